@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import bisect
+from array import array
+
+from search_index import fold
+
+
+class affinity_graph:
+    ''' Weighted graph over folders connecting those which are likely to
+        sound alike: a folder and its closest ancestor with tracks, its
+        siblings and folders sharing rare words in their path (e.g. the
+        artist's name). Stored in flat arrays (compressed sparse rows) so
+        a random step costs O(log degree).
+    '''
+
+    # groups of siblings or folders sharing a word above that size don't
+    # get fully connected - a word that common says nothing
+    MAX_GROUP = 40
+
+    # strongest edges kept per folder
+    MAX_DEGREE = 32
+
+    def __init__(self, folders) -> None:
+        ''' @folders yields (folder index, root, relative path) '''
+        _folders = sorted(folders, key=lambda f: (f[1], f[2]))
+        _edges = {f[0]: {} for f in _folders}
+
+        def connect(a, b, weight):
+            if a != b:
+                _edges[a][b] = _edges[a].get(b, 0.) + weight
+                _edges[b][a] = _edges[b].get(a, 0.) + weight
+
+        _by_path = {(r, p): f for f, r, p in _folders}
+        _children = {}
+        _words = {}
+        for _folder, _root, _relpath in _folders:
+            _children.setdefault((_root, os.path.dirname(_relpath)), []).append(_folder)
+            for _word in set(fold(_relpath).split()):
+                if len(_word) > 2 and not _word.isdigit():
+                    _words.setdefault(_word, []).append(_folder)
+            # the closest ancestor actually having tracks
+            _ancestor = _relpath
+            while _ancestor:
+                _ancestor = os.path.dirname(_ancestor)
+                if (_root, _ancestor) in _by_path:
+                    connect(_folder, _by_path[(_root, _ancestor)], 1.)
+                    break
+
+        for _group in _children.values():
+            affinity_graph._connect_group(_group, 1., connect)
+        for _group in _words.values():
+            if len(_group) > 1:
+                affinity_graph._connect_group(_group, 2. / len(_group), connect)
+
+        self._offsets = array('l', (0,))
+        self._targets = array('l')
+        # cumulated weights per folder for sampling by bisection
+        self._cumulated = array('d')
+        self._index = {}
+        for _folder, _neighbours in _edges.items():
+            self._index[_folder] = len(self._offsets) - 1
+            _strongest = sorted(_neighbours.items(), key=lambda e: -e[1])[
+                :affinity_graph.MAX_DEGREE]
+            _sum = 0.
+            for _target, _weight in _strongest:
+                _sum += _weight
+                self._targets.append(_target)
+                self._cumulated.append(_sum)
+            self._offsets.append(len(self._targets))
+
+    def __len__(self):
+        return len(self._index)
+
+    def neighbours(self, folder: int) -> dict:
+        _node = self._index.get(folder)
+        if _node is None:
+            return {}
+        _begin, _end = self._offsets[_node], self._offsets[_node + 1]
+        _result = {}
+        _previous = 0.
+        for i in range(_begin, _end):
+            _result[self._targets[i]] = self._cumulated[i] - _previous
+            _previous = self._cumulated[i]
+        return _result
+
+    def step(self, folder: int, rnd):
+        ''' returns a neighbour of @folder chosen by edge weight or None '''
+        _node = self._index.get(folder)
+        if _node is None:
+            return None
+        _begin, _end = self._offsets[_node], self._offsets[_node + 1]
+        if _begin == _end:
+            return None
+        _value = rnd.random() * self._cumulated[_end - 1]
+        return self._targets[min(
+            bisect.bisect_right(self._cumulated, _value, _begin, _end), _end - 1)]
+
+    @staticmethod
+    def _connect_group(group: list, weight: float, connect) -> None:
+        if len(group) <= affinity_graph.MAX_GROUP:
+            for i, a in enumerate(group):
+                for b in group[i + 1:]:
+                    connect(a, b, weight)
+        else:
+            # too many to connect all - neighbours by name are still
+            # likely to be related
+            for a, b in zip(group, group[1:]):
+                connect(a, b, weight)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+log = logging.getLogger('ban_matcher')
+
+
+class aho_corasick:
+    ''' Finds all occurrences of a set of patterns in a text in one pass '''
+
+    def __init__(self, patterns: list) -> None:
+        # state -> {character: next state}, state 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        # state -> pattern ids ending in this state (including fail states)
+        self._output = [()]
+        for _id, _pattern in enumerate(patterns):
+            _state = 0
+            for _char in _pattern:
+                _next = self._goto[_state].get(_char)
+                if _next is None:
+                    _next = len(self._goto)
+                    self._goto[_state][_char] = _next
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                _state = _next
+            self._output[_state] += (_id,)
+
+        # breadth first, so fail links always point to finished states
+        _queue = list(self._goto[0].values())
+        for _state in _queue:
+            for _char, _next in self._goto[_state].items():
+                _fail = self._fail[_state]
+                while _fail and _char not in self._goto[_fail]:
+                    _fail = self._fail[_fail]
+                _fail = self._goto[_fail].get(_char, 0)
+                self._fail[_next] = _fail
+                self._output[_next] += self._output[_fail]
+                _queue.append(_next)
+
+    def find(self, text: str) -> frozenset:
+        ''' returns the ids of all patterns contained in @text '''
+        _goto, _fail, _output = self._goto, self._fail, self._output
+        _state = 0
+        _result = set(_output[0])
+        for _char in text:
+            while _state and _char not in _goto[_state]:
+                _state = _fail[_state]
+            _state = _goto[_state].get(_char, 0)
+            if _output[_state]:
+                _result.update(_output[_state])
+        return frozenset(_result)
+
+
+class ban_matcher:
+    ''' Checks tracks against all ban rules of a smartlist at once. Folder
+        and file names are given as interned name indices and @lowered
+        maps them to their lower case representation.
+        Pattern hits are cached per folder until a new rule gets added.
+    '''
+
+    def __init__(self, rules: list, lowered) -> None:
+        self._lowered = lowered
+        self._rules = []
+        self._pattern_ids = {}
+        # pattern id -> [rule index] banning on a match in folder or file
+        self._in_either = []
+        # pattern id -> [rule index] banning on a match in folder / file
+        self._in_folder = []
+        self._in_file = []
+        # folder pattern id -> [(file pattern id, rule index)]
+        self._in_both = []
+        self._automaton = None
+        for r in rules:
+            self._add_rule(r)
+        self._compile()
+
+    def __len__(self):
+        return len(self._rules)
+
+    def add_rule(self, rule) -> None:
+        self._add_rule(rule)
+        self._compile()
+
+    def banning_rules(self, folder: int, filename: int) -> list:
+        ''' returns all rules banning the given track in their order '''
+        return [self._rules[r] for r in sorted(self._rule_indices(folder, filename))]
+
+    def _rule_indices(self, folder: int, filename: int) -> set:
+        if not self._rules:
+            return set()
+        _folder_hits = self._folder_hits.get(folder)
+        if _folder_hits is None:
+            _folder_hits = self._automaton.find(self._lowered(folder))
+            self._folder_hits[folder] = _folder_hits
+        _file_hits = self._automaton.find(self._lowered(filename))
+
+        _result = set()
+        if _folder_hits or _file_hits:
+            for p in _folder_hits | _file_hits:
+                _result.update(self._in_either[p])
+            for p in _folder_hits:
+                _result.update(self._in_folder[p])
+                _result.update(r for q, r in self._in_both[p] if q in _file_hits)
+            for p in _file_hits:
+                _result.update(self._in_file[p])
+        return _result
+
+    def _pattern_id(self, pattern: str) -> int:
+        if pattern not in self._pattern_ids:
+            self._pattern_ids[pattern] = len(self._pattern_ids)
+            self._in_either.append([])
+            self._in_folder.append([])
+            self._in_file.append([])
+            self._in_both.append([])
+        return self._pattern_ids[pattern]
+
+    def _add_rule(self, rule) -> None:
+        if not rule._is_ban_tag:
+            return
+        _index = len(self._rules)
+        self._rules.append(rule)
+        # see scheduler.rule.matches()
+        if rule._folder_component is None and rule._file_component is None:
+            self._in_either[self._pattern_id(rule.tag_string)].append(_index)
+        elif rule._file_component is None:
+            self._in_folder[self._pattern_id(rule._folder_component)].append(_index)
+        elif rule._folder_component is None:
+            self._in_file[self._pattern_id(rule._file_component)].append(_index)
+        else:
+            _file_id = self._pattern_id(rule._file_component)
+            self._in_both[self._pattern_id(rule._folder_component)].append(
+                (_file_id, _index))
+
+    def _compile(self) -> None:
+        self._automaton = aho_corasick(list(self._pattern_ids))
+        self._folder_hits = {}
+        log.debug('compiled %d ban rules with %d patterns',
+                  len(self._rules), len(self._pattern_ids))
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Synthetic benchmarks for the server components. They create their
+    own throwaway music library so they can run anywhere, e.g.
+
+        ./benchmark.py startup --folders 2000 --files 20
+'''
+
+import os
+import sys
+import time
+import wave
+import shutil
+import select
+import subprocess
+import random
+import argparse
+import tempfile
+import logging
+import tracemalloc
+import threading
+
+import zmq
+
+from scheduler import scheduler
+import server
+from watcher import polling_watcher
+from bitset import bitset
+from history import play_history
+from mplayer_output import mplayer_output
+import metadata
+
+
+_WORDS = ('love', 'night', 'dance', 'blue', 'heart', 'fire', 'dream', 'city',
+          'moon', 'rain', 'gold', 'wild', 'summer', 'shadow', 'electric',
+          'river', 'angel', 'storm', 'silver', 'sound', 'echo', 'stone')
+
+
+def _title(rnd, n):
+    return ' '.join(rnd.choice(_WORDS) for _ in range(n)) + ' %d' % rnd.randrange(10000)
+
+
+def _create_library(root, folders, files):
+    _rnd = random.Random(42)
+    for i in range(folders):
+        _folder = os.path.join(root, _title(_rnd, 2), _title(_rnd, 2))
+        os.makedirs(_folder, exist_ok=True)
+        for j in range(files):
+            open(os.path.join(
+                _folder, '%02d - %s.mp3' % (j, _title(_rnd, 3))), 'w').close()
+
+
+def _config(tmp):
+    return {'music_file_pattern': (".mp3", ".mp4", ".m4a", ".ogg", ".opus", ),
+            'playlist_folder':    os.path.join(tmp, 'lists'),
+            'read_metadata':      False,
+            'analyze_loudness':   False}
+
+
+def bench_startup(args):
+    ''' compare crawling a library without and with a library index '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+
+        _t = time.time()
+        with scheduler(config=_config(_tmp)) as s:
+            _count = s.add_path(_music)
+        _cold = time.time() - _t
+
+        _t = time.time()
+        with scheduler(config=_config(_tmp)) as s:
+            s.add_path(_music)
+        _warm = time.time() - _t
+
+    print('startup with %d tracks: cold %.3fs, warm %.3fs (%.1fx)' % (
+        _count, _cold, _warm, _cold / _warm))
+
+
+# latency search_filenames() should stay below for selective queries -
+# those with words matching less than that many names
+_SEARCH_TARGET = .001
+_SELECTIVE_NAMES = 1000
+
+
+def bench_search(args):
+    ''' average latency of search_filenames() '''
+    _queries = ('blue 1234', 'electric storm 77', 'shadow moon', 'xyz', 'e',
+                'electrik', 'SHADOW-moon', 'sylver angle', '24017',
+                'artist 2417', 'album silver 24017')
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        with scheduler(config=_config(_tmp)) as s:
+            _count = s.add_path(_music)
+            _slow = []
+            for _query in _queries:
+                # names matching the words, summed up
+                _names = sum(len(n) for w in _query.split()
+                             for n, _ in s._search_index.search_groups(w))
+                # numpy imports some of its parts on first use
+                s.search_filenames(_query)
+                _t = time.time()
+                for _ in range(args.repeat):
+                    s.search_filenames(_query)
+                _latency = (time.time() - _t) / args.repeat
+                _selective = _names < _SELECTIVE_NAMES
+                if _selective and _latency > _SEARCH_TARGET:
+                    _slow.append(_query)
+                print('search in %d tracks for %-20r %8.3fms (%d names%s)' % (
+                    _count, _query, _latency * 1000, _names,
+                    ', selective' if _selective else ''))
+    print('search: %d of the selective queries took longer than %.1fms%s' % (
+        len(_slow), _SEARCH_TARGET * 1000, ': %r' % _slow if _slow else ''))
+
+
+def bench_search_large(args):
+    ''' bench_search() with a library of 500k tracks '''
+    bench_search(argparse.Namespace(**dict(vars(args), folders=25000, files=20)))
+
+
+def bench_memory(args):
+    ''' memory held by the scheduler per crawled track '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        tracemalloc.start()
+        _before = tracemalloc.get_traced_memory()[0]
+        with scheduler(config=_config(_tmp)) as s:
+            _count = s.add_path(_music)
+            _size = tracemalloc.get_traced_memory()[0] - _before
+        tracemalloc.stop()
+
+    print('memory for %d tracks: %.1fMB, %d bytes per track' % (
+        _count, _size / 2**20, _size / _count))
+
+
+def bench_refresh(args):
+    ''' apply changes in 10% of all folders compared to crawling again '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        with scheduler(config=_config(_tmp)) as s:
+            s.add_path(_music)
+            _folders = sorted({os.path.join(_root, _relpath)
+                               for _root, _relpath, _ in s.known_dirs()})
+            time.sleep(.01)
+            for _folder in _folders[::10]:
+                for j in range(args.files):
+                    open(os.path.join(_folder, 'new track %d.mp3' % j), 'w').close()
+
+            _slots = len(s._track_name)
+            _t = time.time()
+            _delta = polling_watcher(s).poll()
+            _refresh = time.time() - _t
+            _slots = len(s._track_name) - _slots
+
+        _t = time.time()
+        with scheduler(config=_config(_tmp)) as s:
+            _count = s.add_path(_music)
+        _crawl = time.time() - _t
+
+    print('refresh %d new tracks (%d track slots used): %.3fs, '
+          'full crawl of %d tracks: %.3fs' % (_delta, _slots, _refresh, _count, _crawl))
+
+
+def bench_tags(args):
+    ''' add_tag throughput on a smartlist which already has 100k rules '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders // 10, args.files)
+        with scheduler(config=_config(_tmp)) as s:
+            s.add_path(_music)
+            _tracks = [s.get_next() for _ in range(100)]
+        with open(os.path.join(_tmp, 'lists', 'unspecified'), 'w') as _f:
+            for i in range(100000):
+                _f.write('%.3f, frans, upvote, %s, 0.00\n' % (
+                    time.time(), os.path.join(*_tracks[i % 100][1:])))
+
+        _t = time.time()
+        with scheduler(config=_config(_tmp)) as s:
+            _load = time.time() - _t
+            s.add_path(_music)
+            _count = args.repeat * 50
+            _t = time.time()
+            for i in range(_count):
+                s.add_tag(listener='frans', track=_tracks[i % 100], pos=1,
+                          details={'tag_name': 'upvote'})
+            _append = (time.time() - _t) / _count
+            # what storing the smartlist used to cost on every single tag
+            _t = time.time()
+            s._compact_journal()
+            s._list.journal.close()
+            _rewrite = time.time() - _t
+
+    print('100k rules: replay %.3fs, add_tag %.3fms, full rewrite %.3fms' % (
+        _load, _append * 1000, _rewrite * 1000))
+
+
+def bench_switch(args):
+    ''' switching between smartlists with 10k rules each, kept loaded or
+        read again every time '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        os.makedirs(os.path.join(_tmp, 'lists'))
+        _rnd = random.Random(42)
+        for _name in ('party', 'concentration'):
+            with open(os.path.join(_tmp, 'lists', _name), 'w') as _f:
+                for i in range(10000):
+                    _f.write('%.3f, frans, upvote, %s/%s.mp3, 0.00\n' % (
+                        time.time(), _title(_rnd, 2), _title(_rnd, 3)))
+
+        _results = []
+        for _memory_limit in (256, 0):
+            with scheduler(config=dict(_config(_tmp),
+                                       smartlist_memory_limit=_memory_limit)) as s:
+                s.add_path(_music)
+                _t = time.time()
+                for i in range(args.repeat):
+                    s.activate_smartlist(('party', 'concentration')[i % 2])
+                _results.append((time.time() - _t) / args.repeat)
+
+    print('switch smartlists: preloaded %.3fms, reloaded %.3fms' % (
+        _results[0] * 1000, _results[1] * 1000))
+
+
+def bench_listeners(args):
+    ''' combine the bans of 50 listeners over 500k tracks and let
+        listeners come and go '''
+    _rnd = random.Random(42)
+    _tracks = 500000
+    _bans = [bitset(_rnd.randrange(_tracks) for _ in range(_tracks // 100))
+             for _ in range(50)]
+    _t = time.time()
+    for _ in range(args.repeat):
+        _union = bitset.union(_bans)
+    _combine = (time.time() - _t) / args.repeat
+    _t = time.time()
+    for _ in range(args.repeat):
+        _union.unpack(_tracks)
+    _unpack = (time.time() - _t) / args.repeat
+
+    print('50 listeners, %d tracks: combine %.3fms, unpack %.3fms' % (
+        _tracks, _combine * 1000, _unpack * 1000))
+
+    # a listener coming and going with and without bans of their own
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        with scheduler(config=dict(_config(_tmp), lookahead=0)) as s:
+            s.add_path(_music)
+            for i, w in enumerate(_WORDS):
+                s.add_tag(listener='listener%d' % i, track=None, pos=1,
+                          details={'tag_name': 'ban', 'subject': w})
+            s.add_present_listener('listener0')
+            _results = []
+            for _listener in ('guest', 'listener1'):
+                _t = time.time()
+                for _ in range(args.repeat):
+                    s.add_present_listener(_listener)
+                    s.remove_present_listener(_listener)
+                _results.append((time.time() - _t) / args.repeat / 2)
+            _count = len(s._track_name)
+
+    print('presence change, %d tracks: without bans %.3fms, with bans %.3fms' % (
+        _count, _results[0] * 1000, _results[1] * 1000))
+
+
+def bench_metadata(args):
+    ''' read the tags of a library for the first time and again after a
+        restart '''
+    if metadata.mutagen is None:
+        print('metadata: needs mutagen')
+        return
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders // 10, args.files)
+        _rnd = random.Random(42)
+        for _dir, _, _files in os.walk(_music):
+            for f in _files:
+                _id3 = metadata.mutagen.easyid3.EasyID3()
+                _id3.update({'artist': _title(_rnd, 2), 'album': _title(_rnd, 2),
+                             'title': _title(_rnd, 3)})
+                _id3.save(os.path.join(_dir, f))
+
+        _results = []
+        for _ in range(2):
+            with scheduler(config=dict(_config(_tmp), read_metadata=True)) as s:
+                # tags get read while crawling goes on
+                _t = time.time()
+                _count = s.add_path(_music)
+                s._metadata.wait()
+                _results.append(_count / (time.time() - _t))
+
+    print('read tags of %d files: cold %.0f files/s, warm %.0f files/s' % (
+        _count, _results[0], _results[1]))
+
+
+def bench_affinity(args):
+    ''' build the affinity graph and schedule along it '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        with scheduler(config=dict(_config(_tmp), scheduling_mode='affinity',
+                                   lookahead=0)) as s:
+            _count = s.add_path(_music)
+            _t = time.time()
+            s.get_next()
+            s.get_next()
+            _build = time.time() - _t
+            _t = time.time()
+            for _ in range(args.repeat * 50):
+                s.get_next()
+            _step = (time.time() - _t) / (args.repeat * 50)
+            _edges = sum(len(s._affinity.neighbours(f)) for f in range(len(s._affinity)))
+            # a new folder gets the graph rebuilt in the background
+            _more = os.path.join(_tmp, 'more')
+            _create_library(_more, 1, args.files)
+            s.add_path(_more)
+            _t = time.time()
+            s.get_next()
+            _changed = time.time() - _t
+
+    print('affinity graph over %d tracks: %d edges, built in %.3fs, '
+          'get_next() %.3fms, %.3fms after a new folder' % (
+              _count, _edges, _build, _step * 1000, _changed * 1000))
+
+
+def bench_lookahead(args):
+    ''' time getting and opening the next track at the end of a track
+        with and without tracks picked ahead '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        _results = []
+        for _size in (0, 3):
+            with scheduler(config=dict(_config(_tmp), lookahead=_size)) as s:
+                s.add_path(_music)
+                _total = 0.
+                for _ in range(args.repeat * 10):
+                    # a track playing gives the worker time to catch up
+                    time.sleep(.005)
+                    _t = time.time()
+                    # what the player does before audio comes out
+                    with open(os.path.join(*s.get_next()), 'rb') as _f:
+                        _f.read(64 * 1024)
+                    _total += time.time() - _t
+                _results.append(_total / (args.repeat * 10))
+
+    print('next track ready without lookahead %.3fms, with lookahead %.3fms'
+          % (_results[0] * 1000, _results[1] * 1000))
+
+
+def bench_history(args):
+    ''' query five years of play history '''
+    with tempfile.TemporaryDirectory() as _tmp:
+        _rnd = random.Random(42)
+        _tracks = ['%d/%d.mp3' % (i // args.files, i % args.files)
+                   for i in range(args.folders * args.files)]
+        h = play_history(os.path.join(_tmp, 'play_history'))
+        _count = 5 * 365 * 250
+        _start = time.time() - 5 * 365 * 86400
+        _t = time.time()
+        for i in range(_count):
+            _track = _rnd.choice(_tracks)
+            h.record(_track, os.path.dirname(_track), ('frans', 'julia'),
+                     _start + i * 5 * 365 * 86400 / _count, 100., 200.,
+                     _rnd.random() < .2)
+        _record = (time.time() - _t) / _count
+        _t = time.time()
+        for _ in range(args.repeat):
+            h.top_played(50, time.time() - 7 * 86400)
+        _week = (time.time() - _t) / args.repeat
+        _t = time.time()
+        for _ in range(args.repeat):
+            h.top_played(50)
+        _top = (time.time() - _t) / args.repeat
+        _t = time.time()
+        for _ in range(args.repeat):
+            h.skip_rates(50)
+        _skips = (time.time() - _t) / args.repeat
+        h.close()
+
+    print('play history of %d plays: record %.3fms, top of the week %.3fms, '
+          'top ever %.3fms, skip rates %.3fms' % (
+              _count, _record * 1000, _week * 1000, _top * 1000, _skips * 1000))
+
+
+def bench_mplayer(args):
+    ''' time from asking for the next track until audio gets played with
+        an mplayer process per track and with one idling in between '''
+    if shutil.which('mplayer') is None:
+        print('mplayer: needs mplayer')
+        return
+    import server
+
+    class handler:
+        def __init__(self, control):
+            self._control = control
+            self.filename = None
+            self.playing = None
+
+        def handler_get_filename(self):
+            return self.filename
+
+        def handler_get_volume(self):
+            return 1.
+
+        def handler_get_pause(self):
+            return False
+
+        def handler_set_pause(self, value):
+            pass
+
+        def handler_update_pos(self, now, total):
+            if self.playing is None:
+                self.playing = time.time()
+                self._control.put('skip')
+
+    _args = ['-ao', 'null', '-vo', 'null']
+    with tempfile.TemporaryDirectory() as _tmp:
+        _files = []
+        for i in range(args.repeat):
+            _files.append(os.path.join(_tmp, '%d.wav' % i))
+            with wave.open(_files[-1], 'wb') as _f:
+                _f.setnchannels(2)
+                _f.setsampwidth(2)
+                _f.setframerate(44100)
+                _f.writeframes(bytes(4 * 44100 * 5))
+
+        # what blocking_play() used to do
+        _spawned = 0.
+        for f in _files:
+            _t = time.time()
+            _process = subprocess.Popen(['mplayer', '-slave', '-nolirc'] + _args + [f],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        stdin=subprocess.PIPE, bufsize=0)
+            _output = b''
+            while b'A:' not in _output:
+                select.select([_process.stdout], [], [], 1.)
+                _output += os.read(_process.stdout.fileno(), 1000)
+            _spawned += time.time() - _t
+            _process.kill()
+            _process.wait()
+
+        _control = server.control_channel()
+        _handler = handler(_control)
+        _idle = 0.
+        with server.player.backend_mplayer(_control, _handler, _args) as _backend:
+            # starts the process
+            _handler.filename = _files[0]
+            _backend.blocking_play()
+            for f in _files:
+                _handler.filename, _handler.playing = f, None
+                _t = time.time()
+                _backend.blocking_play()
+                _idle += _handler.playing - _t
+        _control.close()
+
+    print('track switch: process per track %.1fms, idle process %.1fms' % (
+        _spawned / len(_files) * 1000, _idle / len(_files) * 1000))
+
+
+def bench_parser(args):
+    ''' CPU time spent on an hour of mplayer output, parsed the way
+        backend_mplayer used to and with mplayer_output '''
+    # mplayer writes a status line every few dozen milliseconds, a single
+    # read usually gets one of them
+    _rate = 30
+    _chunks = [b'A: %6.1f (%04.1f) of 245.0 (04:05.0)  0.5%% \r' % (i / _rate, i / _rate)
+               for i in range(3600 * _rate)]
+    _updates = []
+
+    def handler_update_pos(now, total):
+        _updates.append(now)
+
+    _last_pos = [0.]
+
+    def old_handler_update_pos(now, total):
+        if now - _last_pos[0] < 1.:
+            return
+        _last_pos[0] = now
+        _updates.append(now)
+
+    def old_handle_output(line):
+        elems = line.strip().split()
+        if len(elems) == 0:
+            return
+        if elems[0] == "A:":
+            old_handler_update_pos(float(elems[1]), float(elems[4]))
+
+    _old = _new = float('inf')
+    for _ in range(5):
+        _t = time.process_time()
+        for _chunk in _chunks:
+            old_handle_output(_chunk.decode(errors='replace'))
+        _old = min(_old, time.process_time() - _t)
+
+        _output = mplayer_output(1.)
+        _t = time.process_time()
+        for _chunk in _chunks:
+            _output.feed(_chunk)
+            _progress = _output.progress()
+            if _progress is not None:
+                handler_update_pos(*_progress)
+        _new = min(_new, time.process_time() - _t)
+
+    print('CPU per hour of playback (%d status lines): before %.0fms, after %.0fms'
+          % (len(_chunks), _old * 1000, _new * 1000))
+
+
+def bench_soak(args):
+    ''' let the player play a simulated week with the null backend and
+        count tracks and notifications '''
+    _days = 7.
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _create_library(_music, args.folders, args.files)
+        _context = zmq.Context()
+        _soak_config = dict(_config(_tmp), player_backend='null',
+                            null_speedup=100000., notification_endpoint='inproc://soak')
+        _socket = _context.socket(zmq.PAIR)
+        _socket.bind(_soak_config['notification_endpoint'])
+        with scheduler(config=_soak_config) as s:
+            s.add_path(_music)
+            p = server.player(_context, _soak_config)
+            p.set_scheduler(s)
+            _messages = 0
+            _tracks = 0
+            _t = time.time()
+            p.play()
+            _virtual = 0.
+            while _virtual < _days * 86400:
+                _message = _socket.recv_json()
+                _messages += 1
+                if 'current_track' in _message:
+                    _tracks += 1
+                elif 'track_length' in _message and float(_message['current_pos']) == 0.:
+                    _virtual += float(_message['track_length'])
+            _elapsed = time.time() - _t
+            threading.Thread(target=p.stop).start()
+            # the player blocks on sending until it's stopped
+            while p._playing:
+                if _socket.poll(100):
+                    _socket.recv_json()
+        # the player leaves its socket open
+        _context.destroy(linger=0)
+
+    print('%.0f simulated days in %.1fs: %d tracks, %.0f tracks/s, %.0f notifications/s'
+          % (_days, _elapsed, _tracks, _tracks / _elapsed, _messages / _elapsed))
+
+
+def main():
+    _benchmarks = {'startup': bench_startup,
+                   'search':  bench_search,
+                   'search500k': bench_search_large,
+                   'memory':  bench_memory,
+                   'refresh': bench_refresh,
+                   'tags':    bench_tags,
+                   'switch':  bench_switch,
+                   'listeners': bench_listeners,
+                   'metadata': bench_metadata,
+                   'affinity': bench_affinity,
+                   'lookahead': bench_lookahead,
+                   'history': bench_history,
+                   'mplayer': bench_mplayer,
+                   'parser': bench_parser,
+                   'soak': bench_soak}
+
+    parser = argparse.ArgumentParser(description='run server benchmarks')
+    parser.add_argument('benchmark', nargs='*',
+                        help='benchmarks to run, one of %s (default: all)'
+                        % ', '.join(_benchmarks))
+    parser.add_argument('--folders', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+    for _name in args.benchmark:
+        if _name not in _benchmarks:
+            parser.error('unknown benchmark "%s"' % _name)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    print('.'.join(str(e) for e in sys.version_info))
+
+    for _name in args.benchmark or _benchmarks:
+        _benchmarks[_name](args)
+
+
+if __name__ == '__main__':
+    main()
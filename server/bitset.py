@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import functools
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# byte -> its 8 bits as one byte each, least significant first
+_UNPACKED = [bytes((b >> i) & 1 for i in range(8)) for b in range(256)]
+
+
+class bitset:
+    ''' A set of track indices packed into a bytearray with one bit per
+        index. It grows as indices get added so sparse sets of high
+        indices still cost n/8 bytes.
+    '''
+
+    def __init__(self, indices=()) -> None:
+        self._bytes = bytearray()
+        for i in indices:
+            self.add(i)
+
+    def __contains__(self, index: int) -> bool:
+        _byte = index >> 3
+        return _byte < len(self._bytes) and bool(self._bytes[_byte] >> (index & 7) & 1)
+
+    def add(self, index: int) -> None:
+        _byte = index >> 3
+        if _byte >= len(self._bytes):
+            self._bytes.extend(bytes(_byte + 1 - len(self._bytes)))
+        self._bytes[_byte] |= 1 << (index & 7)
+
+    def count(self) -> int:
+        return bin(int.from_bytes(self._bytes, 'little')).count('1')
+
+    def nbytes(self) -> int:
+        return len(self._bytes)
+
+    @staticmethod
+    def union(bitsets) -> 'bitset':
+        ''' ORs all @bitsets at once, vectorized if numpy is available.
+            Otherwise Python's arbitrary size integers do the job which
+            process machine words instead of single bits, too '''
+        _bitsets = list(bitsets)
+        _result = bitset()
+        if numpy is not None:
+            _size = max((len(b._bytes) for b in _bitsets), default=0)
+            _result._bytes = bytearray(_size)
+            _view = numpy.frombuffer(_result._bytes, dtype=numpy.uint8)
+            for b in _bitsets:
+                if b._bytes:
+                    _view[:len(b._bytes)] |= numpy.frombuffer(b._bytes, dtype=numpy.uint8)
+            return _result
+        _value = functools.reduce(
+            operator.or_, (int.from_bytes(b._bytes, 'little') for b in _bitsets), 0)
+        _result._bytes = bytearray(_value.to_bytes((_value.bit_length() + 7) // 8,
+                                                   'little'))
+        return _result
+
+    def unpack(self, size: int) -> bytearray:
+        ''' returns a bytearray with one byte (0 or 1) for each of the
+            indices [0, @size) '''
+        if numpy is not None:
+            _result = bytearray(numpy.unpackbits(
+                numpy.frombuffer(self._bytes, dtype=numpy.uint8),
+                bitorder='little').tobytes())
+        else:
+            _result = bytearray(b''.join(map(_UNPACKED.__getitem__, self._bytes)))
+        if len(_result) < size:
+            _result.extend(bytes(size - len(_result)))
+        del _result[size:]
+        return _result
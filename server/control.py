@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import select
+import collections
+
+
+class control_channel:
+    ''' Commands for a player backend: a queue plus a self-pipe whose read
+        end becomes readable with every command, so a backend can wait for
+        commands with select() together with its other file descriptors.
+        Keeps track of how long commands wait before they get taken.
+    '''
+
+    def __init__(self) -> None:
+        # (command, time put), appended and popped atomically
+        self._queue = collections.deque()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+        self._count = 0
+        self._total_latency = 0.
+        self._max_latency = 0.
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def close(self) -> None:
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def put(self, command: str) -> None:
+        self._queue.append((command, time.monotonic()))
+        try:
+            os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            # the pipe is full of wakeups - it's readable anyway
+            pass
+
+    def take(self) -> list:
+        ''' returns all commands put so far '''
+        # empty the pipe first - a command put meanwhile wakes up again
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        _now = time.monotonic()
+        _result = []
+        while self._queue:
+            _command, _time = self._queue.popleft()
+            _latency = _now - _time
+            self._count += 1
+            self._total_latency += _latency
+            self._max_latency = max(self._max_latency, _latency)
+            _result.append(_command)
+        return _result
+
+    def clear(self) -> None:
+        ''' drops all commands without counting them '''
+        self._queue.clear()
+
+    def wait(self, timeout: float=None) -> bool:
+        ''' blocks until a command has been put or @timeout has passed '''
+        return bool(select.select([self._read_fd], [], [], timeout)[0])
+
+    def latency(self) -> dict:
+        ''' returns the number of commands taken and their mean and maximum
+            latency in seconds '''
+        return {'count': self._count,
+                'mean': self._total_latency / self._count if self._count else 0.,
+                'max': self._max_latency}
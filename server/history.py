@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import struct
+import bisect
+import threading
+import collections
+import logging
+log = logging.getLogger('history')
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# start time, track, folder and present listeners (as name ids), position
+# reached and track length in seconds, flags
+RECORD = struct.Struct('<dIIIffI')
+if numpy is not None:
+    _DTYPE = numpy.dtype([('time', '<f8'), ('track', '<u4'), ('folder', '<u4'),
+                          ('listeners', '<u4'), ('position', '<f4'),
+                          ('length', '<f4'), ('flags', '<u4')])
+    assert _DTYPE.itemsize == RECORD.size
+
+FLAG_SKIPPED = 1
+
+
+def _largest(values, count: int):
+    ''' returns the indices of the @count largest @values, largest first
+        and lowest index first among equal ones '''
+    if 0 < count < len(values):
+        # only sort those which can make it
+        _threshold = numpy.partition(values, len(values) - count)[len(values) - count]
+        _candidates = numpy.nonzero(values >= _threshold)[0]
+    else:
+        _candidates = numpy.arange(len(values))
+    return _candidates[numpy.argsort(-values[_candidates], kind='stable')][:count]
+
+
+class play_history:
+    ''' Every played track as a fixed width record appended to @path.
+        Tracks, folders and sets of listeners are stored as ids into a
+        table of names (@path.names, one JSON string per line) which only
+        ever grows, so ids stay valid across restarts and re-crawls.
+        Queries map the log into memory and - if numpy is available -
+        count with vectorized operations.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._names_path = path + '.names'
+        self._lock = threading.Lock()
+        self._names = []
+        self._name_ids = {}
+        # bytes of complete lines in the names file
+        self._names_size = 0
+        self._load_names()
+        # opened on the first record so there are no files without history
+        self._fd = None
+        self._names_file = None
+        self._mmap = None
+
+    def __len__(self):
+        try:
+            return os.stat(self._path).st_size // RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._names_file.close()
+                self._fd = None
+
+    def record(self, track: str, folder: str, listeners, started: float,
+               position: float, length: float, skipped: bool) -> None:
+        with self._lock:
+            if self._fd is None:
+                self._open()
+            _record = RECORD.pack(
+                started, self._name_id(track), self._name_id(folder),
+                self._name_id(','.join(sorted(listeners))),
+                position, length, FLAG_SKIPPED if skipped else 0)
+            # names first - a record must never refer to a missing name
+            self._names_file.flush()
+            os.write(self._fd, _record)
+
+    def top_played(self, count: int=50, since: float=0.) -> list:
+        ''' returns (track, plays) of the @count tracks played most often
+            since @since '''
+        _records = self._records(since)
+        if numpy is not None:
+            _plays = numpy.bincount(_records['track'])
+            return [(self._names[i], int(_plays[i]))
+                    for i in _largest(_plays, count) if _plays[i]]
+        _plays = collections.Counter(r[1] for r in _records)
+        return [(self._names[i], n) for i, n in _plays.most_common(count)]
+
+    def skip_rates(self, count: int=50, since: float=0., min_plays: int=3) -> list:
+        ''' returns (folder, plays, skip rate) of the @count folders skipped
+            most often relative to their plays since @since, ignoring
+            those played less than @min_plays times '''
+        _records = self._records(since)
+        if numpy is not None:
+            _plays = numpy.bincount(_records['folder'])
+            _skips = numpy.bincount(_records['folder'],
+                                    weights=_records['flags'] & FLAG_SKIPPED)
+            _folders = numpy.nonzero(_plays >= max(min_plays, 1))[0]
+            _rates = _skips[_folders] / _plays[_folders]
+            return [(self._names[_folders[i]], int(_plays[_folders[i]]),
+                     float(_rates[i])) for i in _largest(_rates, count)]
+        _plays = collections.Counter(r[2] for r in _records)
+        _skips = collections.Counter(r[2] for r in _records if r[6] & FLAG_SKIPPED)
+        _rates = sorted(((_skips[f] / n, f) for f, n in _plays.items()
+                         if n >= max(min_plays, 1)), key=lambda e: -e[0])
+        return [(self._names[f], _plays[f], r) for r, f in _rates[:count]]
+
+    def _records(self, since: float):
+        ''' returns the records since @since - which is where they start
+            as they get appended in chronological order '''
+        with self._lock:
+            _count = len(self)
+            if self._mmap is None or len(self._mmap) < _count * RECORD.size:
+                # just drop the old mapping - results might still use it
+                self._mmap = None
+                if _count:
+                    with open(self._path, 'rb') as _f:
+                        self._mmap = mmap.mmap(_f.fileno(), _count * RECORD.size,
+                                               access=mmap.ACCESS_READ)
+            _mmap = self._mmap
+        if numpy is not None:
+            if not _count:
+                return numpy.zeros(0, dtype=_DTYPE)
+            _records = numpy.frombuffer(_mmap, dtype=_DTYPE, count=_count)
+            return _records[numpy.searchsorted(_records['time'], since):]
+        if not _count:
+            return []
+        _records = list(RECORD.iter_unpack(_mmap[:_count * RECORD.size]))
+        return _records[bisect.bisect_left(_records, (since,)):]
+
+    def _name_id(self, name: str) -> int:
+        _id = self._name_ids.get(name)
+        if _id is None:
+            _id = len(self._names)
+            self._names.append(name)
+            self._name_ids[name] = _id
+            _line = json.dumps(name) + '\n'
+            self._names_file.write(_line)
+            # json escapes anything but ASCII - characters are bytes
+            self._names_size += len(_line)
+        return _id
+
+    def _load_names(self) -> None:
+        try:
+            with open(self._names_path, 'rb') as _f:
+                _lines = _f.read().split(b'\n')
+        except FileNotFoundError:
+            return
+        # the last one is empty unless it got cut off while being written
+        for _line in _lines[:-1]:
+            _name = json.loads(_line)
+            self._name_ids[_name] = len(self._names)
+            self._names.append(_name)
+            self._names_size += len(_line) + 1
+
+    def _open(self) -> None:
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        _size = os.fstat(self._fd).st_size
+        if _size % RECORD.size:
+            log.warning("drop incomplete record at the end of '%s'", self._path)
+            os.truncate(self._path, _size - _size % RECORD.size)
+        if os.path.exists(self._names_path):
+            os.truncate(self._names_path, self._names_size)
+        self._names_file = open(self._names_path, 'a')
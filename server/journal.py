@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import logging
+log = logging.getLogger('journal')
+
+
+class journal:
+    ''' Append-only line based file. Appended lines reach the OS at once
+        but get fsync'ed by a background thread at most every
+        @sync_interval seconds. A compaction rewrites the file atomically
+        in the background while appending goes on.
+    '''
+
+    def __init__(self, path: str, sync_interval: float=1.) -> None:
+        self._path = path
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = False
+        # lines appended while a compaction is running, None otherwise
+        self._appended_while_compacting = None
+        self._compaction_thread = None
+        self._stop_event = threading.Event()
+        self._sync_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self) -> list:
+        ''' returns all lines of the journal. The last line might be
+            incomplete if we crashed while writing it. '''
+        try:
+            with open(self._path) as _f:
+                return _f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def append(self, line: str) -> None:
+        assert '\n' not in line
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(line + '\n')
+            self._file.flush()
+            self._unsynced = True
+            if self._appended_while_compacting is not None:
+                self._appended_while_compacting.append(line)
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                os.fsync(self._file.fileno())
+                self._unsynced = False
+
+    def compact(self, lines: list) -> bool:
+        ''' replaces the journal with @lines in the background, returns
+            False if a compaction is running already '''
+        with self._lock:
+            if self._compaction_thread is not None:
+                return False
+            self._appended_while_compacting = []
+            self._compaction_thread = threading.Thread(
+                target=self._compact, args=(lines,), name='compaction')
+            self._compaction_thread.start()
+            return True
+
+    def close(self) -> None:
+        _thread = self._compaction_thread
+        if _thread is not None:
+            _thread.join()
+        self._stop_event.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+            self._sync_thread = None
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _open(self) -> None:
+        self._file = open(self._path, 'a')
+        if self._file.tell() > 0:
+            with open(self._path, 'rb') as _f:
+                _f.seek(-1, os.SEEK_END)
+                # don't continue a line we didn't finish before a crash
+                if _f.read(1) != b'\n':
+                    self._file.write('\n')
+        if self._sync_thread is None:
+            self._stop_event.clear()
+            self._sync_thread = threading.Thread(
+                target=self._sync_fn, name='journal-sync', daemon=True)
+            self._sync_thread.start()
+
+    def _sync_fn(self) -> None:
+        while not self._stop_event.wait(self._sync_interval):
+            self.sync()
+
+    def _compact(self, lines: list) -> None:
+        _tmp_path = self._path + '.tmp'
+        try:
+            with open(_tmp_path, 'w') as _f:
+                _f.writelines(l + '\n' for l in lines)
+                with self._lock:
+                    # lines appended in the meantime go to the new file, too
+                    _f.writelines(l + '\n' for l in self._appended_while_compacting)
+                    _f.flush()
+                    os.fsync(_f.fileno())
+                    os.replace(_tmp_path, self._path)
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = open(self._path, 'a')
+                        self._unsynced = False
+            log.info("compacted '%s' to %d lines", self._path, len(lines))
+        except OSError as ex:
+            log.error("could not compact '%s': %s", self._path, ex)
+        finally:
+            with self._lock:
+                self._appended_while_compacting = None
+                self._compaction_thread = None
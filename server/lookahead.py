@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import collections
+import threading
+import logging
+log = logging.getLogger('lookahead')
+
+# bytes read synchronously from a file to be played next - covers the
+# first seconds of audio even if the kernel ignores the read-ahead advice
+WARM_HEAD_SIZE = 256 * 1024
+
+
+def warm_page_cache(path: str) -> bool:
+    ''' asks the OS to read @path into its page cache so opening it later
+        doesn't wait for a spinning disk or a network share '''
+    try:
+        _fd = os.open(path, os.O_RDONLY)
+    except OSError as ex:
+        log.warning("cannot prefetch '%s': %s", path, ex)
+        return False
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(_fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        os.read(_fd, WARM_HEAD_SIZE)
+        return True
+    except OSError as ex:
+        log.warning("cannot prefetch '%s': %s", path, ex)
+        return False
+    finally:
+        os.close(_fd)
+
+
+class lookahead:
+    ''' Keeps the next @size randomly chosen tracks ready. A worker thread
+        picks them ahead of time via @pick() which returns (track, path)
+        or None, drops those which don't exist and warms the page cache
+        for the file to be played next - which is the one @next_wish()
+        returns or otherwise the first one queued.
+    '''
+
+    # seconds between checks for a new wish to prefetch
+    WISH_CHECK_INTERVAL = 2.
+
+    def __init__(self, pick, next_wish, size: int=3) -> None:
+        self._pick = pick
+        self._next_wish = next_wish
+        self._size = size
+        # (track, path) in the order they'll be played
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        # increased whenever queued tracks become invalid
+        self._generation = 0
+        self._stop = False
+        self._warmed = None
+        self._thread = threading.Thread(target=self._run, name='lookahead',
+                                        daemon=True)
+        self._thread.start()
+
+    def pop(self, eligible):
+        ''' returns the first queued track for which @eligible(track) is
+            still true (e.g. it could have been banned meanwhile) or None '''
+        with self._condition:
+            while self._queue:
+                _track, _ = self._queue.popleft()
+                self._condition.notify()
+                if eligible(_track):
+                    return _track
+        return None
+
+    def tracks(self) -> list:
+        with self._condition:
+            return [t for t, _ in self._queue]
+
+    def clear(self) -> None:
+        ''' drops all queued tracks, e.g. because the smartlist changed '''
+        with self._condition:
+            self._queue.clear()
+            self._generation += 1
+            self._condition.notify()
+
+    def wake(self) -> None:
+        ''' there might be something (new) to pick from '''
+        with self._condition:
+            self._condition.notify()
+
+    def close(self) -> None:
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self) -> None:
+        # @pick and @next_wish lock the scheduler which in turn might wait
+        # for pop() - so never call them while holding _condition
+        while True:
+            self._warm_next()
+            with self._condition:
+                if self._stop:
+                    return
+                if len(self._queue) >= self._size:
+                    self._condition.wait(lookahead.WISH_CHECK_INTERVAL)
+                    continue
+                _generation = self._generation
+
+            _picked = self._pick()
+            if _picked is None:
+                with self._condition:
+                    # nothing to pick from (yet)
+                    self._condition.wait(1.)
+                continue
+            if not os.path.exists(_picked[1]):
+                log.warning("skip non-existing '%s'", _picked[1])
+                with self._condition:
+                    # don't spin if a whole share has gone away
+                    self._condition.wait(.1)
+                continue
+            with self._condition:
+                if _generation == self._generation:
+                    self._queue.append(_picked)
+
+    def _warm_next(self) -> None:
+        _path = self._next_wish()
+        if _path is None:
+            with self._condition:
+                _path = self._queue[0][1] if self._queue else None
+        if _path is not None and _path != self._warmed:
+            self._warmed = _path
+            warm_page_cache(_path)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Measures the integrated loudness of music files the way EBU R128 /
+    ReplayGain 2.0 do - K-weighted, in gated 400ms blocks - in a pool of
+    low priority worker processes and caches it, so the player can even
+    out the level of tracks without analysing anything while playing.
+'''
+
+import os
+import math
+import shutil
+import functools
+import logging
+log = logging.getLogger('loudness')
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metadata import file_cache
+import mixer
+
+# blocks get measured every 100ms
+HOP = mixer.RATE // 10
+# hops read at once
+CHUNK_HOPS = 100
+
+# EBU R128 gates
+ABSOLUTE_GATE = -70.
+RELATIVE_GATE = -10.
+
+
+def _biquad_power(b, a, w):
+    ''' returns |H|² of the biquad filter (@b, @a) at the angular
+        frequencies @w '''
+    _z = numpy.exp(-1j * w)
+    return numpy.abs(numpy.polyval(b[::-1], _z) / numpy.polyval(a[::-1], _z)) ** 2
+
+
+def k_weighting(rate: int, size: int):
+    ''' returns the power response of the K-weighting filter at the bins
+        of a real FFT of @size samples, scaled so multiplying it with
+        the squared magnitudes of the FFT and summing up yields the mean
+        square of the filtered signal '''
+    _w = 2 * math.pi * numpy.fft.rfftfreq(size)
+    # high shelf, +4dB above 1.5kHz
+    _gain, _q, _fc = 4., 1 / math.sqrt(2), 1500.
+    _a = 10 ** (_gain / 40)
+    _w0 = 2 * math.pi * _fc / rate
+    _alpha = math.sin(_w0) / (2 * _q)
+    _cos = math.cos(_w0)
+    _shelf = _biquad_power(
+        numpy.array([_a * ((_a + 1) + (_a - 1) * _cos + 2 * math.sqrt(_a) * _alpha),
+                     -2 * _a * ((_a - 1) + (_a + 1) * _cos),
+                     _a * ((_a + 1) + (_a - 1) * _cos - 2 * math.sqrt(_a) * _alpha)]),
+        numpy.array([(_a + 1) - (_a - 1) * _cos + 2 * math.sqrt(_a) * _alpha,
+                     2 * ((_a - 1) - (_a + 1) * _cos),
+                     (_a + 1) - (_a - 1) * _cos - 2 * math.sqrt(_a) * _alpha]),
+        _w)
+    # high pass at 38Hz
+    _q, _fc = .5, 38.
+    _w0 = 2 * math.pi * _fc / rate
+    _alpha = math.sin(_w0) / (2 * _q)
+    _cos = math.cos(_w0)
+    _high_pass = _biquad_power(
+        numpy.array([(1 + _cos) / 2, -(1 + _cos), (1 + _cos) / 2]),
+        numpy.array([1 + _alpha, -2 * _cos, 1 - _alpha]),
+        _w)
+    # Parseval - all bins but DC and Nyquist stand for two
+    _bins = numpy.full(len(_w), 2.)
+    _bins[0] = 1.
+    if size % 2 == 0:
+        _bins[-1] = 1.
+    return (_shelf * _high_pass * _bins / (size * size)).astype(numpy.float32)
+
+
+def _lufs(power: float) -> float:
+    return -.691 + 10 * math.log10(power)
+
+
+def integrated_loudness(hop_powers):
+    ''' returns the gated loudness in LUFS of the K-weighted @hop_powers
+        (summed over channels) or None if it's all silence '''
+    if len(hop_powers) < 4:
+        return None
+    # 400ms blocks overlapping by 75%
+    _blocks = numpy.convolve(hop_powers, numpy.full(4, .25), 'valid')
+    _blocks = _blocks[_blocks > 10 ** ((ABSOLUTE_GATE + .691) / 10)]
+    if not len(_blocks):
+        return None
+    _threshold = 10 ** ((_lufs(_blocks.mean()) + RELATIVE_GATE + .691) / 10)
+    return _lufs(_blocks[_blocks > _threshold].mean())
+
+
+def measure(path: str, command=mixer.decoder.COMMAND) -> dict:
+    ''' returns the 'loudness' in LUFS and the sample 'peak' of @path,
+        runs in a worker process '''
+    try:
+        _source = mixer.decoder(path, 0., command)
+    except OSError as ex:
+        log.error("can't run the decoder: %s", ex)
+        return {}
+    _weights = k_weighting(mixer.RATE, HOP)
+    _buffer = bytearray(CHUNK_HOPS * HOP * mixer.FRAME_SIZE)
+    _view = memoryview(_buffer)
+    _powers = []
+    _peak = 0
+    try:
+        while True:
+            _size = 0
+            while _size < len(_buffer):
+                _count = _source.readinto(_view[_size:])
+                if not _count:
+                    break
+                _size += _count
+            # the last fraction of a hop doesn't count
+            _hops = _size // (HOP * mixer.FRAME_SIZE)
+            if _hops:
+                _samples = numpy.frombuffer(_buffer, dtype=numpy.int16,
+                                            count=_hops * HOP * mixer.CHANNELS)
+                _peak = max(_peak, int(numpy.abs(_samples.astype(numpy.int32)).max()))
+                _spectra = numpy.fft.rfft(
+                    _samples.reshape(_hops, HOP, mixer.CHANNELS) / 32768., axis=1)
+                _squares = _spectra.real ** 2 + _spectra.imag ** 2
+                # channels are weighted 1 for stereo
+                _powers.append(numpy.einsum('hbc,b->h', _squares, _weights))
+            if _size < len(_buffer):
+                break
+    finally:
+        _source.close()
+    if not _powers:
+        return {}
+    _result = {'peak': _peak / 32768.}
+    _loudness = integrated_loudness(numpy.concatenate(_powers))
+    if _loudness is not None:
+        _result['loudness'] = round(_loudness, 2)
+    return _result
+
+
+def measure_batch(paths: list, command=mixer.decoder.COMMAND) -> list:
+    return [measure(p, command) for p in paths]
+
+
+def _lowest_priority() -> None:
+    # decoding whole files takes a while - playback comes first
+    os.nice(19)
+
+
+def gain(measured: dict, target: float) -> float:
+    ''' returns the factor bringing a track @measured to @target LUFS
+        without clipping, or 1 if its loudness isn't known '''
+    if not measured or 'loudness' not in measured:
+        return 1.
+    _gain = 10 ** ((target - measured['loudness']) / 20)
+    if measured['peak'] > 0.:
+        _gain = min(_gain, 1. / measured['peak'])
+    return _gain
+
+
+class loudness_store(file_cache):
+    ''' The loudness of music files decoded with @command (see
+        mixer.decoder) '''
+
+    WHAT = 'loudness'
+
+    # one file takes a while, so hand them out in small batches
+    BATCH_SIZE = 4
+
+    def __init__(self, cache_path: str, processes: int=None,
+                 command=mixer.decoder.COMMAND) -> None:
+        if numpy is None:
+            raise loudness_store.unavailable('measuring loudness needs numpy')
+        if shutil.which(command[0]) is None:
+            raise loudness_store.unavailable(
+                'measuring loudness needs %s' % command[0])
+        super().__init__(cache_path,
+                         functools.partial(measure_batch, command=tuple(command)),
+                         processes, _lowest_priority)
+
+    def gain(self, path: str, target: float=-18.) -> float:
+        ''' returns the factor to play @path with to reach @target LUFS,
+            1 as long as it hasn't been measured '''
+        return gain(self.get(path), target)
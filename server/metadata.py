@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Reads artist, album and title from the tags of music files in a pool
+    of worker processes and keeps them in a persistent cache - which works
+    for other things read from music files as well.
+'''
+
+import os
+import json
+import time
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+import logging
+log = logging.getLogger('metadata')
+
+try:
+    import mutagen
+    import mutagen.easyid3
+except ImportError:
+    mutagen = None
+
+TAG_NAMES = ('artist', 'album', 'title')
+
+
+def read_tags(path: str) -> dict:
+    ''' returns the tags of @path we're interested in, runs in a worker
+        process '''
+    try:
+        if path.lower().endswith('.mp3'):
+            # ID3 only - no need to look at the MPEG frames
+            _tags = mutagen.easyid3.EasyID3(path)
+        else:
+            _tags = mutagen.File(path, easy=True)
+    except (mutagen.MutagenError, OSError, ValueError):
+        return {}
+    if _tags is None:
+        return {}
+    return {n: _tags[n][0] for n in TAG_NAMES if _tags.get(n)}
+
+
+def read_length(path: str) -> float:
+    ''' returns the duration of @path in seconds or 0 if it's unknown '''
+    if mutagen is None:
+        return 0.
+    try:
+        _file = mutagen.File(path)
+    except (mutagen.MutagenError, OSError, ValueError):
+        return 0.
+    if _file is None or _file.info is None:
+        return 0.
+    return float(getattr(_file.info, 'length', 0.) or 0.)
+
+
+def read_tags_batch(paths: list) -> list:
+    return [read_tags(p) for p in paths]
+
+
+def _lower_priority() -> None:
+    # tag reading must not get in the way of playback
+    os.nice(10)
+
+
+class file_cache:
+    ''' Hands files over to a process pool in the background and caches
+        what @worker returns for a batch of their paths keyed by (path,
+        size, mtime) so unchanged files are never read twice, not even
+        across restarts.
+    '''
+
+    # increase whenever the layout of the cache file changes
+    CACHE_VERSION = 1
+
+    # files handed over to a worker process at once
+    BATCH_SIZE = 64
+
+    # what gets cached, for the log
+    WHAT = 'results'
+
+    # seconds between storing the cache while files are being read
+    STORE_INTERVAL = 60.
+
+    class unavailable(Exception):
+        pass
+
+    def __init__(self, cache_path: str, worker, processes: int=None,
+                 initializer=_lower_priority) -> None:
+        self._cache_path = cache_path
+        self._worker = worker
+        self._initializer = initializer
+        self._processes = processes or max(1, (os.cpu_count() or 2) // 2)
+        self._lock = threading.Lock()
+        # path -> (size, mtime_ns, result)
+        self._cache = self._load()
+        self._dirty = False
+        self._stored = time.monotonic()
+        self._queue = queue.Queue()
+        # set by close() - what's still pending gets dropped
+        self._stop = threading.Event()
+        self._pool = None
+        self._thread = threading.Thread(target=self._run, name=self.WHAT,
+                                        daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, path: str):
+        ''' returns the result for @path or None if it's not known (yet) '''
+        with self._lock:
+            _entry = self._cache.get(path)
+        return None if _entry is None else _entry[2]
+
+    def submit(self, paths) -> None:
+        ''' makes sure the results for all @paths get known eventually '''
+        self._queue.put(list(paths))
+
+    def wait(self) -> None:
+        ''' blocks until all submitted files have been handled '''
+        self._queue.join()
+
+    def close(self) -> None:
+        ''' stops reading files and stores what has been read so far -
+            the rest gets read after the next start '''
+        self._stop.set()
+        self._queue.put(None)
+        with self._lock:
+            if self._pool is not None:
+                # only batches being read right now get finished
+                self._pool.shutdown(wait=False, cancel_futures=True)
+        self._thread.join()
+        self.store()
+
+    def store(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            _snapshot = {'version': self.CACHE_VERSION,
+                         'files': self._cache}
+            _tmp_path = self._cache_path + '.tmp'
+            with open(_tmp_path, 'w') as _f:
+                json.dump(_snapshot, _f, separators=(',', ':'))
+            os.replace(_tmp_path, self._cache_path)
+            self._dirty = False
+            self._stored = time.monotonic()
+        log.info("stored %s of %d files in '%s'", self.WHAT, len(self._cache),
+                 self._cache_path)
+
+    def _load(self) -> dict:
+        try:
+            with open(self._cache_path) as _f:
+                _snapshot = json.load(_f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            log.warning("ignore unreadable %s cache '%s': %s", self.WHAT,
+                        self._cache_path, ex)
+            return {}
+        if _snapshot.get('version') != self.CACHE_VERSION:
+            return {}
+        return {p: tuple(e) for p, e in _snapshot['files'].items()}
+
+    def _stale(self, paths: list) -> list:
+        ''' returns (path, size, mtime_ns) of all @paths not in the cache '''
+        _result = []
+        for p in paths:
+            try:
+                _stat = os.stat(p)
+            except OSError:
+                continue
+            _entry = self._cache.get(p)
+            if (_entry is not None and _entry[0] == _stat.st_size and
+                    _entry[1] == _stat.st_mtime_ns):
+                continue
+            _result.append((p, _stat.st_size, _stat.st_mtime_ns))
+        return _result
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                _items = [self._queue.get()]
+                # take whatever else is waiting so all workers get busy
+                while len(_items) < 1000:
+                    try:
+                        _items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    if self._stop.is_set():
+                        return
+                    _stale = self._stale(
+                        [p for i in _items if i is not None for p in i])
+                    if _stale:
+                        with self._lock:
+                            if self._stop.is_set():
+                                return
+                            if self._pool is None:
+                                # spawned workers don't inherit the server's threads
+                                self._pool = concurrent.futures.ProcessPoolExecutor(
+                                    max_workers=self._processes,
+                                    mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=self._initializer)
+                        self._read(self._pool, _stale)
+                finally:
+                    for _ in _items:
+                        self._queue.task_done()
+                if None in _items:
+                    return
+                if self._queue.empty():
+                    self.store()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+
+    def _read(self, pool, files: list) -> None:
+        _batches = [files[i:i + self.BATCH_SIZE]
+                    for i in range(0, len(files), self.BATCH_SIZE)]
+        try:
+            _futures = [pool.submit(self._worker, [e[0] for e in b])
+                        for b in _batches]
+        except RuntimeError:
+            # close() has shut the pool down meanwhile
+            return
+        for _batch, _future in zip(_batches, _futures):
+            if self._stop.is_set():
+                return
+            try:
+                _results = _future.result()
+            except concurrent.futures.CancelledError:
+                return
+            except Exception as ex:
+                log.error("reading %s failed: %s", self.WHAT, repr(ex))
+                continue
+            with self._lock:
+                for (_path, _size, _mtime), r in zip(_batch, _results):
+                    self._cache[_path] = (_size, _mtime, r)
+                self._dirty = True
+            # a killed server doesn't lose everything read so far
+            if time.monotonic() - self._stored > self.STORE_INTERVAL:
+                self.store()
+        log.info('read %s of %d files', self.WHAT, len(files))
+
+
+class metadata_store(file_cache):
+    ''' The tags of music files, read with mutagen '''
+
+    WHAT = 'tags'
+
+    def __init__(self, cache_path: str, processes: int=None) -> None:
+        if mutagen is None:
+            raise metadata_store.unavailable('reading tags needs mutagen')
+        super().__init__(cache_path, read_tags_batch, processes)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Plays tracks by decoding them to PCM in a subprocess and mixing them
+    block by block with numpy - which allows gapless playback and
+    crossfading. All buffers get allocated up front so the mixing loop
+    doesn't leave garbage behind and can run for days.
+'''
+
+import math
+import wave
+import subprocess
+import logging
+log = logging.getLogger('mixer')
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import sounddevice
+except ImportError:
+    sounddevice = None
+
+import error
+
+RATE = 44100
+CHANNELS = 2
+# bytes per frame of signed 16 bit samples
+FRAME_SIZE = 2 * CHANNELS
+
+
+class unavailable(Exception):
+    pass
+
+
+class decoder:
+    ''' Runs a decoder process writing raw PCM of @path to its stdout,
+        starting at @start seconds '''
+
+    COMMAND = ('ffmpeg', '-v', 'error', '-ss', '{start}', '-i', '{path}',
+               '-f', 's16le', '-ac', str(CHANNELS), '-ar', str(RATE), '-')
+
+    def __init__(self, path: str, start: float=0., command=COMMAND) -> None:
+        self._process = subprocess.Popen(
+            [a.format(path=path, start=start) for a in command],
+            stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, bufsize=0)
+
+    def readinto(self, buffer) -> int:
+        return self._process.stdout.readinto(buffer)
+
+    def close(self) -> None:
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+
+
+class null_sink:
+    ''' discards what it gets, e.g. for tests '''
+    def __init__(self) -> None:
+        self.frames = 0
+
+    def write(self, data) -> None:
+        self.frames += len(data) // FRAME_SIZE
+
+    def close(self) -> None:
+        pass
+
+
+class wav_sink:
+    def __init__(self, path: str) -> None:
+        self._file = wave.open(path, 'wb')
+        self._file.setnchannels(CHANNELS)
+        self._file.setsampwidth(2)
+        self._file.setframerate(RATE)
+
+    def write(self, data) -> None:
+        self._file.writeframesraw(data)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class device_sink:
+    ''' plays on the default audio device, blocks while its buffer is full '''
+    def __init__(self, block_frames: int) -> None:
+        if sounddevice is None:
+            raise unavailable('playing on an audio device needs sounddevice')
+        self._stream = sounddevice.RawOutputStream(
+            samplerate=RATE, channels=CHANNELS, dtype='int16',
+            blocksize=block_frames)
+        self._stream.start()
+
+    def write(self, data) -> None:
+        self._stream.write(data)
+
+    def close(self) -> None:
+        self._stream.stop()
+        self._stream.close()
+
+
+def create_sink(name: str, block_frames: int):
+    ''' returns the sink called @name: 'device', 'null' or 'wav:<path>' '''
+    if name == 'device':
+        return device_sink(block_frames)
+    if name == 'null':
+        return null_sink()
+    if name.startswith('wav:'):
+        return wav_sink(name[4:])
+    raise error.invalid_value('unknown sink "%s"' % name)
+
+
+def _fade_in_curve(curve: str, t):
+    if curve == 'linear':
+        return t
+    if curve == 'equal_power':
+        return numpy.sin(t * (math.pi / 2))
+    if curve == 's_curve':
+        return t * t * (3 - 2 * t)
+    raise error.invalid_value('unknown crossfade curve "%s"' % curve)
+
+
+class pcm_mixer:
+    ''' Writes blocks of @block_frames frames to @sink. The last blocks of
+        a track stay in a ring buffer when play() returns, so the next
+        call can fade them out while the next track fades in over
+        @crossfade seconds - or with no crossfade append the next track
+        to the last block without a gap.
+    '''
+
+    CURVES = ('linear', 'equal_power', 's_curve')
+
+    def __init__(self, sink, block_frames: int=4096, crossfade: float=0.,
+                 curve: str='equal_power', progress_interval: float=1.) -> None:
+        if numpy is None:
+            raise unavailable('mixing needs numpy')
+        self._sink = sink
+        self._block = block_frames
+        # crossfades span whole blocks
+        self._fade_blocks = int(math.ceil(crossfade * RATE / block_frames))
+        _steps = max(self._fade_blocks, 1)
+        _t = (numpy.arange(_steps * block_frames, dtype=numpy.float32) + .5) / (
+            _steps * block_frames)
+        _fade_in = _fade_in_curve(curve, _t).astype(numpy.float32)
+        _fade_out = _fade_in[::-1].copy()
+        # one (frames, 1) view per block so the loop needn't slice
+        self._fade_in = list(_fade_in.reshape(_steps, block_frames, 1))
+        self._fade_out = list(_fade_out.reshape(_steps, block_frames, 1))
+
+        # the next blocks of the current track, oldest at _head - one more
+        # than the crossfade spans as the end shows only when a read fails
+        _slots = self._fade_blocks + 1
+        self._ring = numpy.zeros((_slots, block_frames, CHANNELS), dtype=numpy.int16)
+        self._ring_slots = list(self._ring)
+        self._ring_bytes = [memoryview(s).cast('B') for s in self._ring_slots]
+        self._head = 0
+        self._count = 0
+        # frames in the newest block of the ring
+        self._last_frames = 0
+
+        self._incoming = numpy.zeros((block_frames, CHANNELS), dtype=numpy.int16)
+        self._incoming_bytes = memoryview(self._incoming).cast('B')
+        self._mix = numpy.zeros((block_frames, CHANNELS), dtype=numpy.float32)
+        self._tmp = numpy.zeros((block_frames, CHANNELS), dtype=numpy.float32)
+        self._out = numpy.zeros((block_frames, CHANNELS), dtype=numpy.int16)
+        self._out_bytes = memoryview(self._out).cast('B')
+
+        self._volume = 1.
+        self._report_blocks = max(1, int(progress_interval * RATE / block_frames))
+
+    def play(self, open_source, control, handler, length: float=0.) -> None:
+        ''' plays the source returned by @open_source(start seconds) until
+            its end is in the ring buffer or it gets skipped. Takes
+            commands from @control and reports the position together with
+            @length, the duration of the track (0 if unknown). '''
+        self._volume = handler.handler_get_volume()
+        _start = 0.
+        _source = open_source(_start)
+        try:
+            _frames = self._begin(_source)
+            _eof = self._fill(_source)
+            _blocks = 0
+            while not _eof:
+                if control.wait(0.):
+                    _skip, _seek = self._apply(control, handler)
+                    if _skip:
+                        break
+                    if _seek is not None:
+                        _source.close()
+                        _start, _source = _seek, open_source(_seek)
+                        self._count, _frames = 0, 0
+                        _eof = self._fill(_source)
+                        continue
+                _slot = self._head
+                self._write(self._ring_slots[_slot])
+                self._head = (_slot + 1) % len(self._ring_slots)
+                self._count -= 1
+                _frames += self._block
+                _eof = self._read_block(_source, (self._head + self._count) % len(self._ring_slots))
+                _blocks += 1
+                if _blocks % self._report_blocks == 0:
+                    handler.handler_update_pos(_start + _frames / RATE, length)
+            # keep no more blocks than the next track fades in over
+            while self._count > max(self._fade_blocks, 1):
+                self._write(self._ring_slots[self._head])
+                self._head = (self._head + 1) % len(self._ring_slots)
+                self._count -= 1
+        finally:
+            _source.close()
+
+    def finish(self) -> None:
+        ''' plays (and fades out) what's left of the last track '''
+        for i in range(self._count):
+            _slot = self._ring_slots[(self._head + i) % len(self._ring_slots)]
+            if self._fade_blocks:
+                numpy.multiply(_slot, self._fade_out[self._fade_blocks - self._count + i],
+                               out=self._mix, casting='unsafe')
+                self._write_mix()
+            else:
+                self._write(_slot)
+        self._count = 0
+
+    def _begin(self, source) -> int:
+        ''' mixes the new @source into the end of the last track, returns
+            the number of its frames played '''
+        if not self._count:
+            return 0
+        if not self._fade_blocks:
+            # gapless: complete the last block of the track before
+            _newest = (self._head + self._count - 1) % len(self._ring_slots)
+            _frames = self._read(source, self._ring_bytes[_newest],
+                                 self._last_frames * FRAME_SIZE) // FRAME_SIZE
+            self._last_frames += _frames
+            self._write(self._ring_slots[_newest])
+            self._count = 0
+            return _frames
+        _frames = 0
+        for i in range(self._count):
+            _slot = self._ring_slots[(self._head + i) % len(self._ring_slots)]
+            _step = self._fade_blocks - self._count + i
+            _frames += self._read(source, self._incoming_bytes, 0) // FRAME_SIZE
+            numpy.multiply(_slot, self._fade_out[_step], out=self._mix, casting='unsafe')
+            numpy.multiply(self._incoming, self._fade_in[_step], out=self._tmp,
+                           casting='unsafe')
+            numpy.add(self._mix, self._tmp, out=self._mix)
+            self._write_mix()
+        self._count = 0
+        return _frames
+
+    def _fill(self, source) -> bool:
+        ''' reads blocks until the ring is full, returns True at the end
+            of @source '''
+        self._head = 0
+        while self._count < len(self._ring_slots):
+            if self._read_block(source, self._count):
+                return True
+        return False
+
+    def _read_block(self, source, slot: int) -> bool:
+        ''' reads the next block into @slot, returns True at the end of
+            @source '''
+        _frames = self._read(source, self._ring_bytes[slot], 0) // FRAME_SIZE
+        if _frames:
+            self._count += 1
+            self._last_frames = _frames
+        return _frames < self._block
+
+    def _read(self, source, buffer, offset: int) -> int:
+        ''' fills @buffer from @offset on, with silence after the end of
+            @source, returns the number of bytes read '''
+        _size = len(buffer) - offset
+        # a whole block mostly arrives at once - then nothing gets sliced
+        _read = (source.readinto(buffer) or 0) if not offset else 0
+        if _read == _size:
+            return _read
+        _view = buffer[offset:]
+        while _read < _size:
+            _count = source.readinto(_view[_read:])
+            if not _count:
+                _view[_read:] = bytes(_size - _read)
+                break
+            _read += _count
+        return _read
+
+    def _apply(self, control, handler) -> tuple:
+        ''' applies all pending commands, returns whether to skip and the
+            position to seek to or None '''
+        _skip, _seek = False, None
+        for _command in control.take():
+            if _command == 'skip':
+                _skip = True
+            elif _command == 'pause':
+                handler.handler_set_pause(not handler.handler_get_pause())
+            elif _command == 'volume':
+                self._volume = handler.handler_get_volume()
+            elif _command == 'seek':
+                _seek = float(handler.handler_get_seek_position())
+        while handler.handler_get_pause() and not _skip:
+            # nothing gets written - wait for the next command
+            control.wait()
+            _skip, _next_seek = self._apply(control, handler)
+            _seek = _seek if _next_seek is None else _next_seek
+        return _skip, _seek
+
+    def _write(self, block) -> None:
+        numpy.multiply(block, self._volume, out=self._mix, casting='unsafe')
+        self._write_mix(volume=False)
+
+    def _write_mix(self, volume: bool=True) -> None:
+        if volume and self._volume != 1.:
+            numpy.multiply(self._mix, self._volume, out=self._mix)
+        numpy.clip(self._mix, -32768., 32767., out=self._mix)
+        numpy.copyto(self._out, self._mix, casting='unsafe')
+        self._sink.write(self._out_bytes)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+log = logging.getLogger('mplayer_output')
+
+
+class mplayer_output:
+    ''' Splits what mplayer writes to stdout into lines as it arrives -
+        lines may span reads. Status lines ("A:  12.3 (12.3) of 245.0
+        (04:05.0)  0.5%") come several times a second and are terminated
+        by '\\r' only. Only the latest of them gets parsed, and not more
+        often than every @interval seconds, without decoding it first.
+    '''
+
+    def __init__(self, interval: float=1.) -> None:
+        self._interval = interval
+        self._buffer = bytearray()
+        self._last_update = float('-inf')
+        self._progress = None
+
+    def reset(self) -> None:
+        ''' a new track starts - report its progress right away '''
+        self._last_update = float('-inf')
+        self._progress = None
+
+    def feed(self, chunk: bytes) -> list:
+        ''' returns all lines completed by @chunk except status lines '''
+        _buffer = self._buffer
+        if not _buffer and chunk.endswith(b'\r') and b'\n' not in chunk:
+            # the usual case - nothing but complete status lines
+            if time.monotonic() - self._last_update >= self._interval:
+                self._parse_status(chunk[chunk.rfind(b'\r', 0, -1) + 1:-1])
+            return []
+        _buffer += chunk
+        _lines = []
+        _status = None
+        # other lines end with '\n' - they're rare so take the slow path
+        _lf = _buffer.rfind(b'\n')
+        if _lf >= 0:
+            for _line in bytes(_buffer[:_lf]).replace(b'\r', b'\n').split(b'\n'):
+                if _line.startswith(b'A:'):
+                    _status = _line
+                elif _line:
+                    _lines.append(_line.decode(errors='replace'))
+        # what's left are status lines and maybe the beginning of a line
+        _cr = _buffer.rfind(b'\r', _lf + 1)
+        if _cr >= 0:
+            _begin = _buffer.rfind(b'\r', _lf + 1, _cr) + 1 or _lf + 1
+            if _buffer.startswith(b'A:', _begin):
+                _status = _buffer[_begin:_cr]
+        if _status is not None:
+            self._parse_status(_status)
+        del _buffer[:max(_lf, _cr) + 1]
+        return _lines
+
+    def progress(self):
+        ''' returns (position, length) in seconds if it's time to report
+            them or None '''
+        _progress, self._progress = self._progress, None
+        return _progress
+
+    def _parse_status(self, line) -> None:
+        _now = time.monotonic()
+        if _now - self._last_update < self._interval:
+            return
+        # "A:" position "(" position ")" "of" length ...
+        _fields = line[2:].split(None, 4)
+        try:
+            self._progress = (float(_fields[0]), float(_fields[3]))
+        except (IndexError, ValueError):
+            log.debug('unexpected status line %s', bytes(line))
+            return
+        self._last_update = _now
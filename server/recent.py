@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import collections
+import logging
+log = logging.getLogger('recent')
+
+
+class recent_window:
+    ''' The keys added during the last @seconds and/or the last @size keys
+        added (0 means no limit). A ring buffer keeps them in order so
+        they can expire, a dict counts their occurrences so lookups are
+        O(1).
+    '''
+
+    # bounds the memory of windows limited by time only
+    MAX_SIZE = 100000
+
+    def __init__(self, size: int=0, seconds: float=0.) -> None:
+        self._size = min(size, recent_window.MAX_SIZE) or recent_window.MAX_SIZE
+        self._seconds = seconds
+        # (time, key), oldest first
+        self._entries = collections.deque()
+        self._counts = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        if self._seconds:
+            self._expire(time.time() - self._seconds)
+        return key in self._counts
+
+    def add(self, key, time_stamp: float=None) -> None:
+        self._entries.append((time.time() if time_stamp is None else time_stamp,
+                              key))
+        self._counts[key] = self._counts.get(key, 0) + 1
+        if len(self._entries) > self._size:
+            self._drop_oldest()
+
+    def entries(self) -> list:
+        if self._seconds:
+            self._expire(time.time() - self._seconds)
+        return list(self._entries)
+
+    def _expire(self, oldest: float) -> None:
+        while self._entries and self._entries[0][0] < oldest:
+            self._drop_oldest()
+
+    def _drop_oldest(self) -> None:
+        _, _key = self._entries.popleft()
+        _count = self._counts[_key] - 1
+        if _count:
+            self._counts[_key] = _count
+        else:
+            del self._counts[_key]
+
+
+class recently_played:
+    ''' No-repeat windows for tracks, folders and artists as configured by
+        no_repeat_<kind>s (a number of plays) and
+        no_repeat_<kind>_seconds. They get stored in @path so they survive
+        restarts. Keys are paths and names rather than indices which
+        change whenever the library gets crawled again.
+    '''
+
+    KINDS = ('track', 'folder', 'artist')
+
+    # kind -> (plays, seconds) unless configured otherwise
+    DEFAULTS = {'track': (0, 3600.)}
+
+    # increase whenever the layout of the state file changes
+    VERSION = 1
+
+    def __init__(self, config: dict, path: str) -> None:
+        self._path = path
+        # kind -> recent_window, only for configured kinds
+        self._windows = {}
+        for _kind in recently_played.KINDS:
+            _size, _seconds = recently_played.DEFAULTS.get(_kind, (0, 0.))
+            _size = config.get('no_repeat_%ss' % _kind, _size)
+            _seconds = config.get('no_repeat_%s_seconds' % _kind, _seconds)
+            if _size or _seconds:
+                self._windows[_kind] = recent_window(_size, _seconds)
+        self._load()
+
+    def __bool__(self):
+        return bool(self._windows)
+
+    def excludes(self, track: str, folder: str, artist: str=None,
+                 ahead=()) -> bool:
+        ''' tells whether any of @track, @folder or @artist has been played
+            too recently or will be played before, as one of the (track,
+            folder, artist) keys @ahead '''
+        _windows = self._windows
+        if (('track' in _windows and track in _windows['track']) or
+                ('folder' in _windows and folder in _windows['folder']) or
+                (artist is not None and 'artist' in _windows and
+                 artist in _windows['artist'])):
+            return True
+        return any(_key is not None and _key == _other and _kind in _windows
+                   for _keys in ahead
+                   for _kind, _key, _other in zip(recently_played.KINDS,
+                                                  (track, folder, artist), _keys))
+
+    def add(self, track: str, folder: str, artist: str=None) -> None:
+        _now = time.time()
+        for _kind, _key in (('track', track), ('folder', folder), ('artist', artist)):
+            if _key is not None and _kind in self._windows:
+                self._windows[_kind].add(_key, _now)
+
+    def store(self) -> None:
+        if not self._windows:
+            return
+        _tmp_path = self._path + '.tmp'
+        with open(_tmp_path, 'w') as _f:
+            json.dump({'version': recently_played.VERSION,
+                       'windows': {k: w.entries() for k, w in self._windows.items()}},
+                      _f, separators=(',', ':'))
+        os.replace(_tmp_path, self._path)
+
+    def _load(self) -> None:
+        if not self._windows:
+            return
+        try:
+            with open(self._path) as _f:
+                _state = json.load(_f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            log.warning("ignore unreadable play history '%s': %s", self._path, ex)
+            return
+        if _state.get('version') != recently_played.VERSION:
+            return
+        for _kind, _entries in _state['windows'].items():
+            if _kind in self._windows:
+                for _time, _key in _entries:
+                    self._windows[_kind].add(_key, _time)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+import itertools
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class weighted_sampler:
+    ''' Picks an index with a probability proportional to its weight in
+        O(log n) without retries. Weights are kept in a Fenwick tree
+        (binary indexed tree) so they can be changed in O(log n), too.
+    '''
+
+    # tries before giving up on sums drifted off by rounding errors
+    ATTEMPTS = 3
+
+    def __init__(self, weights=()):
+        self._weights = array('d')
+        # 1-based Fenwick tree, _tree[0] is unused
+        self._tree = array('d', (0.,))
+        self._top = 0
+        # number of weights above zero - the total may be off by rounding
+        self._positive = 0
+        self.assign(weights)
+
+    def __len__(self):
+        return len(self._weights)
+
+    def total(self) -> float:
+        return self._prefix_sum(len(self._weights))
+
+    def get(self, index: int) -> float:
+        return self._weights[index]
+
+    def append(self, weight: float) -> int:
+        assert weight >= 0.
+        _index = len(self._weights)
+        _node = _index + 1
+        # a new node covers (_node - lowbit(_node), _node]
+        _value = weight + (self._prefix_sum(_index) -
+                           self._prefix_sum(_node - (_node & -_node)))
+        self._weights.append(weight)
+        self._tree.append(_value)
+        self._positive += weight > 0.
+        while self._top * 2 <= _node:
+            self._top = self._top * 2 if self._top else 1
+        return _index
+
+    def extend(self, weights) -> None:
+        ''' appends all @weights in O(k + log² n) instead of computing two
+            prefix sums for each of them like append() does '''
+        _new = array('d', weights)
+        if not _new:
+            return
+        assert min(_new) >= 0.
+        _first = len(self._weights)
+        # _sums[i] is the sum of the first _first + i weights
+        _sums = list(itertools.accumulate(_new, initial=self.total()))
+        self._weights.extend(_new)
+        # sums of the old weights some of the new nodes start after
+        _old_sums = {}
+        for _node in range(_first + 1, len(self._weights) + 1):
+            _start = _node - (_node & -_node)
+            if _start >= _first:
+                _before = _sums[_start - _first]
+            else:
+                _before = _old_sums.get(_start)
+                if _before is None:
+                    _before = _old_sums[_start] = self._prefix_sum(_start)
+            self._tree.append(_sums[_node - _first] - _before)
+        self._positive += sum(1 for w in _new if w > 0.)
+        while self._top * 2 <= len(self._weights):
+            self._top = self._top * 2 if self._top else 1
+
+    def set(self, index: int, weight: float) -> None:
+        assert weight >= 0.
+        _delta = weight - self._weights[index]
+        if _delta == 0.:
+            return
+        self._positive += (weight > 0.) - (self._weights[index] > 0.)
+        self._weights[index] = weight
+        _node = index + 1
+        while _node < len(self._tree):
+            self._tree[_node] += _delta
+            _node += _node & -_node
+
+    def assign(self, weights) -> None:
+        ''' replaces all weights in O(n), vectorized for numpy arrays '''
+        if numpy is not None and isinstance(weights, numpy.ndarray):
+            self._assign_array(weights)
+        else:
+            self._weights = array('d', weights)
+            self._tree = array('d', (0.,))
+            self._tree.extend(self._weights)
+            for _node in range(1, len(self._tree)):
+                _parent = _node + (_node & -_node)
+                if _parent < len(self._tree):
+                    self._tree[_parent] += self._tree[_node]
+            self._positive = sum(1 for w in self._weights if w > 0.)
+        self._top = 1
+        while self._top * 2 < len(self._tree):
+            self._top *= 2
+        if len(self._weights) == 0:
+            self._top = 0
+
+    def _assign_array(self, weights) -> None:
+        _weights = numpy.ascontiguousarray(weights, dtype=numpy.float64)
+        assert _weights.ndim == 1 and not (_weights < 0.).any()
+        # node i of a Fenwick tree holds the sum of (i - lowbit(i), i]
+        _sums = numpy.concatenate(((0.,), numpy.cumsum(_weights)))
+        _nodes = numpy.arange(len(_sums))
+        _tree = _sums - _sums[_nodes - (_nodes & -_nodes)]
+        self._weights = array('d')
+        self._weights.frombytes(_weights.tobytes())
+        self._tree = array('d')
+        self._tree.frombytes(_tree.tobytes())
+        self._positive = int(numpy.count_nonzero(_weights > 0.))
+
+    def sample(self, rnd=random):
+        ''' returns a random index or None if all weights are zero '''
+        if not self._positive:
+            return None
+        for _ in range(weighted_sampler.ATTEMPTS):
+            _total = self.total()
+            if _total > 0.:
+                _index = self._find(rnd.random() * _total)
+                if self._weights[_index] > 0.:
+                    return _index
+            # rounding errors of accumulated updates led to a zero weight
+            self.assign(self._weights)
+        return None
+
+    def _find(self, rest: float) -> int:
+        ''' returns the index whose weight covers @rest '''
+        _node = 0
+        _step = self._top
+        while _step:
+            _next = _node + _step
+            if _next < len(self._tree) and self._tree[_next] <= rest:
+                _node = _next
+                rest -= self._tree[_next]
+            _step //= 2
+        return min(_node, len(self._weights) - 1)
+
+    def _prefix_sum(self, count: int) -> float:
+        ''' sum of the first @count weights '''
+        _result = 0.
+        _node = count
+        while _node:
+            _result += self._tree[_node]
+            _node -= _node & -_node
+        return _result
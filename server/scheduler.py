@@ -3,29 +3,78 @@
 
 import os
 import time
+import json
+import heapq
 import random
 import logging
+import queue
+import threading
+import itertools
+import collections
+import concurrent.futures
+from array import array
 log = logging.getLogger('scheduler')
 
 import error
+from search_index import search_index, fold
+from ban_matcher import ban_matcher
+from weighting import upvote_weights, numpy
+from wishlist import wishlist
+from journal import journal
+from smartlist import smartlist
+from bitset import bitset
+from metadata import metadata_store
+from loudness import loudness_store
+from affinity import affinity_graph
+from lookahead import lookahead
+from recent import recently_played
+from history import play_history
+import mixer
 
 
 class scheduler:
 
+    # increase whenever the layout of the library index file changes
+    LIBRARY_INDEX_VERSION = 1
+
+    SCHEDULING_MODES = ('uniform', 'upvotes', 'affinity')
+
+    # upvote weights fade over time so they get refreshed once in a while
+    WEIGHTS_MAX_AGE = 3600.
+
+    # seconds between two progress reports while crawling
+    CRAWL_REPORT_INTERVAL = 2.
+
+    # seconds crawling adds directories at a time before the smartlists
+    # take the new tracks and others get the lock
+    CRAWL_BATCH_TIME = .1
+
+    # rewrite a smartlist journal when it has that many needless lines
+    JOURNAL_COMPACT_THRESHOLD = 1000
+
+    # tracks sampled before one played recently gets accepted anyway
+    NO_REPEAT_ATTEMPTS = 10
+
+    # searching scores all tracks at once rather than following the chains
+    # of the matching names when they outnumber that fraction of all tracks
+    SEARCH_SCAN_FRACTION = 0.005
+
     class rule:
         def __init__(self, *, line:str=None,
                      time_stamp:float=time.time(), listener:str=None,
                      tag_name:str=None, tag_string:str=None,
                      track_pos:float=None) -> None:
             if line is not None:
-                _items = tuple((e.strip() for e in line.split(',')))
-                if not len(_items) == 5:
-                    log.warning("ignore misspelled rule: '%s'", line)
+                # the subject is the only field which may contain commas
+                _items = line.split(',', 3)
+                if len(_items) < 4 or ',' not in _items[3]:
+                    raise ValueError('expected 5 fields')
+                _items = [e.strip() for e in _items[:3] + _items[3].rsplit(',', 1)]
                 self.time = float(_items[0])
                 self.listener = _items[1]
                 self.tag_name = _items[2]
-                self.tag_string = _items[3].lower() if len(_items) > 3 else None
-                self.track_pos = float(_items[4]) if len(_items) > 4 else None
+                self.tag_string = _items[3].lower()
+                self.track_pos = float(_items[4])
             elif time_stamp is not None and tag_name is not None:
                 assert isinstance(time_stamp, float)
                 assert isinstance(listener, str)
@@ -66,7 +115,7 @@ class scheduler:
             return '%.3f, %s, %s, %s, %.2f' % (
                 self.time, self.listener,
                 self.tag_name, self.tag_string,
-                self.track_pos)
+                self.track_pos or 0.)
 
         def __str__(self):
             return 'rule(type="%s", what="%s")' % (self.tag_name, self.tag_string)
@@ -88,43 +137,153 @@ class scheduler:
 
     def __init__(self, *, config):
         assert 'playlist_folder' in config
-        self.count = 0
         self._sources = []
-        self._folders = {}
-        self._wishlist = []
+        # guards the library against concurrent crawling and scheduling
+        self._lock = threading.RLock()
+        # notified whenever there might be something new to play
+        self._available = threading.Condition(self._lock)
+        self._available_changes = 0
+        self._wishlist = wishlist()
         self._acquirer = None
         self._music_pattern = ()
         self._config = config
         if 'music_file_pattern' in config:
             self._music_pattern = config['music_file_pattern']
         self._smartlists = set()
-        self._active_list = None
-        self._rules = []
+        # the active smartlist
+        self._list = None
+        # name -> loaded smartlist, least recently used first
+        self._loaded = collections.OrderedDict()
+        # inactive smartlists get unloaded beyond that many bytes
+        self._memory_limit = config.get('smartlist_memory_limit', 256) * 2 ** 20
+        self._scheduling_mode = 'uniform'
         self._present_listeners = set()
-        self._dirty = False
+        # listener -> time they've been heard of last
+        self._last_seen = {}
+        # set when weights of inactive smartlists have become stale
+        self._stale_event = threading.Event()
+        self._stop_event = threading.Event()
+        # set when crawls should give up, see stop_crawling()
+        self._crawl_stop = threading.Event()
+        # interned strings: name index -> name and name -> name index
+        self._names = []
+        self._name_indices = {}
+        self._search_index = search_index()
+        # folder index -> name index of root path / relative path
+        self._folder_path = array('l')
+        self._folder_relpath = array('l')
+        # tracks of folder i are [_folder_offsets[i], _folder_offsets[i + 1])
+        # plus those added after it had been crawled first
+        self._folder_offsets = array('l', (0,))
+        # folder index -> tracks added later / number of tracks removed
+        self._folder_added = {}
+        self._folder_removed = {}
+        # (root path, relative path) name indices -> folder index
+        self._folder_lookup = {}
+        # track index -> folder index / file name index
+        self._track_folder = array('l')
+        self._track_name = array('l')
+        # tracks of removed files keep their index with a name index of -1
+        self._removed_tracks = 0
+        self._removed = bitset()
+        # name index -> first folder / track using it as relative path /
+        # file name, further ones are chained via _folder_next / _track_next
+        self._name_folder = array('l')
+        self._name_track = array('l')
+        self._folder_next = array('l')
+        self._track_next = array('l')
+        self._dir_cache = self._load_library_index()
+        self._crawled_roots = set()
+        self._index_dirty = False
+        self._metadata = self._create_metadata_store()
+        self._loudness = self._create_loudness_store()
+        # built on demand for the 'affinity' scheduling mode and rebuilt
+        # in the background when folders come or go
+        self._affinity = None
+        self._affinity_stale = False
+        # the track scheduled last
+        self._last_track = None
+        self._recent = recently_played(config, self._state_path('recently_played'))
+        self._history = play_history(self._state_path('play_history'))
+        # tracks picked ahead of time, created below
+        self._lookahead = None
+        self.set_scheduling_mode(config.get('scheduling_mode', 'uniform'))
         self._init_lists()
-        self._name_components = {}
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_fn, name='smartlists', daemon=True)
+        self._refresh_thread.start()
+        if config.get('lookahead', 3) > 0:
+            self._lookahead = lookahead(self._pick_ahead, self._next_wish_path,
+                                        config.get('lookahead', 3))
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
-        self._store_list()
+        self.close()
+
+    def close(self):
+        ''' stops all background work and stores what has to survive a
+            restart '''
+        if self._lookahead is not None:
+            self._lookahead.close()
+        self._stop_event.set()
+        self._stale_event.set()
+        self._refresh_thread.join()
+        for l in self._loaded.values():
+            l.journal.close()
+        if self._metadata is not None:
+            self._metadata.close()
+        if self._loudness is not None:
+            self._loudness.close()
+        self._recent.store()
+        self._history.close()
+        self.store_library_index()
 
     def get_smartlists(self):
         return self._smartlists
 
     def get_active_smartlist(self):
-        return self._active_list
+        return self._list.name if self._list is not None else None
+
+    def get_scheduling_mode(self) -> str:
+        return self._scheduling_mode
+
+    def set_scheduling_mode(self, mode: str) -> None:
+        if mode not in scheduler.SCHEDULING_MODES:
+            raise error.invalid_value('unknown scheduling mode "%s"' % mode)
+        if mode == 'upvotes' and numpy is None:
+            log.warning('upvote weighting needs numpy - schedule uniformly')
+            mode = 'uniform'
+        with self._lock:
+            self._scheduling_mode = mode
+            for l in self._loaded.values():
+                l.upvote_weights = (
+                    upvote_weights(self._config) if mode == 'upvotes' else None)
+            self._refresh_weights(collect_upvotes=True)
+            if self._lookahead is not None:
+                self._lookahead.clear()
 
     def activate_smartlist(self, list_name: str):
+        ''' switches to @list_name - instantly if it's loaded already '''
         if list_name not in self._smartlists:
             raise error.invalid_value('')
-        self._store_list()
-        self._rules = self._load_rules(list_name)
-        self._active_list = list_name
-        log.info("loaded smartlist '%s' with %d rules",
-                 list_name, len(self._rules))
+        with self._lock:
+            _list = self._loaded.get(list_name)
+        if _list is None:
+            _list = self._load_smartlist(list_name)
+        with self._lock:
+            if _list.stale:
+                self._refresh_smartlist(_list)
+            self._list = _list
+            # might have been unloaded in the meantime
+            self._loaded[list_name] = _list
+            self._loaded.move_to_end(list_name)
+            self._evict_smartlists()
+            if self._lookahead is not None:
+                self._lookahead.clear()
+            self._notify_available()
+        log.info("activated %s", _list)
 
     def add_tag(self, listener: str, track: tuple, pos: int, details: dict):
         if 'tag_name' not in details:
@@ -140,49 +299,148 @@ class scheduler:
         else:
             raise error.bad_request('cannot handle tag name "%s"' % _tag_name)
 
-        self._dirty = True
-        self._rules.append(scheduler.rule(time_stamp=time.time(), listener=listener,
-                                          tag_name=_tag_name, tag_string=_subject,
-                                          track_pos=pos))
+        _rule = scheduler.rule(time_stamp=time.time(), listener=listener,
+                               tag_name=_tag_name, tag_string=_subject,
+                               track_pos=pos)
+        with self._lock:
+            _list = self._list
+            _list.journal.append(_rule.to_line())
+            _list.rules.append(_rule)
+            if _rule.tag_name == 'ban':
+                if (_rule.listener, _rule.tag_string) in _list.ban_subjects:
+                    log.info('ignore repeated %s', _rule)
+                    _list.redundant_lines += 1
+                else:
+                    _list.ban_subjects.add((_rule.listener, _rule.tag_string))
+                    _list.ban_matcher.add_rule(_rule)
+                    self._apply_ban_rule(_rule)
+            elif _list.upvote_weights is not None:
+                for _track in self._upvoted_tracks(_rule):
+                    _list.upvote_weights.add_vote(_track, _rule.time, _rule.listener)
+                self._update_weights(_list)
+            if _list.redundant_lines >= scheduler.JOURNAL_COMPACT_THRESHOLD:
+                self._compact_journal()
+
+    def get_metadata(self, track: tuple) -> dict:
+        ''' returns artist, album and title of @track as far as its tags
+            tell and they have been read already, None otherwise '''
+        if self._metadata is None:
+            return None
+        return self._metadata.get(os.path.join(*track))
 
-        # todo: not needed in production mode but might be useful though
-        self._store_list()
+    def get_gain(self, track: tuple) -> float:
+        ''' returns the factor to play @track with so it's about as loud
+            as the others, 1 as long as it hasn't been measured '''
+        if self._loudness is None:
+            return 1.
+        return self._loudness.gain(os.path.join(*track),
+                                   self._config.get('loudness_target', -18.))
 
     def present_listeners(self):
         return self._present_listeners
 
     def add_present_listener(self, name):
-        self._present_listeners.add(name)
+        ''' from now on bans of @name count and so do their upvotes in
+            full (see _ban_applies()) - until they get removed or haven't
+            been heard of for a while (see expire_present_listeners()) '''
+        with self._lock:
+            self._last_seen[name] = time.time()
+            if name not in self._present_listeners:
+                self._set_present_listeners(self._present_listeners | {name})
 
     def remove_present_listener(self, name):
-        self._present_listeners.remove(name)
+        with self._lock:
+            self._last_seen.pop(name, None)
+            if name in self._present_listeners:
+                self._set_present_listeners(self._present_listeners - {name})
 
-    def search_filenames(self, query: str) -> list:
-        _query = query.lower().split()
-        _result = []
-        for _path, _files in self._folders.items():
-            _score_plus = 0
-            _p2 = self._get_name_component(_path[1])
-            for q in _query:
-                if q in _p2.lower():
-                    _score_plus += 1
-            for f in _files:
-                _f = self._get_name_component(f.name_index)
-                _score = 0
-                for q in _query:
-                    if q in _f.lower():
-                        _score += 1
-                if _score + _score_plus > 0:
-                    _result.append(
-                        ("%d/%d/%d" % (_path[0], _path[1], f.name_index),
-                         os.path.join(_p2, _f),
-                         _score + _score_plus))
-        _result.sort(key=lambda tup: tup[2], reverse=True)
-        return _result[:20]
-
-    def schedule_next_item(self, item: str) -> None:
-        _components = (int(e) for e in item.split('/'))
-        self._wishlist.append(self._get_name_components(_components))
+    def expire_present_listeners(self, timeout: float) -> None:
+        ''' removes the listeners not heard of for @timeout seconds '''
+        _deadline = time.time() - timeout
+        with self._lock:
+            _expired = {l for l, t in self._last_seen.items() if t < _deadline}
+            if not _expired:
+                return
+            for l in _expired:
+                log.info("listener '%s' hasn't been heard of for %.0fs",
+                         l, time.time() - self._last_seen.pop(l))
+            self._set_present_listeners(self._present_listeners - _expired)
+
+    def search_filenames(self, query: str, count: int=20) -> list:
+        ''' returns (item, path, score) of the @count tracks matching the
+            words of @query best - ignoring case, accents, punctuation and
+            minor typos. Each word adds up to 1 for the folder and up to 1
+            for the file name containing it. '''
+        with self._lock:
+            # (name indices, score) pairs per word
+            _groups = [g for g in (self._search_index.search_groups(q)
+                                   for q in query.split()) if g]
+            if not _groups:
+                return []
+            return [(self._get_item_id(_track),
+                     os.path.join(*self._get_track(_track)[1:]),
+                     _score)
+                    for _score, _track in (
+                        self._best_tracks_vectorized(_groups, count)
+                        if numpy is not None else
+                        self._best_tracks([search_index.similarities(g)
+                                           for g in _groups], count))]
+
+    def schedule_next_item(self, item: str, listener: str=None) -> int:
+        ''' puts @item (as returned by search_filenames()) on the wishlist
+            or votes for it if it's there already, returns its votes '''
+        with self._lock:
+            _votes = self._wishlist.add(self._get_track_index(item), listener)
+            self._notify_available()
+            return _votes
+
+    def vote_wish(self, item: str, listener: str) -> int:
+        with self._lock:
+            try:
+                return self._wishlist.vote(self._get_track_index(item), listener)
+            except wishlist.unknown_wish:
+                raise error.invalid_value('"%s" has not been wished' % item)
+
+    def list_wishes(self, count: int=None) -> list:
+        ''' returns (item, path, votes) for the wishes to be played next '''
+        with self._lock:
+            return [(self._get_item_id(_track),
+                     os.path.join(*self._get_track(_track)[1:]),
+                     _votes)
+                    for _track, _votes, _ in self._wishlist.items(count)
+                    if self._track_name[_track] >= 0]
+
+    def list_upcoming(self, count: int=None) -> list:
+        ''' returns (item, path) for the tracks to be played next - the
+            wishes followed by the tracks picked ahead of time '''
+        _picked = self._lookahead.tracks() if self._lookahead is not None else []
+        with self._lock:
+            _tracks = [_track for _track, _, _ in self._wishlist.items(count)
+                       if self._track_name[_track] >= 0]
+            _tracks.extend(t for t in _picked if self._is_eligible(t))
+            return [(self._get_item_id(_track),
+                     os.path.join(*self._get_track(_track)[1:]))
+                    for _track in _tracks[:count]]
+
+    def record_played(self, track: tuple, started: float, position: float,
+                      length: float, skipped: bool) -> None:
+        ''' adds @track to the play history together with the listeners
+            present right now '''
+        with self._lock:
+            _listeners = list(self._present_listeners)
+        self._history.record(os.path.join(*track), os.path.join(*track[:2]),
+                             _listeners, started, position, length, skipped)
+
+    def top_played(self, count: int=50, days: float=7.) -> list:
+        ''' returns (path, plays) of the tracks played most often during the
+            last @days '''
+        return self._history.top_played(count, time.time() - days * 86400.)
+
+    def skip_rates(self, count: int=50, days: float=None, min_plays: int=3) -> list:
+        ''' returns (folder, plays, skip rate) of the folders skipped most
+            often relative to their plays during the last @days (or ever) '''
+        return self._history.skip_rates(
+            count, 0. if days is None else time.time() - days * 86400., min_plays)
 
     def _init_lists(self):
         _smartlists = set(('unspecified',
@@ -196,152 +454,1063 @@ class scheduler:
             pass
 
         for f in os.listdir(_path):
-            _smartlists.add(f)
+            if not f.endswith('.tmp'):
+                _smartlists.add(f)
 
         self._smartlists = _smartlists
+        # the active one gets loaded last so it's the least likely to be
+        # unloaded when they don't fit into memory together
+        for _name in sorted(_smartlists - {'unspecified'}):
+            self._load_smartlist(_name)
         self.activate_smartlist('unspecified')
 
-    def get_next(self) -> tuple:
-        while len(self._wishlist) > 0:
-            _item = self._wishlist.pop(0)
-            if os.path.exists(os.path.join(*_item)):
+    def get_next(self, timeout: float=0.) -> tuple:
+        ''' returns the next track to play. If there is none it waits up
+            to @timeout seconds (None means forever) for tracks to get
+            crawled, wished or unbanned and returns None if none came '''
+        _deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                _changes = self._available_changes
+            _item = self._pick_next()
+            if _item is not None:
+                return _item
+            with self._lock:
+                if not self._available.wait_for(
+                        lambda: self._available_changes != _changes,
+                        None if _deadline is None else _deadline - time.monotonic()):
+                    return None
+
+    def _pick_next(self) -> tuple:
+        while True:
+            with self._lock:
+                _track = self._wishlist.pop()
+                if _track is None:
+                    break
+                _item = (self._get_track(_track)
+                         if self._track_name[_track] >= 0 else None)
+            if _item is not None and os.path.exists(os.path.join(*_item)):
                 log.info("scheduling wishlist-item %s", _item)
+                with self._lock:
+                    self._last_track = _track
+                    self._remember_played(_track)
+                    if (self._lookahead is not None and
+                            self._scheduling_mode == 'affinity'):
+                        # the walk has to go on from the wish
+                        self._lookahead.clear()
                 return _item
+            elif _item is None:
+                log.warning('removing wish for a removed file')
             else:
-                log.warn("removing non-existing item '%s' from wishlist", _item)
+                log.warning("removing wish for the missing file '%s'",
+                            os.path.join(*_item[1:]))
 
-        if len(self._folders) == 0:
-            time.sleep(1)
-            return None  # slow down endless loops
+        if self._lookahead is not None:
+            with self._lock:
+                _track = self._lookahead.pop(self._is_eligible)
+                _item = self._get_track(_track) if _track is not None else None
+                if _item is not None:
+                    self._remember_played(_track)
+            if _item is not None:
+                log.info('accept item picked ahead: %s', _item)
+                return _item
 
-        def passes(folder, filename):
-            for e in self._rules:
-                if e.tag_name == 'ban' and e.matches(folder, filename):
-                    log.info('skip banned item %s', (folder, filename))
-                    return False
-            log.info('accept item: %s', (folder, filename))
-            return True
+        with self._lock:
+            _list = self._list
+            _track_count = len(self._track_name) - self._removed_tracks
+            if _track_count > 0:
+                _track = self._sample(_list)
+                _item = self._get_track(_track) if _track is not None else None
+                if _item is not None:
+                    self._remember_played(_track)
 
-        while True:
-            _location = random.choice(list(self._folders.keys()))
-            _p1, _p2 = self._get_name_components(_location)
-            #if not (passes(_p1) and passes(_p2)):
-                #log.info('skipped banned location "%s/%s"', _p1, _p2)
-                #continue
-            _file = random.choice(self._folders[_location])
-            _f =  self._get_name_component(_file.name_index)
-            if not passes(_p2, _f):
-                log.info('skipped banned file "%s/%s"', _p2, _f)
+        if _track_count == 0:
+            return None
+
+        if _item is None:
+            log.warning('all %d tracks are banned by smartlist "%s"',
+                        _track_count, _list.name)
+            return None
+
+        log.info('accept item: %s', _item)
+        return _item
+
+    def _best_tracks(self, matches: list, count: int) -> list:
+        ''' returns (score, track) of the @count tracks scoring best
+            with the folder and file names scored by the {name index:
+            score} dicts @matches '''
+        # folders and files have one name each, so summing up the scores
+        # per name is enough
+        _name_scores = {}
+        for m in matches:
+            for _idx, _score in m.items():
+                _name_scores[_idx] = _name_scores.get(_idx, 0) + _score
+        _folder_scores = {}
+        _file_scores = {}
+        for _idx, _score in _name_scores.items():
+            for _folder in self._folders_with_relpath(_idx):
+                _folder_scores[_folder] = _score
+            for _track in self._tracks_with_name(_idx):
+                _file_scores[_track] = _score
+
+        _hits = [(_score + _folder_scores.get(self._track_folder[_track], 0), _track)
+                 for _track, _score in _file_scores.items()]
+        # every other file inside a matching folder is a hit on its own -
+        # with the folder's score, so only the best folders need to be
+        # expanded until there are enough of them
+        _missing = count
+        for _folder in sorted(_folder_scores, key=_folder_scores.get, reverse=True):
+            if _missing <= 0:
+                break
+            for _track in self._folder_tracks(_folder):
+                if _track not in _file_scores:
+                    _hits.append((_folder_scores[_folder], _track))
+                    _missing -= 1
+                    if not _missing:
+                        break
+        return heapq.nlargest(count, _hits, key=lambda tup: tup[0])
+
+    def _best_tracks_vectorized(self, groups: list, count: int) -> list:
+        ''' like _best_tracks() but takes the (name indices, score) pairs
+            per word as returned by search_index.search_groups() and scores
+            the tracks using a matching name in one go - or all tracks if
+            a common word matches so many names that following their chains
+            would take longer '''
+        _track_name = numpy.asarray(self._track_name)
+        _track_folder = numpy.asarray(self._track_folder)
+        _folder_relpath = numpy.asarray(self._folder_relpath)
+        _matching = sum(len(n) for g in groups for n, _ in g)
+        if _matching > len(_track_name) * scheduler.SEARCH_SCAN_FRACTION:
+            # one more for the name index -1 of removed tracks
+            _scores = numpy.zeros(len(self._names) + 1)
+            for _word_groups in groups:
+                if len(_word_groups) == 1:
+                    _scores[self._name_array(_word_groups[0][0])] += _word_groups[0][1]
+                    continue
+                # a name can match several times - with the best score counting
+                _word = numpy.zeros(len(self._names) + 1)
+                for _names, _score in sorted(_word_groups, key=lambda g: g[1]):
+                    _word[self._name_array(_names)] = _score
+                _scores += _word
+            _tracks = numpy.arange(len(_track_name))
+            _total = _scores[_track_name] + _scores[_folder_relpath][_track_folder]
+            if self._removed_tracks:
+                _total[_track_name < 0] = 0.
+        else:
+            _name_scores = collections.Counter()
+            for _word_groups in groups:
+                _name_scores.update(search_index.similarities(_word_groups))
+            # sorted by name index for looking them up
+            _names_list = sorted(_name_scores)
+            _names = numpy.fromiter(_names_list, dtype=numpy.int64,
+                                    count=len(_names_list))
+            _scores = numpy.fromiter(map(_name_scores.get, _names_list),
+                                     dtype=numpy.float64, count=len(_names_list))
+            _name_track, _track_next = self._name_track, self._track_next
+            _name_folder, _folder_next = self._name_folder, self._folder_next
+            # removed tracks are not part of any chain
+            _candidates = []
+            for i in _names_list:
+                _track = _name_track[i]
+                while _track >= 0:
+                    _candidates.append(_track)
+                    _track = _track_next[_track]
+                _folder = _name_folder[i]
+                while _folder >= 0:
+                    _candidates.extend(self._folder_tracks(_folder))
+                    _folder = _folder_next[_folder]
+            _tracks = numpy.unique(numpy.array(_candidates, dtype=numpy.int64))
+
+            def _score(name_indices):
+                _pos = numpy.minimum(numpy.searchsorted(_names, name_indices),
+                                     len(_names) - 1)
+                return numpy.where(_names[_pos] == name_indices, _scores[_pos], 0.)
+
+            _total = (_score(_track_name[_tracks]) +
+                      _score(_folder_relpath[_track_folder[_tracks]]))
+        _hits = numpy.flatnonzero(_total)
+        if len(_hits) > count:
+            _hits = _hits[numpy.argpartition(-_total[_hits], count - 1)[:count]]
+        _hits = _hits[numpy.argsort(-_total[_hits], kind='stable')]
+        return [(float(_total[h]), int(_tracks[h])) for h in _hits]
+
+    @staticmethod
+    def _name_array(names):
+        ''' returns the name indices @names as numpy array - without copying
+            the posting lists of the search index '''
+        if isinstance(names, array):
+            return numpy.frombuffer(names, dtype=numpy.uint32)
+        return numpy.fromiter(names, dtype=numpy.int64, count=len(names))
+
+    def _sample(self, smartlist_inst):
+        ''' returns a random track allowed by @smartlist_inst or None if
+            all of them are banned. It only gets remembered as played
+            once it's handed out, until then it mustn't repeat those
+            picked ahead '''
+        if (smartlist_inst.upvote_weights is not None and
+                time.time() - smartlist_inst.weights_time > scheduler.WEIGHTS_MAX_AGE):
+            self._update_weights(smartlist_inst)
+        _ahead = ()
+        if self._recent and self._lookahead is not None:
+            _ahead = [self._recent_keys(t) for t in self._lookahead.tracks()
+                      if self._track_name[t] >= 0]
+        for _ in range(scheduler.NO_REPEAT_ATTEMPTS):
+            _track = None
+            if self._scheduling_mode == 'affinity':
+                _track = self._walk(smartlist_inst)
+            if _track is None:
+                # banned tracks have a weight of 0 so every pick is a valid one
+                _track = smartlist_inst.sampler.sample()
+            if _track is None or not self._played_recently(_track, _ahead):
+                break
+        # if nothing else is left we play something again after all
+        if _track is not None:
+            self._last_track = _track
+        return _track
+
+    def _recent_keys(self, track: int) -> tuple:
+        ''' returns the (track, folder, artist) keys of the no-repeat windows '''
+        _root, _relpath, _filename = self._get_track(track)
+        _folder = os.path.join(_root, _relpath)
+        _path = os.path.join(_folder, _filename)
+        _tags = self._metadata.get(_path) if self._metadata is not None else None
+        _artist = fold(_tags['artist']).strip() if _tags and 'artist' in _tags else None
+        return _path, _folder, _artist
+
+    def _played_recently(self, track: int, ahead=()) -> bool:
+        return bool(self._recent) and self._recent.excludes(
+            *self._recent_keys(track), ahead=ahead)
+
+    def _remember_played(self, track: int) -> None:
+        if self._recent:
+            self._recent.add(*self._recent_keys(track))
+
+    def _pick_ahead(self):
+        ''' returns (track, path) for the lookahead or None '''
+        with self._lock:
+            if len(self._track_name) == self._removed_tracks:
+                return None
+            _track = self._sample(self._list)
+            if _track is None:
+                return None
+            return _track, os.path.join(*self._get_track(_track))
+
+    def _next_wish_path(self) -> str:
+        with self._lock:
+            for _track, _, _ in self._wishlist.items(1):
+                if self._track_name[_track] >= 0:
+                    return os.path.join(*self._get_track(_track))
+        return None
+
+    def _is_eligible(self, track: int) -> bool:
+        ''' tells whether @track may (still) be played - it might have been
+            removed or banned since it got picked '''
+        return self._track_name[track] >= 0 and self._list.sampler.get(track) > 0.
+
+    def _walk(self, smartlist_inst):
+        ''' returns a track close to the one scheduled last by doing a
+            step on the affinity graph or None to pick one from the whole
+            library '''
+        if self._last_track is None or self._track_name[self._last_track] < 0:
+            return None
+        if random.random() < self._config.get('affinity_restart', .1):
+            return None
+        if self._affinity is None:
+            self._affinity = affinity_graph(self._affinity_folders())
+            log.info('built affinity graph over %d folders', len(self._affinity))
+        _folder = self._track_folder[self._last_track]
+        if random.random() >= self._config.get('affinity_stay', .3):
+            _folder = self._affinity.step(_folder, random)
+            if _folder is None:
+                return None
+        # stick to the smartlist's weights - banned tracks have none
+        _tracks = self._folder_tracks(_folder)
+        _weights = [0. if t == self._last_track else smartlist_inst.sampler.get(t)
+                    for t in _tracks]
+        if sum(_weights) <= 0.:
+            return None
+        return random.choices(_tracks, _weights)[0]
+
+    def _affinity_folders(self) -> list:
+        ''' returns (folder index, root, relative path) of all folders '''
+        return [(_folder, self._get_name_component(_path_idx),
+                 self._get_name_component(_relpath_idx))
+                for (_path_idx, _relpath_idx), _folder in self._folder_lookup.items()]
+
+    def _invalidate_affinity(self) -> None:
+        ''' folders came or went - the affinity graph gets rebuilt in the
+            background while scheduling goes on with the old one '''
+        if self._affinity is not None:
+            self._affinity_stale = True
+            self._stale_event.set()
+
+    def _load_smartlist(self, list_name: str):
+        ''' reads @list_name and derives its state from the library. It
+            stays loaded until it gets unloaded by _evict_smartlists() '''
+        _journal = journal(
+            os.path.join(os.path.expanduser(self._config['playlist_folder']),
+                         list_name),
+            self._config.get('journal_sync_interval', 1.))
+        _rules, _malformed, _redundant_lines = self._load_rules(_journal)
+        _list = smartlist(list_name, _journal, _rules, _redundant_lines, _malformed)
+        with self._lock:
+            if list_name in self._loaded:
+                # somebody else has been faster
+                _journal.close()
+                return self._loaded[list_name]
+            _list.ban_matcher = ban_matcher(_rules, self._search_index.lowered)
+            _list.banned = bytearray(
+                _name < 0 or self._check_bans(
+                    _list, _track, self._folder_relpath[_folder], _name)
+                for _track, (_folder, _name) in enumerate(
+                    zip(self._track_folder, self._track_name)))
+            if self._scheduling_mode == 'upvotes':
+                _list.upvote_weights = upvote_weights(self._config)
+            self._refresh_smartlist(_list)
+            self._loaded[list_name] = _list
+            self._evict_smartlists()
+        log.info("loaded %s", _list)
+        return _list
+
+    def _evict_smartlists(self) -> None:
+        ''' unloads the least recently used smartlists until the others
+            fit into smartlist_memory_limit '''
+        _usage = sum(l.memory_usage() for l in self._loaded.values())
+        # the most recently used one always stays
+        for l in list(self._loaded.values())[:-1]:
+            if _usage <= self._memory_limit:
+                break
+            if l is self._list:
                 continue
-            return (_p1, _p2, _f)
+            _usage -= l.memory_usage()
+            del self._loaded[l.name]
+            l.journal.close()
+            log.info("unloaded %s", l)
 
-    def _store_list(self):
-        if not self._dirty:
-            return
-        _path = os.path.join(
-            os.path.expanduser(self._config['playlist_folder']),
-            self._active_list)
-        with open(_path, 'w') as _f:
-            for r in self._rules:
-                _f.write(r.to_line() + '\n')
-        self._dirty = False
-
-    def _load_rules(self, list_file):
-        _path = os.path.join(
-            os.path.expanduser(self._config['playlist_folder']),
-            list_file)
+    def _refresh_weights(self, collect_upvotes: bool) -> None:
+        ''' brings the weights of the active smartlist up to date at once
+            and those of the other loaded smartlists in the background '''
+        for l in self._loaded.values():
+            l.stale = l.stale or l is not self._list
+        if self._list is not None:
+            if collect_upvotes:
+                self._collect_upvotes(self._list)
+            self._update_weights(self._list)
+        self._stale_event.set()
 
-        try:
-            with open(_path) as _f:
-                return [scheduler.rule(line=l) for l in _f.readlines()]
-        except FileNotFoundError:
-            return []
+    def _set_present_listeners(self, listeners: set) -> None:
+        ''' makes @listeners the ones present and recomputes the weights
+            of only those smartlists whose bans or upvotes count
+            differently now '''
+        _changed = self._present_listeners ^ listeners
+        _applying = {l.name: self._applying_bans(l) for l in self._loaded.values()}
+        self._present_listeners = listeners
+        for l in self._loaded.values():
+            if (_applying[l.name] == self._applying_bans(l) and
+                    (l.upvote_weights is None or
+                     not any(l.upvote_weights.has_voted(x) for x in _changed))):
+                continue
+            if l is self._list:
+                self._combine_bans(l)
+                self._update_weights(l)
+                self._notify_available()
+            else:
+                l.stale = True
+                self._stale_event.set()
+
+    def _refresh_smartlist(self, smartlist_inst) -> None:
+        self._combine_bans(smartlist_inst)
+        self._collect_upvotes(smartlist_inst)
+        self._update_weights(smartlist_inst)
+        smartlist_inst.stale = False
+
+    def _refresh_fn(self) -> None:
+        while True:
+            self._stale_event.wait()
+            if self._stop_event.is_set():
+                return
+            self._stale_event.clear()
+            with self._lock:
+                _stale = [l for l in self._loaded.values() if l.stale]
+                _folders = self._affinity_folders() if self._affinity_stale else None
+                self._affinity_stale = False
+            if _folders is not None:
+                _graph = affinity_graph(_folders)
+                with self._lock:
+                    # even if folders changed meanwhile it's newer than
+                    # the one in use - and another one is on its way
+                    self._affinity = _graph
+                log.info('rebuilt affinity graph over %d folders', len(_graph))
+            # one by one so we don't block scheduling for too long
+            for l in _stale:
+                with self._lock:
+                    if l.stale and self._loaded.get(l.name) is l:
+                        self._refresh_smartlist(l)
+
+    def _compact_journal(self):
+        ''' rewrites the journal of the active smartlist in the background
+            without repeated ban rules '''
+        _list = self._list
+        _ban_subjects = set()
+        _lines = list(_list.malformed_lines)
+        for r in _list.rules:
+            if r.tag_name == 'ban':
+                if (r.listener, r.tag_string) in _ban_subjects:
+                    continue
+                _ban_subjects.add((r.listener, r.tag_string))
+            _lines.append(r.to_line())
+        # if one is running already it's the next one's turn
+        if _list.journal.compact(_lines):
+            _list.redundant_lines = 0
+
+    def _load_rules(self, rule_journal):
+        ''' replays @rule_journal, returns its rules, its malformed lines
+            and the number of lines a compaction would remove '''
+        _rules = []
+        _malformed = []
+        _ban_subjects = set()
+        _redundant_lines = 0
+        for l in rule_journal.read():
+            try:
+                _rule = scheduler.rule(line=l)
+            except ValueError as ex:
+                # kept as they are so they can be repaired by hand
+                log.error("skip malformed rule '%s': %s", l, ex)
+                _malformed.append(l)
+                continue
+            if _rule.tag_name == 'ban':
+                if (_rule.listener, _rule.tag_string) in _ban_subjects:
+                    _redundant_lines += 1
+                _ban_subjects.add((_rule.listener, _rule.tag_string))
+            _rules.append(_rule)
+        return _rules, _malformed, _redundant_lines
 
     def _on_aquired(self, url, path):
-        pass
+        self._notify_available()
+
+    def _notify_available(self) -> None:
+        ''' wakes up get_next() callers waiting for something to play '''
+        with self._lock:
+            self._available_changes += 1
+            self._available.notify_all()
 
     def set_acquirer(self, acquirer_inst):
         assert hasattr(acquirer_inst, 'aquire')
         self._acquirer = acquirer_inst
 
     def add_path(self, path:str='.') -> int:
-        self._sources.append(path)
-        return self._crawl_path(path)
+        return self.add_paths((path,))
 
-    def debug_check(self):
-        for r in self._rules:
-            if r.tag_name != 'ban':
-                continue
-            log.info("%d items banned by %s", len(r.banned_items), r)
-            for i in r.banned_items:
-                log.info("   %s", i)
+    def add_paths(self, paths) -> int:
+        ''' crawls all given paths concurrently and returns the number of
+            music files found '''
+        self._sources.extend(paths)
+        _count = self._crawl_paths(paths)
+        if self._lookahead is not None:
+            self._lookahead.wake()
+        if self._scheduling_mode == 'upvotes':
+            with self._lock:
+                # votes for tracks we didn't know before count now
+                self._refresh_weights(collect_upvotes=True)
+        return _count
 
-    def _is_music(self, filename):
-        return os.path.splitext(filename.lower())[1] in self._music_pattern
+    def known_dirs(self) -> list:
+        ''' returns (root, relpath, mtime_ns) for every crawled directory '''
+        with self._lock:
+            return [(_root, _relpath, _entry[0])
+                    for _root, _dirs in self._dir_cache.items()
+                    if _root in self._crawled_roots
+                    for _relpath, _entry in _dirs.items()]
 
-    def _has_music(self, files):
-        for f in files:
-            if self._is_music(f):
-                return True
-        return False
+    def refresh_dirs(self, dirs) -> int:
+        ''' applies changes inside the given (root, relpath) directories
+            to the library without crawling everything again and returns
+            the number of added minus removed tracks '''
+        _delta = 0
+        for _root, _relpath in dirs:
+            _delta += self._refresh_dir(_root, _relpath)
+        if self._scheduling_mode == 'upvotes':
+            with self._lock:
+                # votes refer to track indices which may have changed
+                self._refresh_weights(collect_upvotes=True)
+        return _delta
 
-    def _get_music(self, files):
-        # todo: count init/del
-        class fileinfo:
-            def __init__(self, filename_index):
-                self.name_index = filename_index
+    def stop_crawling(self) -> None:
+        ''' makes crawls in progress return early and those to come return
+            right away - the library index stays as it has been before '''
+        self._crawl_stop.set()
 
-            def __repr__(self):
-                return "fileinfo(%d)" % self.name_index
+    def debug_check(self):
+        with self._lock:
+            for r in self._list.rules:
+                if r.tag_name != 'ban':
+                    continue
+                log.info("%d items banned by %s", len(r.banned_items), r)
+                for i in r.banned_items:
+                    log.info("   %s", i)
 
-        return [fileinfo(self._get_name_component_index(f))
-                for f in files if self._is_music(f)]
+    def _is_music(self, filename):
+        return os.path.splitext(filename.lower())[1] in self._music_pattern
 
     def _get_name_component_index(self, name_component:str) -> int:
-        if not name_component in self._name_components:
-            _new_index = len(self._name_components)
-            assert _new_index not in self._name_components
-            self._name_components[name_component] = _new_index
-            self._name_components[_new_index] = name_component
-            return _new_index
-        return self._name_components[name_component]
+        _index = self._name_indices.get(name_component)
+        if _index is None:
+            _index = len(self._names)
+            self._names.append(name_component)
+            self._name_indices[name_component] = _index
+            self._name_folder.append(-1)
+            self._name_track.append(-1)
+        return _index
 
     def _get_name_component(self, name_component_index: int) -> str:
-        assert name_component_index in self._name_components
-        return self._name_components[name_component_index]
+        assert 0 <= name_component_index < len(self._names)
+        return self._names[name_component_index]
 
     def _get_name_components(self, indices: tuple) -> tuple:
         return tuple(self._get_name_component(e) for e in indices)
 
-    def _crawl_path(self, path: str):
-        _path = os.path.normpath(path)
-        assert _path.startswith('/')
-        assert not _path.endswith('/')
-        _path_idx = self._get_name_component_index(_path)
-        _result_count = 0
-        for _parent, _folders, _files in os.walk(_path):
-            _folders[:] = [d for d in _folders if d not in ('.git', '.svn')]
-
-            assert _parent.startswith(_path)
-            assert _parent == os.path.normpath(_parent)
-            _relpath = _parent[len(_path):].strip('/')
-            _relpath_idx = self._get_name_component_index(_relpath)
-            assert _parent == os.path.normpath(os.path.join(_path, _relpath))
-
-            if _parent in self._folders:
+    def _state_path(self, name: str) -> str:
+        ''' returns the path of the state file @name which can be
+            configured and by default lives next to playlist_folder '''
+        if name in self._config:
+            return os.path.expanduser(self._config[name])
+        # must not live inside playlist_folder - every file there is a smartlist
+        _lists = os.path.normpath(
+            os.path.expanduser(self._config['playlist_folder']))
+        return os.path.join(os.path.dirname(_lists), name)
+
+    def _library_index_path(self) -> str:
+        return self._state_path('library_index')
+
+    def _create_metadata_store(self):
+        if not self._config.get('read_metadata', True):
+            return None
+        try:
+            return metadata_store(self._state_path('metadata_cache'),
+                                  self._config.get('metadata_processes'))
+        except metadata_store.unavailable as ex:
+            log.warning('%s - artist, album and title stay unknown', ex)
+            return None
+
+    def _create_loudness_store(self):
+        if not self._config.get('analyze_loudness', True):
+            return None
+        try:
+            return loudness_store(self._state_path('loudness_cache'),
+                                  self._config.get('loudness_processes'),
+                                  self._config.get('decoder_command',
+                                                   mixer.decoder.COMMAND))
+        except loudness_store.unavailable as ex:
+            log.warning('%s - all tracks play at the same volume', ex)
+            return None
+
+    def _load_library_index(self) -> dict:
+        ''' returns the directory cache stored by store_library_index() as
+            {root: {relpath: (mtime_ns, subdirs, music_files)}} or an empty
+            dict if there is no usable snapshot '''
+        _path = self._library_index_path()
+        try:
+            with open(_path) as _f:
+                _snapshot = json.load(_f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            log.warning("ignore unreadable library index '%s': %s", _path, ex)
+            return {}
+
+        if _snapshot.get('version') != scheduler.LIBRARY_INDEX_VERSION:
+            log.info("ignore library index '%s' with version %s",
+                     _path, _snapshot.get('version'))
+            return {}
+
+        _names = _snapshot['names']
+        _result = {}
+        for _root, _dirs in _snapshot['roots'].items():
+            _entries = {_names[_relpath]: (_mtime, [], tuple(_names[f] for f in _files))
+                        for _relpath, _mtime, _files in _dirs}
+            # subdirectories are not stored explicitly - each directory
+            # is known to its parent by its relative path
+            for _relpath in _entries:
+                if _relpath == '':
+                    continue
+                _parent = _entries.get(os.path.dirname(_relpath))
+                if _parent is not None:
+                    _parent[1].append(os.path.basename(_relpath))
+            _result[_root] = _entries
+
+        log.info("loaded library index '%s' with %d directories",
+                 _path, sum(len(d) for d in _result.values()))
+        return _result
+
+    def store_library_index(self) -> None:
+        ''' writes all crawled directories together with their mtime and
+            their music files to disk so the next crawl can skip
+            directories which have not been modified since '''
+        if not self._index_dirty:
+            return
+        _names = []
+        _name_indices = {}
+
+        def intern(name):
+            if name not in _name_indices:
+                _name_indices[name] = len(_names)
+                _names.append(name)
+            return _name_indices[name]
+
+        _roots = {}
+        for _root in self._crawled_roots:
+            _roots[_root] = [
+                (intern(_relpath), _mtime, [intern(f) for f in _files])
+                for _relpath, (_mtime, _, _files) in self._dir_cache[_root].items()]
+
+        _path = self._library_index_path()
+        _tmp_path = _path + '.tmp'
+        with open(_tmp_path, 'w') as _f:
+            json.dump({'version': scheduler.LIBRARY_INDEX_VERSION,
+                       'names': _names,
+                       'roots': _roots}, _f, separators=(',', ':'))
+        os.replace(_tmp_path, _path)
+        self._index_dirty = False
+        log.info("stored library index '%s'", _path)
+
+    def _scan_dir(self, path: str, mtime: int) -> tuple:
+        _subdirs, _music_files = [], []
+        for _entry in os.scandir(path):
+            if _entry.is_dir():
+                # like os.walk() we don't follow symlinks to directories
+                if (not _entry.is_symlink() and
+                        _entry.name not in ('.git', '.svn')):
+                    _subdirs.append(_entry.name)
+            elif self._is_music(_entry.name):
+                _music_files.append(_entry.name)
+        return mtime, _subdirs, tuple(_music_files)
+
+    def _ban_applies(self, listener: str) -> bool:
+        ''' bans count for the listeners present - or for everybody if
+            nobody is known to be present '''
+        return not self._present_listeners or listener in self._present_listeners
+
+    def _check_bans(self, smartlist_inst, track: int, folder: int,
+                    filename: int) -> bool:
+        ''' marks @track for all listeners banning it and returns whether
+            it's banned for the listeners present '''
+        _banned = False
+        for r in smartlist_inst.ban_matcher.banning_rules(folder, filename):
+            smartlist_inst.bans_of(r.listener).add(track)
+            if not _banned and self._ban_applies(r.listener):
+                r.banned_items.add(self._get_name_components((folder, filename)))
+                _banned = True
+        return _banned
+
+    def _applying_bans(self, smartlist_inst) -> set:
+        ''' returns the listeners whose bans count in @smartlist_inst '''
+        return {l for l in smartlist_inst.listener_bans if self._ban_applies(l)}
+
+    def _combine_bans(self, smartlist_inst) -> None:
+        ''' recomputes which tracks are banned from the bitsets of the
+            listeners present in one go '''
+        smartlist_inst.banned = bitset.union(
+            [self._removed] + [smartlist_inst.listener_bans[l]
+                               for l in self._applying_bans(smartlist_inst)]
+        ).unpack(len(self._track_name))
+
+    def _tracks_matching(self, rule) -> set:
+        ''' returns the indices of all tracks matched by @rule using the
+            search index instead of looking at each track '''
+        def folder_tracks(pattern):
+            return {t for _idx in self._search_index.find(pattern)
+                    for _folder in self._folders_with_relpath(_idx)
+                    for t in self._folder_tracks(_folder)}
+
+        def file_tracks(pattern):
+            return {t for _idx in self._search_index.find(pattern)
+                    for t in self._tracks_with_name(_idx)}
+
+        if rule._folder_component is None and rule._file_component is None:
+            return folder_tracks(rule.tag_string) | file_tracks(rule.tag_string)
+        if rule._file_component is None:
+            return folder_tracks(rule._folder_component)
+        if rule._folder_component is None:
+            return file_tracks(rule._file_component)
+        return folder_tracks(rule._folder_component) & file_tracks(
+            rule._file_component)
+
+    def _apply_ban_rule(self, rule) -> None:
+        ''' bans all tracks matching @rule in the active smartlist '''
+        _bans = self._list.bans_of(rule.listener)
+        _applies = self._ban_applies(rule.listener)
+        _count = 0
+        for _track in self._tracks_matching(rule):
+            _bans.add(_track)
+            if not _applies or self._list.banned[_track]:
                 continue
-            if not self._has_music(_files):
+            rule.banned_items.add(self._get_track(_track)[1:])
+            self._list.banned[_track] = 1
+            self._list.sampler.set(_track, 0.)
+            _count += 1
+        log.info('%s bans %d more tracks', rule, _count)
+
+    def _upvoted_tracks(self, rule) -> list:
+        ''' returns the indices of the tracks an upvote rule refers to '''
+        _folder, _, _file = rule.tag_string.rpartition('/')
+        return [t for _idx in self._search_index.find(_file)
+                if self._search_index.lowered(_idx) == _file
+                for t in self._tracks_with_name(_idx)
+                if self._search_index.lowered(
+                    self._folder_relpath[self._track_folder[t]]) == _folder]
+
+    def _collect_upvotes(self, smartlist_inst) -> None:
+        _weights = smartlist_inst.upvote_weights
+        if _weights is None:
+            return
+        _weights.clear()
+        for r in smartlist_inst.rules:
+            if r.tag_name != 'upvote':
+                continue
+            for _track in self._upvoted_tracks(r):
+                _weights.add_vote(_track, r.time, r.listener)
+
+    def _update_weights(self, smartlist_inst) -> None:
+        ''' recomputes the selection weights of all tracks '''
+        _weights = smartlist_inst.upvote_weights
+        if _weights is None and numpy is not None:
+            smartlist_inst.sampler.assign(
+                1. - numpy.frombuffer(smartlist_inst.banned, dtype=numpy.uint8))
+        elif _weights is None:
+            smartlist_inst.sampler.assign(
+                0. if b else 1. for b in smartlist_inst.banned)
+        else:
+            smartlist_inst.sampler.assign(_weights.compute(
+                smartlist_inst.banned, self._present_listeners, time.time()))
+            log.debug('updated weights from %d upvotes', len(_weights))
+        smartlist_inst.weights_time = time.time()
+
+    def _get_track(self, track: int) -> tuple:
+        _folder = self._track_folder[track]
+        return (self._get_name_component(self._folder_path[_folder]),
+                self._get_name_component(self._folder_relpath[_folder]),
+                self._get_name_component(self._track_name[track]))
+
+    def _get_item_id(self, track: int) -> str:
+        _folder = self._track_folder[track]
+        return "%d/%d/%d" % (self._folder_path[_folder],
+                             self._folder_relpath[_folder],
+                             self._track_name[track])
+
+    def _get_track_index(self, item: str) -> int:
+        ''' turns an item id into a track index '''
+        try:
+            _path_idx, _relpath_idx, _name_idx = (int(e) for e in item.split('/'))
+        except ValueError:
+            raise error.invalid_value('malformed item "%s"' % item)
+        _folder = self._folder_lookup.get((_path_idx, _relpath_idx))
+        if _folder is not None:
+            for _track in self._folder_tracks(_folder):
+                if self._track_name[_track] == _name_idx:
+                    return _track
+        raise error.invalid_value('unknown item "%s"' % item)
+
+    def _folder_tracks(self, folder: int):
+        ''' returns the tracks of @folder which haven't been removed '''
+        _tracks = range(self._folder_offsets[folder], self._folder_offsets[folder + 1])
+        if folder not in self._folder_added and folder not in self._folder_removed:
+            return _tracks
+        return [t for t in itertools.chain(_tracks, self._folder_added.get(folder, ()))
+                if self._track_name[t] >= 0]
+
+    def _folders_with_relpath(self, name_index: int):
+        _folder = self._name_folder[name_index]
+        while _folder >= 0:
+            yield _folder
+            _folder = self._folder_next[_folder]
+
+    def _tracks_with_name(self, name_index: int):
+        _track = self._name_track[name_index]
+        while _track >= 0:
+            yield _track
+            _track = self._track_next[_track]
+
+    @staticmethod
+    def _unlink(first: array, following: array, name_index: int, item: int) -> None:
+        ''' removes @item from the chain of @name_index '''
+        _previous, _current = -1, first[name_index]
+        while _current != item:
+            _previous, _current = _current, following[_current]
+        if _previous < 0:
+            first[name_index] = following[item]
+        else:
+            following[_previous] = following[item]
+
+    def _forget_unused_name(self, name_index: int) -> None:
+        if self._name_folder[name_index] < 0 and self._name_track[name_index] < 0:
+            self._search_index.remove(name_index)
+
+    def _remove_folder(self, folder: int) -> int:
+        ''' marks all tracks of @folder as removed, returns their number '''
+        _relpath_idx = self._folder_relpath[folder]
+        del self._folder_lookup[(self._folder_path[folder], _relpath_idx)]
+        self._invalidate_affinity()
+        scheduler._unlink(self._name_folder, self._folder_next, _relpath_idx, folder)
+        self._forget_unused_name(_relpath_idx)
+        _tracks = self._folder_tracks(folder)
+        for _track in _tracks:
+            self._remove_track(_track)
+        self._folder_added.pop(folder, None)
+        self._folder_removed.pop(folder, None)
+        return len(_tracks)
+
+    def _remove_track(self, track: int) -> None:
+        ''' marks @track as removed - its index never gets used again '''
+        _name = self._track_name[track]
+        scheduler._unlink(self._name_track, self._track_next, _name, track)
+        self._forget_unused_name(_name)
+        self._track_name[track] = -1
+        self._removed.add(track)
+        for l in self._loaded.values():
+            l.banned[track] = 1
+            l.sampler.set(track, 0.)
+        self._removed_tracks += 1
+        _folder = self._track_folder[track]
+        self._folder_removed[_folder] = self._folder_removed.get(_folder, 0) + 1
+
+    def _replace_folder(self, root: str, relpath: str, files: tuple) -> int:
+        ''' makes the tracks of the given folder match @files, returns the
+            change of their number '''
+        _path_idx = self._get_name_component_index(root)
+        _relpath_idx = self._get_name_component_index(relpath)
+        _folder = self._folder_lookup.get((_path_idx, _relpath_idx))
+        if _folder is None:
+            if files:
+                self._add_folder(_path_idx, _relpath_idx, files)
+                self._catch_up_smartlists()
+            return len(files)
+        if not files:
+            return -self._remove_folder(_folder)
+        # unchanged files keep their tracks - and wishes, bans etc. with them
+        _tracks = {self._get_name_component(self._track_name[t]): t
+                   for t in self._folder_tracks(_folder)}
+        for f in set(_tracks) - set(files):
+            self._remove_track(_tracks[f])
+        _added = [f for f in files if f not in _tracks]
+        if _added:
+            self._folder_added.setdefault(_folder, array('l')).extend(
+                self._append_track(_folder, f) for f in _added)
+            self._catch_up_smartlists()
+            self._submit_files(_folder, _added)
+            self._notify_available()
+        return len(files) - len(_tracks)
+
+    def _remove_subtree(self, root: str, relpath: str) -> int:
+        _dirs = self._dir_cache.get(root, {})
+        _prefix = relpath + '/' if relpath else ''
+        _delta = 0
+        for _relpath in [d for d in _dirs if d == relpath or d.startswith(_prefix)]:
+            del _dirs[_relpath]
+            _delta += self._replace_folder(root, _relpath, ())
+        return _delta
+
+    def _crawl_subtree(self, root: str, relpath: str) -> list:
+        ''' lists a new directory and all directories below it '''
+        _result = []
+        _pending = [relpath]
+        while _pending:
+            _relpath = _pending.pop()
+            _visit = self._visit_dir(root, _relpath, None)
+            if _visit is not None:
+                _result.append((_relpath, _visit[0]))
+                _pending.extend(os.path.join(_relpath, d) for d in _visit[0][1])
+        return _result
+
+    def _refresh_dir(self, root: str, relpath: str) -> int:
+        _visit = self._visit_dir(root, relpath, None)
+        with self._lock:
+            _dirs = self._dir_cache.setdefault(root, {})
+            _old = _dirs.get(relpath)
+            self._index_dirty = True
+            if _visit is None:
+                _delta = self._remove_subtree(root, relpath)
+                log.info("removed '%s' (%+d tracks)", os.path.join(root, relpath), _delta)
+                return _delta
+            _entry = _visit[0]
+            _dirs[relpath] = _entry
+            _delta = 0
+            if _old is None or set(_old[2]) != set(_entry[2]):
+                _delta += self._replace_folder(root, relpath, _entry[2])
+            _new_subdirs = set(_entry[1])
+            if _old is not None:
+                for d in set(_old[1]) - _new_subdirs:
+                    _delta += self._remove_subtree(root, os.path.join(relpath, d))
+                _new_subdirs -= set(_old[1])
+
+        for d in _new_subdirs:
+            for _relpath, _entry in self._crawl_subtree(root, os.path.join(relpath, d)):
+                with self._lock:
+                    self._dir_cache[root][_relpath] = _entry
+                    _delta += self._replace_folder(root, _relpath, _entry[2])
+        log.info("refreshed '%s' (%+d tracks)", os.path.join(root, relpath), _delta)
+        return _delta
+
+    def _add_folder(self, path_idx: int, relpath_idx: int, files: tuple) -> None:
+        _folder = len(self._folder_relpath)
+        self._folder_lookup[(path_idx, relpath_idx)] = _folder
+        self._invalidate_affinity()
+        self._folder_path.append(path_idx)
+        self._folder_relpath.append(relpath_idx)
+        self._folder_next.append(self._name_folder[relpath_idx])
+        self._name_folder[relpath_idx] = _folder
+        self._search_index.add(relpath_idx, self._get_name_component(relpath_idx))
+        for f in files:
+            self._append_track(_folder, f)
+        self._folder_offsets.append(len(self._track_name))
+        self._submit_files(_folder, files)
+        # no need to wait for the whole crawl
+        self._notify_available()
+
+    def _append_track(self, folder: int, filename: str) -> int:
+        _name = self._get_name_component_index(filename)
+        _track = len(self._track_name)
+        self._track_folder.append(folder)
+        self._track_name.append(_name)
+        self._track_next.append(self._name_track[_name])
+        self._name_track[_name] = _track
+        self._search_index.add(_name, filename)
+        return _track
+
+    def _catch_up_smartlists(self) -> None:
+        ''' checks the tracks appended since the last call against the bans
+            of all loaded smartlists and lets them get picked. Tracks get
+            appended in bulk so they must not be used before. '''
+        _count = len(self._track_name)
+        for l in self._loaded.values():
+            _first = len(l.banned)
+            if _first == _count:
                 continue
-            _music_file_list = self._get_music(_files)
-            for f in _music_file_list:
-                for r in self._rules:
-                    if r.tag_name == 'ban' and r.matches(
-                        self._get_name_component(_relpath_idx),
-                        self._get_name_component(f.name_index)):
-                        pass
-
-            self._folders[(_path_idx, _relpath_idx)] = _music_file_list
-            _result_count += len(_music_file_list)
-            log.debug(_relpath)
+            if len(l.ban_matcher):
+                l.banned.extend(
+                    _name < 0 or self._check_bans(
+                        l, _track, self._folder_relpath[self._track_folder[_track]], _name)
+                    for _track, _name in enumerate(
+                        self._track_name[_first:], _first))
+            else:
+                l.banned.extend(bytes(_count - _first))
+            l.sampler.extend(0. if b else 1. for b in l.banned[_first:])
+
+    def _submit_files(self, folder: int, files) -> None:
+        ''' has tags and loudness of @files in @folder read '''
+        _path = os.path.join(self._get_name_component(self._folder_path[folder]),
+                             self._get_name_component(self._folder_relpath[folder]))
+        for _store in (self._metadata, self._loudness):
+            if _store is not None:
+                _store.submit(os.path.join(_path, f) for f in files)
+
+    def _visit_dir(self, root: str, relpath: str, known: tuple):
+        ''' runs in a crawler thread and must not touch shared state.
+            Returns the (mtime, subdirs, music_files) entry of the given
+            directory and whether it had to be listed or None on error '''
+        _path = os.path.join(root, relpath) if relpath else root
+        try:
+            _mtime = os.stat(_path).st_mtime_ns
+        except OSError as ex:
+            log.warning("cannot access '%s': %s", _path, ex)
+            return None
+
+        # a directory's mtime changes whenever entries are added, removed
+        # or renamed so we only have to list it if it differs
+        if known is not None and known[0] == _mtime:
+            return known, False
+        try:
+            return self._scan_dir(_path, _mtime), True
+        except OSError as ex:
+            log.warning("cannot list '%s': %s", _path, ex)
+            return None
 
+    def _crawl_paths(self, paths) -> int:
+        _known_dirs, _crawled_dirs, _rescan_counts = {}, {}, {}
+        for p in paths:
+            _path = os.path.normpath(p)
+            assert _path.startswith('/')
+            assert not _path.endswith('/')
+            _known_dirs[_path] = self._dir_cache.get(_path, {})
+            _crawled_dirs[_path] = {}
+            _rescan_counts[_path] = 0
+
+        _t_start = _t_report = time.time()
+        _dir_count, _result_count = 0, 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._config.get('crawler_threads', 8)) as _pool:
+
+            # finished visits get merged by this thread only - in batches
+            # so the smartlists can take the new tracks in one go
+            _finished = queue.Queue()
+            _pending = {}
+
+            def visit(root, relpath):
+                _future = _pool.submit(self._visit_dir, root, relpath,
+                                       _known_dirs[root].get(relpath))
+                _pending[_future] = (root, relpath)
+                _future.add_done_callback(_finished.put)
+
+            for _root in _known_dirs:
+                visit(_root, '')
+
+            while _pending:
+                if self._crawl_stop.is_set():
+                    _pool.shutdown(wait=False, cancel_futures=True)
+                    break
+                _future = _finished.get()
+                with self._lock:
+                    _t_batch = time.time()
+                    while True:
+                        _root, _relpath = _pending.pop(_future)
+                        _result = _future.result()
+                        if _result is not None:
+                            _entry, _rescanned = _result
+                            _dir_count += 1
+                            _rescan_counts[_root] += _rescanned
+                            _crawled_dirs[_root][_relpath] = _entry
+                            for d in _entry[1]:
+                                visit(_root, os.path.join(_relpath, d))
+                            _result_count += self._add_dir(_root, _relpath, _entry)
+                        if (not _pending or
+                                time.time() - _t_batch > scheduler.CRAWL_BATCH_TIME):
+                            break
+                        try:
+                            _future = _finished.get_nowait()
+                        except queue.Empty:
+                            break
+                    self._catch_up_smartlists()
+
+                if time.time() - _t_report > scheduler.CRAWL_REPORT_INTERVAL:
+                    _t_report = time.time()
+                    log.info("crawled %d directories (%.0f/s), %d files (%.0f/s)",
+                             _dir_count, _dir_count / (_t_report - _t_start),
+                             _result_count, _result_count / (_t_report - _t_start))
+
+        if self._crawl_stop.is_set():
+            log.info("stopped crawling after %d directories", _dir_count)
+            return _result_count
+        for _root, _dirs in _crawled_dirs.items():
+            if (_rescan_counts[_root] > 0 or
+                    _dirs.keys() != _known_dirs[_root].keys()):
+                self._index_dirty = True
+            self._dir_cache[_root] = _dirs
+            self._crawled_roots.add(_root)
+            log.info("crawled %d directories in '%s', %d had to be rescanned",
+                     len(_dirs), _root, _rescan_counts[_root])
+        _duration = max(time.time() - _t_start, 1e-6)
+        log.info("crawled %d directories (%.0f/s) with %d files (%.0f/s)",
+                 _dir_count, _dir_count / _duration,
+                 _result_count, _result_count / _duration)
         return _result_count
+
+    def _add_dir(self, root: str, relpath: str, entry: tuple) -> int:
+        with self._lock:
+            _path_idx = self._get_name_component_index(root)
+            _relpath_idx = self._get_name_component_index(relpath)
+            if (_path_idx, _relpath_idx) in self._folder_lookup:
+                return 0
+            if not entry[2]:
+                return 0
+            self._add_folder(_path_idx, _relpath_idx, entry[2])
+            log.debug(relpath)
+            return len(entry[2])
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import string
+import unicodedata
+from array import array
+from collections import Counter
+
+# characters vanishing when folded, so "don't" becomes "dont"
+_APOSTROPHES = "'`´‘’"
+_ASCII_FOLDING = str.maketrans({c: '' if c in _APOSTROPHES else ' '
+                                for c in string.punctuation})
+# non-ASCII character -> folded form, filled on demand
+_FOLDED_CHARS = {}
+
+
+def _fold_char(char: str) -> str:
+    _result = _FOLDED_CHARS.get(char)
+    if _result is None:
+        _result = ''
+        for c in unicodedata.normalize('NFKD', char):
+            if unicodedata.combining(c):
+                continue
+            if c in _APOSTROPHES:
+                continue
+            _result += ' ' if unicodedata.category(c)[0] in 'PSZ' else c.lower()
+        _FOLDED_CHARS[char] = _result
+    return _result
+
+
+def fold(text: str) -> str:
+    ''' returns @text in lower case without accents and with punctuation
+        turned into spaces, e.g. "Beyoncé - Halo" becomes "beyonce   halo".
+        Characters get folded one by one so a substring of @text is still
+        a substring when both are folded. '''
+    _lowered = text.lower()
+    if _lowered.isascii():
+        return _lowered.translate(_ASCII_FOLDING)
+    return ''.join(_fold_char(c) for c in _lowered)
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    ''' returns the Levenshtein distance of @a and @b or @limit + 1 if it
+        exceeds @limit '''
+    _previous = list(range(len(b) + 1))
+    for i, _char in enumerate(a, 1):
+        _current = [i]
+        for j, _other in enumerate(b, 1):
+            _current.append(min(_previous[j] + 1, _current[j - 1] + 1,
+                                _previous[j - 1] + (_char != _other)))
+        if min(_current) > limit:
+            return limit + 1
+        _previous = _current
+    return min(_previous[-1], limit + 1)
+
+
+class search_index:
+    ''' Inverted trigram index over interned name components. Names are
+        indexed in their folded form (see fold()) so lookups return the
+        indices of all names containing a given substring without having
+        to look at every name.
+        search() also tolerates accents, punctuation and typos - the
+        latter by looking up similar words in a vocabulary of all words
+        of all names. Terms without spaces are resolved through the
+        vocabulary, too, since only words can contain them.
+    '''
+    GRAM_SIZE = 3
+
+    def __init__(self):
+        # trigram -> indices of names containing it (in insertion order)
+        self._grams = {}
+        # names too short to contain a single trigram
+        self._short = set()
+        # name index -> lower case name or None for names not indexed
+        self._lowered = []
+        # name index -> folded name, only for names which are not ASCII
+        self._folded = {}
+        self._count = 0
+        # word -> word id and back, number of names containing a word
+        self._word_ids = {}
+        self._words = []
+        self._word_counts = array('I')
+        # word id -> indices of names containing the word, cleaned up when
+        # they hold more than _word_counts of them
+        self._word_names = []
+        # trigram of a word padded with spaces -> ids of words containing it
+        self._word_grams = {}
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, index):
+        return index < len(self._lowered) and self._lowered[index] is not None
+
+    def lowered(self, index: int) -> str:
+        return self._lowered[index]
+
+    def folded(self, index: int) -> str:
+        _folded = self._folded.get(index)
+        if _folded is not None:
+            return _folded
+        return self._lowered[index].translate(_ASCII_FOLDING)
+
+    def add(self, index: int, name: str) -> None:
+        if index in self:
+            return
+        if index >= len(self._lowered):
+            self._lowered.extend((None,) * (index + 1 - len(self._lowered)))
+        _lowered = name.lower()
+        # most names are lower case already - don't store them twice
+        self._lowered[index] = name if _lowered == name else _lowered
+        _folded = fold(_lowered)
+        if not _lowered.isascii():
+            self._folded[index] = _folded
+        self._count += 1
+        for _word in set(_folded.split()):
+            self._add_word(_word, index)
+        if len(_folded) < search_index.GRAM_SIZE:
+            self._short.add(index)
+            return
+        for _gram in self._get_grams(_folded):
+            try:
+                self._grams[_gram].append(index)
+            except KeyError:
+                self._grams[_gram] = array('I', (index,))
+
+    def remove(self, index: int) -> None:
+        # posting lists are cleaned up lazily - lookups skip unknown indices
+        if index in self:
+            for _word in set(self.folded(index).split()):
+                self._word_counts[self._word_ids[_word]] -= 1
+            self._lowered[index] = None
+            self._folded.pop(index, None)
+            self._count -= 1
+        self._short.discard(index)
+
+    def find(self, term: str) -> set:
+        ''' returns the indices of all names containing @term '''
+        _term = term.lower()
+        _lowered = self._lowered
+        return {i for i in self._candidates(fold(_term))
+                if _term in (_lowered[i] or '')}
+
+    def search(self, term: str) -> dict:
+        ''' returns {name index: similarity} for all names containing
+            @term when both are folded (similarity 1) or - if there are
+            none - for all names containing a word similar to @term
+            (similarity < 1, depending on the number of typos) '''
+        return self.similarities(self.search_groups(term))
+
+    def search_groups(self, term: str) -> list:
+        ''' like search() but returns the matching names as (name indices,
+            similarity) pairs with the name indices being the posting lists
+            of the index itself, so they must not be modified. A name can
+            be part of several of them. '''
+        _term = fold(term).strip()
+        if not _term:
+            return []
+        if ' ' in _term:
+            _names = self._matching(self._candidates(_term), _term)
+            return [(_names, 1.)] if _names else []
+        _result = [(n, 1.) for n in self._word_postings(self._words_containing(_term))]
+        if _result:
+            return _result
+        for _word, _distance in self._similar_words(_term):
+            _score = 1. - _distance / len(_term)
+            _result.extend((n, _score) for n in
+                           self._word_postings(self._words_containing(_word)))
+        return _result
+
+    @staticmethod
+    def similarities(groups: list) -> dict:
+        ''' returns {name index: best similarity} for the (name indices,
+            similarity) pairs @groups returned by search_groups() '''
+        _result = {}
+        # better ones come last and replace worse ones
+        for _names, _score in sorted(groups, key=lambda g: g[1]):
+            _result.update(dict.fromkeys(_names, _score))
+        return _result
+
+    def _matching(self, candidates, folded_term: str) -> list:
+        ''' returns the @candidates containing @folded_term when folded '''
+        _lowered, _folded = self._lowered, self._folded
+        _result = []
+        for i in candidates:
+            _name = _lowered[i]
+            if _name is None:
+                continue
+            if i in _folded:
+                _name = _folded[i]
+            # folding ASCII names only replaces punctuation - which doesn't
+            # matter unless the term spans several words or the name has
+            # apostrophes which vanish
+            elif (folded_term not in _name and
+                  (' ' in folded_term or "'" in _name or '`' in _name)):
+                _name = _name.translate(_ASCII_FOLDING)
+            if folded_term in _name:
+                _result.append(i)
+        return _result
+
+    def _candidates(self, folded_term: str):
+        ''' returns the indices of names which might contain @folded_term '''
+        if len(folded_term) < search_index.GRAM_SIZE:
+            _result = set(self._short)
+            for _gram, _indices in self._grams.items():
+                if folded_term in _gram:
+                    _result.update(_indices)
+            return _result
+
+        # every name containing the term contains all of its trigrams - so
+        # the rarest one yields the smallest set of candidates to check
+        return min((self._grams.get(g, ()) for g in self._get_grams(folded_term)),
+                   key=len)
+
+    def _words_containing(self, folded_word: str) -> list:
+        ''' returns the ids of all words in use containing @folded_word '''
+        _words, _counts = self._words, self._word_counts
+        if len(folded_word) < search_index.GRAM_SIZE:
+            _ids = range(len(_words))
+        else:
+            _ids = min((self._word_grams.get(g, ())
+                        for g in self._get_grams(folded_word)), key=len)
+        return [i for i in _ids if _counts[i] and folded_word in _words[i]]
+
+    def _word_postings(self, word_ids: list) -> list:
+        ''' returns the indices of the names containing each of @word_ids '''
+        _result = []
+        for _id in word_ids:
+            if len(self._word_names[_id]) > self._word_counts[_id]:
+                # some of them have been removed (or removed and added again)
+                _lowered = self._lowered
+                self._word_names[_id] = array('I', sorted(
+                    {i for i in self._word_names[_id] if _lowered[i] is not None}))
+            _result.append(self._word_names[_id])
+        return _result
+
+    def _add_word(self, word: str, index: int) -> None:
+        _id = self._word_ids.get(word)
+        if _id is not None:
+            self._word_counts[_id] += 1
+            self._word_names[_id].append(index)
+            return
+        _id = len(self._words)
+        self._word_ids[word] = _id
+        self._words.append(word)
+        self._word_counts.append(1)
+        self._word_names.append(array('I', (index,)))
+        for _gram in self._get_grams(' %s ' % word):
+            try:
+                self._word_grams[_gram].append(_id)
+            except KeyError:
+                self._word_grams[_gram] = array('I', (_id,))
+
+    def _similar_words(self, word: str) -> list:
+        ''' returns (word, edit distance) for all known words close to
+            @word, allowing more typos for longer words '''
+        _limit = 0 if len(word) < 4 else 1 if len(word) < 8 else 2
+        if _limit == 0:
+            return []
+        _grams = self._get_grams(' %s ' % word)
+        # each typo breaks at most GRAM_SIZE trigrams
+        _needed = max(len(_grams) - search_index.GRAM_SIZE * _limit, 1)
+        _shared = Counter()
+        for _gram in _grams:
+            _shared.update(self._word_grams.get(_gram, ()))
+        _result = []
+        for _id, _count in _shared.items():
+            if _count < _needed or self._word_counts[_id] == 0:
+                continue
+            _other = self._words[_id]
+            if abs(len(_other) - len(word)) > _limit:
+                continue
+            _distance = edit_distance(word, _other, _limit)
+            if _distance <= _limit:
+                _result.append((_other, _distance))
+        return _result
+
+    @staticmethod
+    def _get_grams(name: str) -> set:
+        return {name[i:i + search_index.GRAM_SIZE]
+                for i in range(len(name) - search_index.GRAM_SIZE + 1)}
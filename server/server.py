@@ -8,6 +8,7 @@ import threading
 import time
 import argparse
 import json
+import zlib
 
 try:
     from espeak import espeak
@@ -15,6 +16,11 @@ except ImportError:
     espeak = None
 
 from scheduler import scheduler
+from control import control_channel
+from mplayer_output import mplayer_output
+import mixer
+import metadata
+from watcher import create_watcher
 import error
 
 import logging
@@ -38,6 +44,9 @@ class player:
         and filtering. If it needs a next file to play it informs a scheduler
         handler.
     '''
+    # seconds to wait for a track before checking whether to stop
+    FETCH_TIMEOUT = 1.
+
     class error(Exception):
         pass
 
@@ -45,8 +54,8 @@ class player:
         pass
 
     class backend_pygame:
-        def __init__(self, comm, handler):
-            self._comm = comm
+        def __init__(self, control, handler):
+            self._control = control
             self._handler = handler
 
         def __enter__(self):
@@ -55,6 +64,10 @@ class player:
             pygame.mixer.init()
             return self
 
+        def close(self):
+            import pygame
+            pygame.mixer.quit()
+
         def load_file(self, filename):
             import pygame
             try:
@@ -65,91 +78,300 @@ class player:
 
         def blocking_play(self):
             import pygame
-            self._comm['skip'] = False
+            pygame.mixer.music.set_volume(self._handler.handler_get_volume())
             pygame.mixer.music.play()
-            while pygame.mixer.music.get_busy() and not self._comm['skip']:
-                time.sleep(1)
-                #_notification_socket.send_json({
-                    #'type': 'tick',
-                    #'time': str(time.time())})
+            self._handler.handler_set_pause(False)
+            while pygame.mixer.music.get_busy() or self._handler.handler_get_pause():
+                # commands wake us up at once - the end can only be polled
+                if not self._control.wait(.5):
+                    continue
+                for _command in self._control.take():
+                    if _command == 'skip':
+                        pygame.mixer.music.stop()
+                        return
+                    elif _command == 'pause':
+                        if self._handler.handler_get_pause():
+                            pygame.mixer.music.unpause()
+                        else:
+                            pygame.mixer.music.pause()
+                        self._handler.handler_set_pause(
+                            not self._handler.handler_get_pause())
+                    elif _command == 'volume':
+                        pygame.mixer.music.set_volume(self._handler.handler_get_volume())
+                    elif _command == 'seek':
+                        pygame.mixer.music.set_pos(self._handler._seek_position)
 
     class backend_mplayer:
-        def __init__(self, comm, handler):
+        ''' Keeps one mplayer process running in idle slave mode and makes
+            it load one file after the other, so codecs and the audio
+            device stay initialized between tracks. A process which died
+            gets replaced with the next track.
+        '''
+
+        # seconds to wait for a track to start / to end after 'stop'
+        LOAD_TIMEOUT = 10.
+        STOP_TIMEOUT = 2.
+
+        def __init__(self, control, handler, args=(), progress_interval=1.):
             # We try to maintain as little state as possible in this class.
             # All needed state should be queried from self._handler
-            self._comm = comm
+            self._control = control
             self._handler = handler
+            # extra arguments, e.g. ('-ao', 'alsa')
+            self._args = list(args)
+            self._process = None
+            # seconds between two progress reports
+            self._progress_interval = progress_interval
+            self._output = mplayer_output(progress_interval)
 
         def __enter__(self):
             return self
 
         def __exit__(self, *args):
-            return
+            self.close()
 
-        def blocking_play(self):
+        def close(self):
             import subprocess
+            if self._process is None:
+                return
+            if self._process.poll() is None:
+                try:
+                    self._send('quit')
+                    self._process.wait(timeout=2.)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._process.kill()
+                    self._process.wait()
+            self._process = None
+
+        def blocking_play(self):
             import select
-            self._comm['skip'] = False
-            _process = subprocess.Popen(
-                args=['mplayer', '-slave', '-nolirc',
-                                              self._handler.handler_get_filename()],
+            self._start_process()
+            self._send('loadfile %s' % player.backend_mplayer._quoted(
+                self._handler.handler_get_filename()))
+            # with the gain of this track
+            self._send_volume()
+            # a new file starts unpaused
+            self._handler.handler_set_pause(False)
+            self._output.reset()
+
+            _stdout, _stderr = self._process.stdout.fileno(), self._process.stderr.fileno()
+            _control = self._control.fileno()
+            # 'loading' -> 'playing' (-> 'stopping' when skipped)
+            _state = 'loading'
+            _skip = False
+            _deadline = time.time() + player.backend_mplayer.LOAD_TIMEOUT
+            while True:
+                if self._process.poll() is not None:
+                    log.warning('mplayer exited with %d', self._process.returncode)
+                    return
+                if time.time() > _deadline:
+                    if _state == 'loading':
+                        raise player.file_load_error(
+                            'mplayer did not start "%s"'
+                            % self._handler.handler_get_filename())
+                    # it's idle anyway when the next file gets loaded
+                    return
+                if _skip and _state == 'playing':
+                    # wait for the end so its 'EOF' can't end the next track
+                    _state = 'stopping'
+                    self._send('stop')
+                    _deadline = time.time() + player.backend_mplayer.STOP_TIMEOUT
+                # nothing happens without output, a command or a timeout
+                _ready, _, _ = select.select(
+                    [_stdout, _stderr, _control], [], [],
+                    None if _deadline == float('inf') else max(_deadline - time.time(), 0.))
+                if _control in _ready:
+                    for _command in self._control.take():
+                        if _command == 'skip':
+                            _skip = True
+                        elif _command == 'pause':
+                            self._send('pause')
+                            self._handler.handler_set_pause(
+                                not self._handler.handler_get_pause())
+                        elif _command == 'volume':
+                            self._send_volume()
+                        elif _command == 'seek':
+                            self._send('seek %d 2' % self._handler._seek_position)
+                    if _skip and _state == 'playing':
+                        continue
+                if _stdout in _ready:
+                    _chunk = os.read(_stdout, 4096)
+                    if not _chunk:
+                        # mplayer is gone
+                        self._process.wait()
+                        continue
+                    for _line in self._output.feed(_chunk):
+                        if _line.startswith('Starting playback') and _state == 'loading':
+                            _state = 'playing'
+                            _deadline = float('inf')
+                        elif _line.startswith('EOF code:'):
+                            # one coming while loading belongs to the track before
+                            if _state != 'loading':
+                                return
+                        else:
+                            log.debug("[mplayer] %s", _line)
+                    _progress = self._output.progress()
+                    if _progress is not None and _state == 'playing':
+                        self._handler.handler_update_pos(*_progress)
+                if _stderr in _ready:
+                    _str = os.read(_stderr, 1000).decode(errors='replace').strip()
+                    if _str != "":
+                        log.warning("STDERR: '%s'", _str)
+                    if _state == 'loading' and ('Failed to open' in _str or
+                                         'Cannot open file' in _str):
+                        raise player.file_load_error(_str)
+
+        def _start_process(self):
+            import subprocess
+            if self._process is not None and self._process.poll() is None:
+                return
+            if self._process is not None:
+                log.warning('restart mplayer after it exited with %d',
+                            self._process.returncode)
+            self._output = mplayer_output(self._progress_interval)
+            # 'EOF code' lines (global=6) tell when a track has ended
+            self._process = subprocess.Popen(
+                args=['mplayer', '-slave', '-idle', '-nolirc',
+                      '-msglevel', 'global=6'] + self._args,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 stdin=subprocess.PIPE, bufsize=0)
 
-            _to_poll = [_process.stdout.fileno(), _process.stderr.fileno()]
-            while _process.poll() is None and not self._comm['skip']:
-                if self._comm['pause']:
-                    self._comm['pause'] = False
-                    _process.stdin.write('pause\n'.encode())
-                    self._handler.handler_set_pause(
-                        not self._handler.handler_get_pause())
-                if self._comm['volume']:
-                    self._comm['volume'] = False
-                    x = self._handler.handler_get_volume()
-                    x = 'volume %d 1\n' % (self._handler.handler_get_volume() * 100)
-                    print(x)
-                    _process.stdin.write(
-                        ('volume %d 1\n' % (self._handler.handler_get_volume() * 100)).encode())
-                if self._comm['seek']:
-                    self._comm['seek'] = False
-                    _process.stdin.write(
-                        ('seek %d 2\n' % self._handler._seek_position).encode())
-                for data in select.select(_to_poll, [], [], .2):
-                    if _process.stdout.fileno() in data:
-                        self._handle_output(
-                            _process.stdout.read(1000).decode(
-                                errors='replace'))
-                    if _process.stderr.fileno() in data:
-                        _str = _process.stderr.read(1000).decode(
-                            errors='replace').strip()
-                        if _str.strip() != "":
-                            log.warning("STDERR: '%s'", _str)
-
-            if _process.poll() is None:
-                _process.kill()
-
-        def _handle_output(self, line):
-            elems = line.strip().split()
-            if len(elems) == 0:
+        def _send_volume(self):
+            # mplayer can't go beyond 100% - louder tracks get turned down only
+            self._send('volume %d 1' % min(self._handler.handler_get_volume() * 100, 100))
+
+        def _send(self, command):
+            self._process.stdin.write((command + '\n').encode())
+
+        @staticmethod
+        def _quoted(path):
+            return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
+    class backend_mixer:
+        ''' Decodes tracks itself and mixes them with numpy, so they can
+            follow each other without a gap or crossfade '''
+        def __init__(self, control, handler, config):
+            self._control = control
+            self._handler = handler
+            self._config = config
+            self._decoder_command = config.get('decoder_command', mixer.decoder.COMMAND)
+            # the sink (e.g. the audio device) only gets opened for playing
+            self._sink = None
+            self._mixer = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+
+        def close(self):
+            if self._mixer is None:
                 return
-            if elems[0] == "A:":
-                try:
-                    self._handler.handler_update_pos(float(elems[1]), float(elems[4]))
-                except Exception as ex:
-                    log.error("EXCEPTION: %s", repr(ex))
-            else:
-                log.debug("[mplayer] %s", line)
-                log.debug("[mplayer] %s", str(elems))
+            self._mixer.finish()
+            self._sink.close()
+            self._sink, self._mixer = None, None
+
+        def blocking_play(self):
+            _path = self._handler.handler_get_filename()
+            self._handler.handler_set_pause(False)
+            if self._mixer is None:
+                _block_frames = self._config.get('mixer_block_frames', 4096)
+                self._sink = mixer.create_sink(self._config.get('mixer_sink', 'device'),
+                                               _block_frames)
+                self._mixer = mixer.pcm_mixer(
+                    self._sink, _block_frames, self._config.get('crossfade', 0.),
+                    self._config.get('crossfade_curve', 'equal_power'),
+                    self._config.get('progress_interval', 1.))
+            self._mixer.play(
+                lambda start: mixer.decoder(_path, start, self._decoder_command),
+                self._control, self._handler, metadata.read_length(_path))
+
+    class backend_null:
+        ''' Plays nothing but takes as long as playing would on a virtual
+            clock running @speedup times faster than the real one. A track
+            lasts between the @track_length (min, max) seconds - always the
+            same for the same file. Progress gets reported like the other
+            backends do, so scheduling and notifications can be soak tested
+            and profiled without audio.
+        '''
+        def __init__(self, control, handler, speedup=1., track_length=(120., 420.),
+                     progress_interval=1.):
+            self._control = control
+            self._handler = handler
+            self._speedup = speedup
+            self._track_length = track_length
+            # virtual seconds between two progress reports
+            self._progress_interval = progress_interval
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+
+        def close(self):
+            pass
+
+        def length(self, path):
+            _min, _max = self._track_length
+            return _min + (_max - _min) * (zlib.crc32(path.encode()) / 0xffffffff)
+
+        def blocking_play(self):
+            _length = self.length(self._handler.handler_get_filename())
+            self._handler.handler_set_pause(False)
+            _position = 0.
+            _next_report = 0.
+            _last = time.monotonic()
+            while _position < _length:
+                # report the scheduled positions, however late we woke up
+                while _position >= _next_report:
+                    self._handler.handler_update_pos(_next_report, _length)
+                    _next_report += self._progress_interval
+                _paused = self._handler.handler_get_pause()
+                _ready = self._control.wait(
+                    None if _paused else
+                    (min(_next_report, _length) - _position) / self._speedup)
+                _now = time.monotonic()
+                if not _paused:
+                    _position = min(_position + (_now - _last) * self._speedup, _length)
+                _last = _now
+                if _ready:
+                    for _command in self._control.take():
+                        if _command == 'skip':
+                            return
+                        elif _command == 'pause':
+                            self._handler.handler_set_pause(
+                                not self._handler.handler_get_pause())
+                        elif _command == 'seek':
+                            _position = min(max(
+                                float(self._handler.handler_get_seek_position()), 0.),
+                                _length)
+                            _next_report = _position
 
 
     def __init__(self, context, config):
-        self._comm = {}
-        self._backend = player.backend_mplayer(self._comm, self)
-        self._reset_comm()
+        self._control = control_channel()
+        _backend = config.get('player_backend', 'mplayer')
+        if _backend == 'mixer':
+            self._backend = player.backend_mixer(self._control, self, config)
+        elif _backend == 'null':
+            self._backend = player.backend_null(
+                self._control, self, config.get('null_speedup', 1.),
+                config.get('null_track_length', (120., 420.)),
+                config.get('progress_interval', 1.))
+        else:
+            self._backend = player.backend_mplayer(
+                self._control, self, config.get('mplayer_args', ()),
+                config.get('progress_interval', 1.))
+        # whether the current track got skipped
+        self._skipped = False
         self._config = config
         self._current_file = None
         self._pause = False
         self._volume = 1.0
+        # evens out the loudness of the current track
+        self._gain = 1.0
         self._seek_position = 0
         self._playing = False
         self._stop = False
@@ -157,14 +379,9 @@ class player:
         self._scheduler = None
         self._context = context
         self._last_pos = 0
+        self._track_length = 0
         self._notification_socket = None
 
-    def _reset_comm(self):
-        self._comm['skip'] = False
-        self._comm['pause'] = False
-        self._comm['volume'] = False
-        self._comm['seek'] = False
-
     def set_scheduler(self, scheduler_inst):
         assert hasattr(scheduler, 'get_next')
         self._scheduler = scheduler_inst
@@ -177,6 +394,8 @@ class player:
         if self._playing:
             self.resume()
             return
+        # not in the thread - stop() might come first
+        self._stop = False
         self._play_thread = threading.Thread(target=self._player_fn)
         self._play_thread.start()
         return True
@@ -191,54 +410,61 @@ class player:
 
     def _fetch(self):
         self._current_file = None
-        # todo: must know if there's nothing to play
-        while self._current_file is None:
-            self._current_file = self._scheduler.get_next()
+        while self._current_file is None and not self._stop:
+            # wakes up as soon as there's something to play
+            self._current_file = self._scheduler.get_next(
+                timeout=player.FETCH_TIMEOUT)
 
     def skip(self):
-        self._comm['skip'] = True
+        self._skipped = True
+        self._control.put('skip')
 
     def pause(self):
         if self._pause:
             return
-        self._comm['pause'] = True
+        self._control.put('pause')
 
     def resume(self):
         if not self._pause:
             return
-        self._comm['pause'] = True
+        self._control.put('pause')
 
     def toggle_pause(self):
-        self._comm['pause'] = True
+        self._control.put('pause')
 
     def volume_up(self):
         self._volume += .1
         if self._volume > 1.0: self._volume = 1.0
-        self._comm['volume'] = True
+        self._control.put('volume')
 
     def volume_down(self):
         self._volume -= .1
         if self._volume < 0.0: self._volume = 0.0
-        self._comm['volume'] = True
+        self._control.put('volume')
 
     def set_volume(self, value: float) -> None:
         self._volume = value
         if self._volume < 0.0: self._volume = 0.0
         if self._volume > 1.0: self._volume = 1.0
-        self._comm['volume'] = True
+        self._control.put('volume')
 
     def get_volume(self) -> float:
         return self._volume
 
     def seek(self, position: int):
         self._seek_position = position
-        self._comm['seek'] = True
+        self._control.put('seek')
 
     def current_track(self):
         return self._current_file
 
+    def control_latency(self) -> dict:
+        ''' returns how many commands the backend got and how long it took
+            (mean and max in seconds) '''
+        return self._control.latency()
+
     def handler_get_volume(self) -> float:
-        return self._volume
+        return self._volume * self._gain
 
     def handler_get_pause(self) -> bool:
         return self._pause
@@ -247,14 +473,17 @@ class player:
         self._pause = value
 
     def handler_update_pos(self, now, total):
-        if now - self._last_pos < 1.:
-            return
+        # the backend sends updates at the rate configured
+        self._track_length = total
         self._last_pos = now
         self._notification_socket.send_json({
             'type': 'now_playing',
             'current_pos': str(now),
             'track_length': str(total)})
 
+    def handler_get_seek_position(self) -> int:
+        return self._seek_position
+
     def handler_get_filename(self) -> str:
         return os.path.join(*self._current_file)
 
@@ -269,9 +498,10 @@ class player:
                 'type': 'hello from player'})
 
         self._playing = True
-        self._stop = False
         while not self._stop:
             self._fetch()
+            if self._current_file is None:
+                break
             self._notification_socket.send_json({
                 'type': 'now_playing',
                 'current_track': ':'.join(self._current_file)})
@@ -279,14 +509,25 @@ class player:
             log.info('play %s', os.path.join(*self._current_file[1:]))
 
             self._last_pos = 0
-            self._reset_comm()
-
+            self._track_length = 0
+            # measured in the background, nothing gets analysed now
+            self._gain = self._scheduler.get_gain(self._current_file)
+            # commands for the track before don't count anymore
+            self._control.clear()
+            self._skipped = False
+
+            _started = time.time()
             try:
                 self._backend.blocking_play()
             except Exception as ex:
                 log.error("an exception occured while playing: '%s'", repr(ex))
                 time.sleep(3)
+                continue
+            self._scheduler.record_played(
+                self._current_file, _started, self._last_pos, self._track_length,
+                skipped=self._skipped and not self._stop)
 
+        self._backend.close()
         self._playing = False
 
 class acquirer:
@@ -316,6 +557,8 @@ class server:
         self._config = config
         self._listeners = {}
         self._application_exit_request = False
+        # watches the library for changes once it has been crawled
+        self._watcher = None
         self._context = zmq.Context()
         self._player = player(self._context, config)
         self._scheduler = scheduler(config=config)
@@ -330,51 +573,80 @@ class server:
         return
 
     def run(self):
+        _crawler = None
+        try:
+            _req_socket = self._context.socket(zmq.ROUTER)
+            _req_socket.bind('tcp://*:9876')
+            _pub_socket = self._context.socket(zmq.PUB)
+            _pub_socket.bind('tcp://*:9875')  # todo: make random
+
+            _notification_socket = self._context.socket(zmq.PAIR)
+            _notification_socket.bind(self._config['notification_endpoint'])
+
+            _poller = zmq.Poller()
+            _poller.register(_req_socket, zmq.POLLIN)
+            _poller.register(_notification_socket, zmq.POLLIN)
+
+            _paths = []
+            for p in self._config ['input_dirs']:
+                _path = os.path.abspath(os.path.expanduser(p))
+                if not os.path.exists(_path):
+                    log.warning('input dir does not exist: "%s"', p)
+                    continue
+                log.info('add "%s"', _path)
+                _paths.append(_path)
+            # requests get answered while crawling - and the player waits
+            # for the first tracks if asked to play
+            _crawler = threading.Thread(target=self._crawl, args=(_paths,),
+                                        name='crawler')
+            _crawler.start()
+
+            # listeners count as gone when they haven't sent anything for so long
+            _presence_timeout = self._config.get('presence_timeout', 1800.)
+
+            while not self._application_exit_request:
+                log.debug('ready')
+                _events = _poller.poll(int(1000 * min(_presence_timeout, 60.)))
+                self._scheduler.expire_present_listeners(_presence_timeout)
+                for _source, _ in _events:
+                    if _source is _notification_socket:
+                        _message = _notification_socket.recv_json()
+                        _pub_socket.send_json(_message)
+                        log.debug("publish: '%s'", _message)
+
+                    elif _source is _req_socket:
+                        _client, _, _msg = _req_socket.recv_multipart()
+                        _request = zmq.utils.jsonapi.loads(_msg)
+                        _reply = self._handle_request(_client, _request)
+                        _req_socket.send_multipart(
+                            (_client, b'', zmq.utils.jsonapi.dumps(_reply)))
+        finally:
+            self._application_exit_request = True
+            if _crawler is not None:
+                self._scheduler.stop_crawling()
+                _crawler.join()
+            if self._watcher is not None:
+                self._watcher.stop()
+            # the player records plays with the scheduler so it goes first
+            self._player.stop()
+            # stores the no-repeat windows and the library index
+            self._scheduler.close()
+            # the player leaves its socket open
+            self._context.destroy(linger=0)
+
+    def _crawl(self, paths) -> None:
         _t = time.time()
-        _full_count = 0
-        for p in self._config ['input_dirs']:
-            _path = os.path.expanduser(p)
-            if not os.path.exists(_path):
-                log.warning('input dir does not exist: "%s"', p)
-                continue
-            log.info('add "%s"', _path)
-            _count = self._scheduler.add_path(_path)
-            _full_count += _count
-            log.info('%d files', _count)
+        _full_count = self._scheduler.add_paths(paths)
+        if self._application_exit_request:
+            return
         _t = time.time() - _t
         log.info('found a total of %d music tracks in %.1f sec', _full_count, _t)
+        self._scheduler.store_library_index()
         self._scheduler.debug_check()
 
-        _req_socket = self._context.socket(zmq.ROUTER)
-        _req_socket.bind('tcp://*:9876')
-        _pub_socket = self._context.socket(zmq.PUB)
-        _pub_socket.bind('tcp://*:9875')  # todo: make random
-
-        _notification_socket = self._context.socket(zmq.PAIR)
-        _notification_socket.bind(self._config['notification_endpoint'])
-
-        _poller = zmq.Poller()
-        _poller.register(_req_socket, zmq.POLLIN)
-        _poller.register(_notification_socket, zmq.POLLIN)
-
-        while not self._application_exit_request:
-            log.debug('ready')
-            for _source, _ in _poller.poll():
-                if _source is _notification_socket:
-                    _message = _notification_socket.recv_json()
-                    _pub_socket.send_json(_message)
-                    log.debug("publish: '%s'", _message)
-
-                elif _source is _req_socket:
-                    _client, _, _msg = _req_socket.recv_multipart()
-                    _request = zmq.utils.jsonapi.loads(_msg)
-                    _reply = self._handle_request(_client, _request)
-                    _req_socket.send_multipart(
-                        (_client, b'', zmq.utils.jsonapi.dumps(_reply)))
-
-        _req_socket.close()
-        _pub_socket.close()
-        self._context.close()
+        self._watcher = create_watcher(self._scheduler, self._config)
+        if self._watcher is not None:
+            self._watcher.start()
 
     def _handle_request(self, client_signature, request):
         log.info('request from %s',
@@ -404,6 +676,7 @@ class server:
 
                 _listener.user_id = request['user_id']
                 _listener.user_name = request['user_name']
+                self._scheduler.add_present_listener(_listener.user_id)
 
                 if espeak is not None:
                     espeak.synth("hello %s" % _listener.user_name)
@@ -422,8 +695,14 @@ class server:
                 raise error.not_identified("you're unknown. say hello first")
 
             log.info("listener '%s' sent '%s'", _listener.user_name, _command)
+            # any request but 'bye' keeps a listener present
+            if _command != 'bye':
+                self._scheduler.add_present_listener(_listener.user_id)
 
-            if _command == 'play':
+            if _command == 'heartbeat':
+                return {'type': 'ok'}
+
+            elif _command == 'play':
                 self._player.play()
                 return {'type': 'ok'}
 
@@ -480,7 +759,60 @@ class server:
 
             elif _command == 'schedule':
                 log.info('got "schedule" request: %s', request)
-                self._scheduler.schedule_next_item(request['item'])
+                _votes = self._scheduler.schedule_next_item(
+                    request['item'], _listener.user_id)
+                return {'type': 'ok', 'votes': _votes}
+
+            elif _command == 'vote_wish':
+                log.info('got "vote_wish" request: %s', request)
+                _votes = self._scheduler.vote_wish(
+                    request['item'], _listener.user_id)
+                return {'type': 'ok', 'votes': _votes}
+
+            elif _command == 'list_wishes':
+                log.info('got "list_wishes" request: %s', request)
+                _wishes = self._scheduler.list_wishes(
+                    int(request['count']) if 'count' in request else None)
+                _wishes = (':'.join((str(i) for i in e)) for e in _wishes)
+                return {'type': 'ok',
+                        'result': '|'.join(_wishes)}
+
+            elif _command == 'upcoming':
+                log.info('got "upcoming" request: %s', request)
+                _upcoming = self._scheduler.list_upcoming(
+                    int(request['count']) if 'count' in request else None)
+                _upcoming = (':'.join((str(i) for i in e)) for e in _upcoming)
+                return {'type': 'ok',
+                        'result': '|'.join(_upcoming)}
+
+            elif _command == 'top_played':
+                log.info('got "top_played" request: %s', request)
+                _top = self._scheduler.top_played(
+                    int(request.get('count', 50)), float(request.get('days', 7)))
+                _top = (':'.join((str(i) for i in e)) for e in _top)
+                return {'type': 'ok',
+                        'result': '|'.join(_top)}
+
+            elif _command == 'skip_rates':
+                log.info('got "skip_rates" request: %s', request)
+                _rates = self._scheduler.skip_rates(
+                    int(request.get('count', 50)),
+                    float(request['days']) if 'days' in request else None,
+                    int(request.get('min_plays', 3)))
+                _rates = (':'.join((str(i) for i in e)) for e in _rates)
+                return {'type': 'ok',
+                        'result': '|'.join(_rates)}
+
+            elif _command == 'control_latency':
+                _latency = self._player.control_latency()
+                return {'type': 'ok',
+                        'count': _latency['count'],
+                        'mean': _latency['mean'],
+                        'max': _latency['max']}
+
+            elif _command == 'bye':
+                log.info("listener '%s' left", _listener.user_name)
+                self._scheduler.remove_present_listener(_listener.user_id)
                 return {'type': 'ok'}
 
             elif _command == 'quit':
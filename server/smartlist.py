@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from sampler import weighted_sampler
+from bitset import bitset
+
+
+class smartlist:
+    ''' The rules of one smartlist together with everything the scheduler
+        derives from them: which tracks are banned and how likely each of
+        the others gets picked. The scheduler keeps this state up to date
+        for every loaded smartlist so switching between them is instant.
+    '''
+
+    # rough size of a parsed rule including its strings
+    RULE_SIZE = 400
+
+    def __init__(self, name: str, rule_journal, rules: list,
+                 redundant_lines: int, malformed_lines: list=()) -> None:
+        self.name = name
+        self.journal = rule_journal
+        self.rules = rules
+        # journal lines which aren't rules, they survive compaction
+        self.malformed_lines = list(malformed_lines)
+        # journal lines which would vanish on compaction
+        self.redundant_lines = redundant_lines
+        # (listener, subject) of all ban rules
+        self.ban_subjects = {(r.listener, r.tag_string)
+                             for r in rules if r.tag_name == 'ban'}
+        self.ban_matcher = None
+        # listener -> bitset of the tracks banned by this listener
+        self.listener_bans = {}
+        # track index -> 1 if banned for the listeners present
+        self.banned = bytearray()
+        # selection weight per track index, 0 for banned tracks
+        self.sampler = weighted_sampler()
+        self.upvote_weights = None
+        self.weights_time = 0.
+        # upvotes have to be collected again and weights recomputed
+        self.stale = False
+
+    def __str__(self):
+        return 'smartlist("%s", %d rules)' % (self.name, len(self.rules))
+
+    def bans_of(self, listener: str) -> bitset:
+        ''' returns the tracks banned by @listener '''
+        _bans = self.listener_bans.get(listener)
+        if _bans is None:
+            _bans = self.listener_bans[listener] = bitset()
+        return _bans
+
+    def memory_usage(self) -> int:
+        ''' returns an estimate of the bytes this smartlist occupies '''
+        # one byte per track for banned, two doubles for the sampler
+        _result = len(self.banned) * 17 + len(self.rules) * smartlist.RULE_SIZE
+        _result += sum(b.nbytes() for b in self.listener_bans.values())
+        if self.upvote_weights is not None:
+            _result += len(self.upvote_weights) * 24
+        return _result
@@ -2,16 +2,37 @@
 # -*- coding: utf-8 -*-
 
 from scheduler import scheduler
+import scheduler as scheduler_module
+from ban_matcher import ban_matcher
+from sampler import weighted_sampler
+from weighting import numpy
+from watcher import polling_watcher, inotify_watcher, create_watcher
+from wishlist import wishlist
+from journal import journal
+from bitset import bitset
+from search_index import fold, edit_distance
+import metadata
+import loudness
+from affinity import affinity_graph
+from lookahead import warm_page_cache
+from recent import recent_window, recently_played
+import history
+import error
 import os
 import sys
 import time
 import shutil
+import random
+import tempfile
+import threading
 
 CONFIG = {'music_file_pattern':    (".mp3", ".mp4", ".m4a",
                                     ".ogg", ".opus", ),
           'input_dirs':            (os.path.dirname(__file__),),
-          'playlist_folder':       './lists',
+          'playlist_folder':       os.path.join(tempfile.mkdtemp(), 'lists'),
           'notification_endpoint': 'inproc://step2',
+          'read_metadata':         False,
+          'analyze_loudness':      False,
           }
 
 def test_rule():
@@ -39,9 +60,9 @@ def test_rule():
 
 def test_scheduler():
 
-    if os.path.isdir('./lists'):
+    if os.path.isdir(CONFIG['playlist_folder']):
         print('remove playlist folder')
-        shutil.rmtree('./lists')
+        shutil.rmtree(CONFIG['playlist_folder'])
 
     with scheduler(config=CONFIG) as s:
         lists = s.get_smartlists()
@@ -80,7 +101,885 @@ def test_scheduler():
 
         #def _crawl_path(self, path=None):
 
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+def test_library_index():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'artist1', 'album1', 'track1.mp3'))
+        _touch(os.path.join(_music, 'artist1', 'album1', 'cover.jpg'))
+        _touch(os.path.join(_music, 'artist2', 'track2.ogg'))
+        _more_music = os.path.join(_tmp, 'more_music')
+        for i in range(50):
+            _touch(os.path.join(_more_music, 'folder%d' % i, 'sub', 'track.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       crawler_threads=4)
+
+        with scheduler(config=_config) as s:
+            assert s.add_path(_music) == 2
+        assert os.path.exists(os.path.join(_tmp, 'library_index'))
+
+        _touch(os.path.join(_music, 'artist2', 'track3.opus'))
+        with scheduler(config=_config) as s:
+            assert len(s._dir_cache[_music]) == 4
+            assert s.add_path(_music) == 3
+            _files = sorted(s._get_track(t)[2] for t in range(len(s._track_name)))
+            assert _files == ['track1.mp3', 'track2.ogg', 'track3.opus']
+
+            assert s.add_paths((_music, _more_music)) == 50
+            assert len(s._dir_cache[_more_music]) == 101
+            assert len(s._folder_lookup) == 52
+            # the smartlists take the crawled tracks in batches
+            for l in s._loaded.values():
+                assert len(l.banned) == len(l.sampler) == 53
+                assert l.sampler.total() == 53.
+
+        # a crawl stopped early leaves the library index as it has been
+        with scheduler(config=_config) as s:
+            s.stop_crawling()
+            assert s.add_path(_more_music) == 0
+            assert len(s._dir_cache[_more_music]) == 101
+
+
+def _search_variants():
+    ''' yields once for scoring all tracks with numpy, once for scoring
+        only those using a matching name and once for doing without '''
+    _numpy, _fraction = scheduler_module.numpy, scheduler.SEARCH_SCAN_FRACTION
+    try:
+        for scheduler_module.numpy, scheduler.SEARCH_SCAN_FRACTION in (
+                (_numpy, 0.), (_numpy, float('inf')), (None, 0.)):
+            yield
+    finally:
+        scheduler_module.numpy, scheduler.SEARCH_SCAN_FRACTION = _numpy, _fraction
+
+
+def test_search_filenames():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'Daft Punk', 'Discovery', 'One More Time.mp3'))
+        _touch(os.path.join(_music, 'Daft Punk', 'Discovery', 'Aerodynamic.mp3'))
+        _touch(os.path.join(_music, 'Various', 'Punk Rock.ogg'))
+        _touch(os.path.join(_music, 'Various', 'ab.ogg'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            for _ in _search_variants():
+                _result = s.search_filenames('punk time')
+                assert _result[0][1:] == ('Daft Punk/Discovery/One More Time.mp3', 2)
+                assert sorted(e[1] for e in _result[1:]) == [
+                    'Daft Punk/Discovery/Aerodynamic.mp3', 'Various/Punk Rock.ogg']
+                assert [e[1] for e in s.search_filenames('B.O')] == ['Various/ab.ogg']
+                assert s.search_filenames('nothing') == []
+                assert len(s.search_filenames('o', count=3)) == 3
+                _result = s.search_filenames('discovery', count=1)
+                assert len(_result) == 1
+                assert _result[0][1].startswith('Daft Punk/Discovery/')
+
+            # removed files don't show up
+            os.remove(os.path.join(_music, 'Various', 'Punk Rock.ogg'))
+            s.refresh_dirs([(_music, 'Various')])
+            for _ in _search_variants():
+                assert [e[1] for e in s.search_filenames('various')] == [
+                    'Various/ab.ogg']
+                assert s.search_filenames('rock') == []
+                assert sorted(e[1] for e in s.search_filenames('punk')) == [
+                    'Daft Punk/Discovery/Aerodynamic.mp3',
+                    'Daft Punk/Discovery/One More Time.mp3']
+
+            # until they come back
+            _touch(os.path.join(_music, 'Various', 'Punk Rock.ogg'))
+            s.refresh_dirs([(_music, 'Various')])
+            for _ in _search_variants():
+                assert [e[1] for e in s.search_filenames('rock')] == [
+                    'Various/Punk Rock.ogg']
+
+
+def test_fuzzy_search():
+    assert fold('Beyoncé - Halo (Live)') == 'beyonce   halo  live '
+    assert fold("Don't") == 'dont'
+    assert edit_distance('electrik', 'electric', 2) == 1
+    assert edit_distance('abc', 'xyz', 1) == 2
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'Beyoncé', 'Halo.mp3'))
+        _touch(os.path.join(_music, 'Daft Punk', 'One More Time.mp3'))
+        _touch(os.path.join(_music, 'Various', 'Electric Feel.mp3'))
+        _touch(os.path.join(_music, 'Various', 'Über Café.ogg'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+
+            def paths(query):
+                return [e[1] for e in s.search_filenames(query)]
+
+            assert paths('beyonce halo') == ['Beyoncé/Halo.mp3']
+            assert paths('daft-punk') == ['Daft Punk/One More Time.mp3']
+            assert paths('uber') == ['Various/Über Café.ogg']
+            assert paths('ELECTRIK') == ['Various/Electric Feel.mp3']
+            assert s.search_filenames('electrik')[0][2] == 1. - 1. / 8
+            # exact hits don't get mixed up with similar ones
+            assert paths('feel') == ['Various/Electric Feel.mp3']
+            assert paths('xyz') == []
+            # the exact substring search used by rules doesn't fold
+            assert s._search_index.find('beyonce') == set()
+            assert len(s._search_index.find('beyoncé')) == 1
+
+
+def test_ban_matcher():
+    _names = ['WORKFLOW/fresh_moods [Elektrolux]', 'reykjavik', 'other/dir',
+              'fresh moods-love, death, angels-07-one two.mp3',
+              'Worakls - From Now On-1fcOQ6YbL9Q.opus',
+              'nu - man o to (original mix).wmv-ksmebecxzya.m4a', 'x.ogg']
+    _rules = [scheduler.rule(listener='frans', tag_name='ban', tag_string=t)
+              for t in ('workflow', 'reykjavik/nu - man o to',
+                        'reykjavik/nu - man o to (original mix).wmv-ksmebecxzya.m4a',
+                        '/x.ogg', 'other/', 'ogg')]
+    m = ban_matcher([], lambda i: _names[i].lower())
+    for r in _rules:
+        m.add_rule(r)
+        for _folder in range(3):
+            for _file in range(3, len(_names)):
+                _expected = [e for e in _rules[:len(m)]
+                             if e.matches(_names[_folder], _names[_file])]
+                assert m.banning_rules(_folder, _file) == _expected
+
+
+def test_weighted_sampler():
+    s = weighted_sampler((1., 0., 2.))
+    for w in (0., 3., 0., 0., 1.):
+        s.append(w)
+    s.set(2, 0.)
+    assert s.total() == 5.
+    _counts = [0] * len(s)
+    for _ in range(5000):
+        _counts[s.sample()] += 1
+    assert _counts[1] == _counts[2] == _counts[3] == _counts[5] == _counts[6] == 0
+    assert 800 < _counts[0] < 1200 and 800 < _counts[7] < 1200
+    assert 800 < _counts[4] / 3 < 1200
+
+    for i in range(len(s)):
+        s.set(i, 0.)
+    assert s.sample() is None
+    assert weighted_sampler().sample() is None
+
+    # fractional weights leave rounding errors behind when they get banned
+    _rnd = random.Random(1)
+    s = weighted_sampler([_rnd.random() / 7 for _ in range(1000)])
+    _order = list(range(1000))
+    _rnd.shuffle(_order)
+    for i in _order[:-1]:
+        s.set(i, 0.)
+    assert {s.sample(_rnd) for _ in range(200)} == {_order[-1]}
+    s.set(_order[-1], 0.)
+    assert all(s.sample(_rnd) is None for _ in range(200))
+
+    # appending in bulk builds the same tree
+    _weights = [_rnd.choice((0., 1., 2.5)) for _ in range(100)]
+    for n in (0, 1, 37, 64, 100):
+        s = weighted_sampler(_weights[:n])
+        s.extend(_weights[n:])
+        assert s._tree == weighted_sampler(_weights)._tree
+        assert s.total() == sum(_weights) and len(s) == 100
+
+
+def test_get_next():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'keep', 'track1.mp3'))
+        _touch(os.path.join(_music, 'drop', 'track2.mp3'))
+        _touch(os.path.join(_music, 'drop', 'track3.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _some_track = (_music, 'keep', 'track1.mp3')
+            s.add_tag(listener='frans', track=_some_track, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'drop'})
+            assert {s.get_next() for _ in range(20)} == {_some_track}
+
+            s.add_tag(listener='frans', track=_some_track, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'keep/track1.mp3'})
+            _t = time.time()
+            assert s.get_next() is None
+            assert time.time() - _t < 2
+
+            s.activate_smartlist('party')
+            assert s.get_next() is not None
+            s.activate_smartlist('unspecified')
+            assert s.get_next() is None
+
+
+def test_wait_for_next():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'a', 'track.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+        with scheduler(config=_config) as s:
+            _t = time.time()
+            assert s.get_next() is None
+            assert s.get_next(timeout=.1) is None
+            assert .1 <= time.time() - _t < 1.
+
+            # waiting callers get woken up by the crawl
+            _result = []
+            _waiter = threading.Thread(
+                target=lambda: _result.append(s.get_next(timeout=10.)))
+            _waiter.start()
+            time.sleep(.1)
+            _t = time.time()
+            s.add_path(_music)
+            _waiter.join()
+            assert time.time() - _t < 1.
+            assert _result == [(_music, 'a', 'track.mp3')]
+
+            # ... and by wishes
+            s.add_tag(listener='frans', track=_result[0], pos=0,
+                      details={'tag_name': 'ban', 'subject': 'a'})
+            assert s.get_next() is None
+            _result = []
+            _waiter = threading.Thread(
+                target=lambda: _result.append(s.get_next(timeout=10.)))
+            _waiter.start()
+            time.sleep(.1)
+            _t = time.time()
+            s.schedule_next_item(s.search_filenames('track')[0][0])
+            _waiter.join()
+            assert time.time() - _t < 1.
+            assert _result == [(_music, 'a', 'track.mp3')]
+
+
+def test_upvote_weighting():
+    if numpy is None:
+        print('numpy is not available - skip')
+        return
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        for i in range(10):
+            _touch(os.path.join(_music, 'folder', 'track%d.mp3' % i))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       scheduling_mode='upvotes', upvote_boost=9.,
+                       upvote_absent_factor=0.)
+
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _favorite = (_music, 'folder', 'track3.mp3')
+            s.add_present_listener('frans')
+            s.add_tag(listener='frans', track=_favorite, pos=1,
+                      details={'tag_name': 'upvote'})
+            # 10 of 19 shares go to the upvoted track
+            assert abs(s._list.sampler.total() - 19.) < 1e-3
+            assert sum(s.get_next() == _favorite for _ in range(1000)) > 400
+
+            s.remove_present_listener('frans')
+            assert s._list.sampler.total() == 10.
+
+            s.add_present_listener('frans')
+            s.activate_smartlist('party')
+            s.activate_smartlist('unspecified')
+            assert abs(s._list.sampler.total() - 19.) < 1e-3
+            s.set_scheduling_mode('uniform')
+            assert s._list.sampler.total() == 10.
+
+
+def _library_files(s):
+    return sorted(os.path.join(*s._get_track(t)[1:])
+                  for t in range(len(s._track_name)) if s._track_name[t] >= 0)
+
+
+def _change_library(music):
+    _touch(os.path.join(music, 'a', 'new.mp3'))
+    os.rename(os.path.join(music, 'a', 'old.mp3'),
+              os.path.join(music, 'a', 'renamed.mp3'))
+    shutil.rmtree(os.path.join(music, 'b'))
+    _touch(os.path.join(music, 'c', 'd', 'e.ogg'))
+
+
+def test_watcher():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'a', 'old.mp3'))
+        _touch(os.path.join(_music, 'b', 'sub', 'gone.mp3'))
+        _touch(os.path.join(_music, 'b', 'gone.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       library_watcher='poll')
+
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            assert isinstance(create_watcher(s, _config), polling_watcher)
+            _watcher = polling_watcher(s)
+            assert _watcher.poll() == 0
+            # make sure changed directories get a new mtime
+            time.sleep(.01)
+            _change_library(_music)
+            assert _watcher.poll() == 0
+            assert _library_files(s) == ['a/new.mp3', 'a/renamed.mp3', 'c/d/e.ogg']
+            assert [e[1] for e in s.search_filenames('gone')] == []
+            assert [e[1] for e in s.search_filenames('renamed')] == ['a/renamed.mp3']
+            assert {s.get_next()[2] for _ in range(50)} == {
+                'new.mp3', 'renamed.mp3', 'e.ogg'}
+
+        with scheduler(config=_config) as s:
+            assert s.add_path(_music) == 3
+            try:
+                _watcher = inotify_watcher(s, delay=.1)
+            except inotify_watcher.unavailable:
+                print('inotify is not available - skip')
+                return
+            _watcher.start()
+            try:
+                shutil.rmtree(os.path.join(_music, 'c'))
+                _touch(os.path.join(_music, 'b', 'back.mp3'))
+                for _ in range(50):
+                    if _library_files(s) == ['a/new.mp3', 'a/renamed.mp3',
+                                             'b/back.mp3']:
+                        break
+                    time.sleep(.1)
+                assert _library_files(s) == ['a/new.mp3', 'a/renamed.mp3',
+                                             'b/back.mp3']
+            finally:
+                _watcher.stop()
+
+
+def test_changed_folder():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        for i in range(100):
+            _touch(os.path.join(_music, 'a', '%02d.mp3' % i))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _wish = s.search_filenames('05.mp3')[0][0]
+            s.schedule_next_item(_wish)
+            _watcher = polling_watcher(s)
+            time.sleep(.01)
+            _touch(os.path.join(_music, 'a', 'new.mp3'))
+            os.remove(os.path.join(_music, 'a', '07.mp3'))
+            _watcher.poll()
+            # only the changed files got new tracks or were removed
+            assert len(s._track_name) == 101
+            assert s.search_filenames('05.mp3')[0][0] == _wish
+            assert [e[1] for e in s.search_filenames('new.mp3')] == ['a/new.mp3']
+            assert 'a/07.mp3' not in [e[1] for e in s.search_filenames('07.mp3')]
+            assert len(_library_files(s)) == 100
+            assert s.get_next() == (_music, 'a', '05.mp3')
+
+            # tracks added to a folder get checked against the bans
+            s.add_tag(listener='frans', track=(_music, 'a', 'new.mp3'), pos=0,
+                      details={'tag_name': 'ban', 'subject': 'fresh'})
+            time.sleep(.01)
+            _touch(os.path.join(_music, 'a', 'fresh.mp3'))
+            _watcher.poll()
+            assert len(_library_files(s)) == 101
+            assert 'fresh.mp3' not in {s.get_next()[2] for _ in range(300)}
+
+
+def test_wishlist():
+    w = wishlist()
+    assert w.pop() is None
+    assert w.add(10, 'frans', 1.) == 1
+    assert w.add(11, 'frans', 2.) == 1
+    assert w.add(12, 'frans', 3.) == 1
+    assert w.add(12, 'julia') == 2
+    assert w.vote(12, 'julia') == 2
+    assert w.vote(11, 'julia') == 2
+    assert [e[:2] for e in w.items()] == [(11, 2), (12, 2), (10, 1)]
+    assert len(w) == 3
+    for _ in range(100):
+        w.vote(10, 'frans')
+    assert [w.pop(), w.pop(), w.pop(), w.pop()] == [11, 12, 10, None]
+    try:
+        w.vote(10, 'frans')
+        assert False
+    except wishlist.unknown_wish:
+        pass
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'a', 'wish1.mp3'))
+        _touch(os.path.join(_music, 'a', 'wish2.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _wish1 = s.search_filenames('wish1')[0][0]
+            _wish2 = s.search_filenames('wish2')[0][0]
+            s.schedule_next_item(_wish1, 'frans')
+            s.schedule_next_item(_wish2, 'frans')
+            assert s.vote_wish(_wish2, 'julia') == 2
+            assert s.list_wishes() == [(_wish2, 'a/wish2.mp3', 2),
+                                       (_wish1, 'a/wish1.mp3', 1)]
+            assert s.get_next() == (_music, 'a', 'wish2.mp3')
+            os.remove(os.path.join(_music, 'a', 'wish1.mp3'))
+            # wish1 is ahead but gone
+            s.schedule_next_item(_wish2, 'frans')
+            assert s.get_next() == (_music, 'a', 'wish2.mp3')
+            for _item in ('1/2', '99/99/99'):
+                try:
+                    s.schedule_next_item(_item, 'frans')
+                    assert False
+                except error.invalid_value:
+                    pass
+
+
+def test_journal():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _path = os.path.join(_tmp, 'journal')
+        with journal(_path) as j:
+            assert j.read() == []
+            j.append('a')
+            j.append('b')
+        # a line we did not finish writing
+        with open(_path, 'a') as _f:
+            _f.write('c')
+        with journal(_path) as j:
+            assert j.read() == ['a', 'b', 'c']
+            j.append('d')
+            j.compact(['b'])
+            j.append('e')
+        assert journal(_path).read() == ['b', 'e']
+
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'dull', 'track.mp3'))
+        _touch(os.path.join(_music, 'b', 'track.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _track = s.get_next()
+            for _ in range(2):
+                s.add_tag(listener='frans', track=_track, pos=1,
+                          details={'tag_name': 'ban', 'subject': 'dull'})
+            s.add_tag(listener='frans', track=(_music, 'b', 'track.mp3'),
+                      pos=1, details={'tag_name': 'upvote'})
+            # subjects may contain commas
+            s.add_tag(listener='frans', track=(_music, 'b', 'track.mp3'),
+                      pos=1, details={'tag_name': 'ban', 'subject': 'x, y'})
+        _list = os.path.join(_tmp, 'lists', 'unspecified')
+        with open(_list, 'a') as _f:
+            _f.write('1.000, frans, ban')
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _rules = s._list.rules
+            assert [(r.tag_name, r.tag_string) for r in _rules] == [
+                ('ban', 'dull'), ('ban', 'dull'), ('upvote', 'b/track.mp3'),
+                ('ban', 'x, y')]
+            assert s._list.redundant_lines == 1
+            assert s.get_next() == (_music, 'b', 'track.mp3')
+            # redundant lines still count while a compaction is running
+            _journal = s._list.journal
+            _journal._compaction_thread = threading.current_thread()
+            s._compact_journal()
+            assert s._list.redundant_lines == 1
+            _journal._compaction_thread = None
+            s._compact_journal()
+            assert s._list.redundant_lines == 0
+        # malformed lines are kept so they can be repaired by hand
+        assert journal(_list).read() == ['1.000, frans, ban'] + [
+            _rules[i].to_line() for i in (0, 2, 3)]
+
+
+def test_smartlists():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'loud', 'track1.mp3'))
+        _touch(os.path.join(_music, 'quiet', 'track2.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+        with scheduler(config=_config) as s:
+            assert len(s._loaded) == 4
+            s.activate_smartlist('concentration')
+            s.add_tag(listener='frans', track=None, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'loud'})
+            s.activate_smartlist('party')
+            s.add_tag(listener='frans', track=None, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'quiet'})
+            # tracks found later get checked against all loaded smartlists
+            s.add_path(_music)
+            assert s.get_next() == (_music, 'loud', 'track1.mp3')
+            _concentration = s._loaded['concentration']
+            s.activate_smartlist('concentration')
+            assert s._list is _concentration
+            assert s.get_next() == (_music, 'quiet', 'track2.mp3')
+
+        _config['smartlist_memory_limit'] = 0
+        _config['scheduling_mode'] = 'upvotes' if numpy is not None else 'uniform'
+        with scheduler(config=_config) as s:
+            # empty smartlists don't take memory
+            assert 'concentration' not in s._loaded
+            s.add_path(_music)
+            s.activate_smartlist('concentration')
+            assert list(s._loaded) == ['concentration']
+            assert s.get_next() == (_music, 'quiet', 'track2.mp3')
+
+        _config['smartlist_memory_limit'] = 256
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            s.add_present_listener('frans')
+            # inactive smartlists get updated in the background
+            for _ in range(50):
+                with s._lock:
+                    if not any(l.stale for l in s._loaded.values()):
+                        break
+                time.sleep(.1)
+            assert not any(l.stale for l in s._loaded.values())
+
+
+def test_listener_bans():
+    b = bitset((1, 9, 30))
+    assert 9 in b and 8 not in b and 1000 not in b
+    assert b.count() == 3
+    u = bitset.union((b, bitset((2,)), bitset()))
+    assert u.unpack(12) == bytearray((0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0))
+    assert len(u.unpack(40)) == 40
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        for _dir in ('loud', 'quiet', 'other'):
+            _touch(os.path.join(_music, _dir, 'track.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'))
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            s.add_tag(listener='frans', track=None, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'loud'})
+            s.add_tag(listener='julia', track=None, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'quiet'})
+            # a ban by somebody else is not a repeated one
+            s.add_tag(listener='julia', track=None, pos=1,
+                      details={'tag_name': 'ban', 'subject': 'loud'})
+            assert s._list.redundant_lines == 0
+
+            def eligible():
+                return {s._get_track(t)[1] for t in range(len(s._track_name))
+                        if not s._list.banned[t]}
+
+            # nobody's there - all bans count
+            assert eligible() == {'other'}
+            s.add_present_listener('frans')
+            assert eligible() == {'quiet', 'other'}
+            s.add_present_listener('peter')
+            assert eligible() == {'quiet', 'other'}
+            s.remove_present_listener('frans')
+            assert eligible() == {'loud', 'quiet', 'other'}
+            s.add_present_listener('julia')
+            assert eligible() == {'other'}
+
+            # somebody without bans doesn't make a difference
+            _weights_time = s._list.weights_time
+            s.add_present_listener('bob')
+            assert s._list.weights_time == _weights_time
+
+            # listeners not heard of for a while are gone
+            s.expire_present_listeners(60.)
+            assert s.present_listeners() == {'peter', 'julia', 'bob'}
+            s._last_seen['julia'] -= 100.
+            s.expire_present_listeners(60.)
+            assert s.present_listeners() == {'peter', 'bob'}
+            assert eligible() == {'loud', 'quiet', 'other'}
+
+
+def _tag(path, **tags):
+    _id3 = metadata.mutagen.easyid3.EasyID3()
+    _id3.update(tags)
+    _id3.save(path)
+
+
+def test_metadata():
+    if metadata.mutagen is None:
+        print('skip test_metadata() - mutagen is not installed')
+        return
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        _touch(os.path.join(_music, 'a', 'song.mp3'))
+        _touch(os.path.join(_music, 'a', 'untagged.mp3'))
+        _touch(os.path.join(_music, 'a', 'broken.ogg'))
+        _tag(os.path.join(_music, 'a', 'song.mp3'),
+             artist='Artist', album='Album', title='Title')
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       read_metadata=True, metadata_processes=2)
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            s._metadata.wait()
+            assert s.get_metadata((_music, 'a', 'song.mp3')) == {
+                'artist': 'Artist', 'album': 'Album', 'title': 'Title'}
+            assert s.get_metadata((_music, 'a', 'untagged.mp3')) == {}
+            assert s.get_metadata((_music, 'a', 'broken.ogg')) == {}
+        assert os.path.exists(os.path.join(_tmp, 'metadata_cache'))
+
+        _tag(os.path.join(_music, 'a', 'untagged.mp3'), title='Later')
+        with scheduler(config=_config) as s:
+            # known from the cache right away
+            assert s.get_metadata((_music, 'a', 'song.mp3'))['title'] == 'Title'
+            s.add_path(_music)
+            s._metadata.wait()
+            assert s.get_metadata((_music, 'a', 'untagged.mp3')) == {'title': 'Later'}
+
+
+def _slow_worker(paths):
+    time.sleep(.2)
+    return [{} for _ in paths]
+
+
+def test_file_cache_close():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _files = [os.path.join(_tmp, '%d.mp3' % i) for i in range(40)]
+        for f in _files:
+            _touch(f)
+        _cache_path = os.path.join(_tmp, 'cache')
+        c = metadata.file_cache(_cache_path, _slow_worker, processes=1)
+        c.BATCH_SIZE = 1
+        c.submit(_files)
+        for _ in range(200):
+            if len(c):
+                break
+            time.sleep(.05)
+        # what's pending gets dropped, what's been read gets stored
+        _t = time.time()
+        c.close()
+        assert time.time() - _t < 2.
+        c = metadata.file_cache(_cache_path, _slow_worker, processes=1)
+        assert 1 <= len(c) < len(_files)
+        c.close()
+
+
+def test_loudness():
+    if loudness.numpy is None:
+        print('skip test_loudness() - numpy is not installed')
+        return
+    numpy = loudness.numpy
+
+    def write_sine(path, amplitude, channels):
+        # 10s of 1kHz
+        _t = numpy.arange(44100 * 10) / 44100
+        _pcm = numpy.zeros((len(_t), 2), dtype=numpy.int16)
+        for c in channels:
+            _pcm[:, c] = amplitude * 32767 * numpy.sin(2 * numpy.pi * 1000 * _t)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as _f:
+            _f.write(_pcm.tobytes())
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        # full scale in one channel is -3.01 LUFS by definition
+        write_sine(os.path.join(_music, 'a', 'loud.mp3'), 1., (0,))
+        write_sine(os.path.join(_music, 'a', 'quiet.mp3'), .1, (0,))
+        _touch(os.path.join(_music, 'a', 'empty.mp3'))
+        # the files are raw PCM already
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       analyze_loudness=True, loudness_processes=2,
+                       decoder_command=('cat', '{path}'))
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            s._loudness.wait()
+            _loud = s._loudness.get(os.path.join(_music, 'a', 'loud.mp3'))
+            assert abs(_loud['loudness'] + 3.01) < .1
+            assert abs(_loud['peak'] - 1.) < .001
+            assert abs(s.get_gain((_music, 'a', 'loud.mp3')) -
+                       10 ** ((-18. + 3.01) / 20)) < .01
+            assert abs(s.get_gain((_music, 'a', 'quiet.mp3')) -
+                       10 ** ((-18. + 23.01) / 20)) < .01
+            assert s.get_gain((_music, 'a', 'empty.mp3')) == 1.
+        assert os.path.exists(os.path.join(_tmp, 'loudness_cache'))
+
+        with scheduler(config=dict(_config, loudness_target=0.)) as s:
+            # known from the cache right away
+            assert abs(s.get_gain((_music, 'a', 'loud.mp3')) - 1.) < .01
+            # turned up no further than to full scale
+            assert abs(s.get_gain((_music, 'a', 'quiet.mp3')) - 10.) < .01
+
+
+def test_affinity():
+    g = affinity_graph(((0, '/m', 'Miles Davis/Kind of Blue'),
+                        (1, '/m', 'Miles Davis/Bitches Brew'),
+                        (2, '/m', 'Nirvana/Nevermind'),
+                        (3, '/m', 'Live/Miles Davis 1964'),
+                        (4, '/m', 'Nirvana'),
+                        (5, '/m', 'Nirvana/Nevermind/Bonus')))
+    assert set(g.neighbours(0)) == {1, 3}
+    assert set(g.neighbours(2)) == {4, 5}
+    assert g.neighbours(1)[0] > g.neighbours(1)[3]
+    assert g.neighbours(42) == {} and g.step(42, None) is None
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        for _folder in ('Miles Davis/Kind of Blue', 'Miles Davis/Bitches Brew',
+                        'Live/Miles Davis 1964', 'Nirvana/Nevermind'):
+            for i in range(3):
+                _touch(os.path.join(_music, _folder, '%d.mp3' % i))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       scheduling_mode='affinity', affinity_restart=0.)
+        with scheduler(config=_config) as s:
+            assert s.get_scheduling_mode() == 'affinity'
+            s.add_path(_music)
+            s.schedule_next_item(s.search_filenames('kind blue')[0][0])
+            _folders = [s.get_next()[1] for _ in range(100)]
+            assert 'Nirvana/Nevermind' not in _folders
+            assert len(set(_folders)) == 3
+
+            # new folders join the graph in the background
+            _graph = s._affinity
+            _more = os.path.join(_tmp, 'more')
+            _touch(os.path.join(_more, 'Miles Davis', 'Sketches of Spain', '0.mp3'))
+            s.add_path(_more)
+            for _ in range(100):
+                if s._affinity is not _graph:
+                    break
+                time.sleep(.01)
+            assert len(s._affinity) == 5
+
+
+def test_lookahead():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        for i in range(10):
+            _touch(os.path.join(_music, 'a', '%d.mp3' % i))
+        assert warm_page_cache(os.path.join(_music, 'a', '0.mp3'))
+        assert not warm_page_cache(os.path.join(_music, 'a', 'missing.mp3'))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       lookahead=3)
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            for _ in range(100):
+                if len(s.list_upcoming()) == 3:
+                    break
+                time.sleep(.05)
+            _upcoming = s.list_upcoming()
+            assert len(_upcoming) == 3
+            assert os.path.join(*s.get_next()[1:]) == _upcoming[0][1]
+
+            # wishes come first
+            _wish = s.search_filenames('7.mp3')[0][0]
+            s.schedule_next_item(_wish)
+            assert s.list_upcoming(1) == [(_wish, 'a/7.mp3')]
+            assert s.get_next()[2] == '7.mp3'
+
+            # tracks picked ahead are dropped when they get banned
+            s.add_tag(listener='frans', track=s.get_next(), pos=0,
+                      details={'tag_name': 'ban', 'subject': '.mp3'})
+            assert s.list_upcoming() == []
+            assert s.get_next() is None
+
+
+def test_no_repeat():
+    w = recent_window(size=2)
+    for k in 'abc':
+        w.add(k)
+    assert 'a' not in w and 'b' in w and 'c' in w and len(w) == 2
+    w = recent_window(seconds=60)
+    w.add('old', time.time() - 61)
+    w.add('new')
+    assert 'old' not in w and 'new' in w and len(w) == 1
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _path = os.path.join(_tmp, 'recently_played')
+        _config = {'no_repeat_folders': 1, 'no_repeat_artist_seconds': 600}
+        r = recently_played(_config, _path)
+        r.add('/m/a/1.mp3', '/m/a', 'miles davis')
+        r.add('/m/b/1.mp3', '/m/b')
+        r.store()
+        r = recently_played(_config, _path)
+        assert r.excludes('/m/a/1.mp3', '/m/x')
+        assert r.excludes('/m/x/1.mp3', '/m/b')
+        assert not r.excludes('/m/x/1.mp3', '/m/a')
+        assert r.excludes('/m/x/1.mp3', '/m/x', 'miles davis')
+        # tracks about to be played count, too
+        assert r.excludes('/m/x/1.mp3', '/m/x', ahead=[('/m/y/1.mp3', '/m/x', None)])
+        assert not r.excludes('/m/x/1.mp3', '/m/x', ahead=[('/m/y/1.mp3', '/m/y', 'bill evans')])
+
+        _music = os.path.join(_tmp, 'music')
+        for i in range(10):
+            _touch(os.path.join(_music, 'a', '%d.mp3' % i))
+        _config = dict(CONFIG, playlist_folder=os.path.join(_tmp, 'lists'),
+                       lookahead=0, no_repeat_tracks=3)
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            _played = [s.get_next()[2] for _ in range(30)]
+            for i in range(3, 30):
+                assert _played[i] not in _played[i - 3:i]
+
+        # tracks picked ahead only count once they get played
+        _config = dict(_config, lookahead=3)
+        os.remove(os.path.join(_tmp, 'recently_played'))
+        with scheduler(config=_config) as s:
+            s.add_path(_music)
+            for _ in range(2):
+                for _ in range(100):
+                    if len(s.list_upcoming()) == 3:
+                        break
+                    time.sleep(.05)
+                _upcoming = [p for _, p in s.list_upcoming()]
+                assert len(set(_upcoming)) == 3
+                assert len(s._recent._windows['track']) == 0
+                s._lookahead.clear()
+            _played = s.get_next()
+            assert s._recent.excludes(os.path.join(*_played), os.path.join(*_played[:2]))
+            assert len(s._recent._windows['track']) == 1
+
+
+def test_play_history():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _path = os.path.join(_tmp, 'play_history')
+        h = history.play_history(_path)
+        assert h.top_played() == [] and h.skip_rates() == []
+        _now = time.time()
+        for i, (_track, _skipped) in enumerate((('a/1', False), ('a/2', True),
+                                               ('b/1', False), ('a/1', True),
+                                               ('b/1', False), ('a/1', False))):
+            h.record(_track, os.path.dirname(_track), ['julia', 'frans'],
+                     _now - 100 + i, 10., 200., _skipped)
+        h.close()
+        # a record cut off while being written
+        with open(_path, 'ab') as _f:
+            _f.write(b'123')
+
+        h = history.play_history(_path)
+        h.record('c/1', 'c', [], _now, 1., 100., True)
+        assert len(h) == 7
+        for _numpy in (history.numpy, None):
+            _saved, history.numpy = history.numpy, _numpy
+            try:
+                assert h.top_played(2) == [('a/1', 3), ('b/1', 2)]
+                assert h.top_played(since=_now - 95.5) == [('a/1', 1), ('c/1', 1)]
+                assert h.skip_rates(min_plays=2) == [('a', 4, .5), ('b', 2, 0.)]
+            finally:
+                history.numpy = _saved
+        h.close()
+
+        # names written before closing survive reopening
+        h.record('d/1', 'd', ['julia'], _now + 1, 1., 100., False)
+        h.close()
+        h.record('e/1', 'e', [], _now + 2, 1., 100., False)
+        h.close()
+        h = history.play_history(_path)
+        assert dict(h.top_played(since=_now + .5)) == {'d/1': 1, 'e/1': 1}
+        h.close()
+
+
 if __name__ == '__main__':
     print(sys.version_info)
     test_rule()
     test_scheduler()
+    test_library_index()
+    test_search_filenames()
+    test_fuzzy_search()
+    test_ban_matcher()
+    test_weighted_sampler()
+    test_get_next()
+    test_wait_for_next()
+    test_upvote_weighting()
+    test_watcher()
+    test_changed_folder()
+    test_wishlist()
+    test_journal()
+    test_smartlists()
+    test_listener_bans()
+    test_metadata()
+    test_file_cache_close()
+    test_loudness()
+    test_affinity()
+    test_lookahead()
+    test_no_repeat()
+    test_play_history()
@@ -2,13 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import server
+from control import control_channel
+from mplayer_output import mplayer_output
+import mixer
+import io
+import wave
 import zmq
 import os
+import time
+import tempfile
+import threading
 
 CONFIG = {'music_file_pattern':    (".mp3", ".mp4", ".m4a",
                                      ".ogg", ".opus", ),
            'input_dirs':            (os.path.dirname(__file__),),
-           'playlist_folder':       './lists',
+           'playlist_folder':       os.path.join(tempfile.mkdtemp(), 'lists'),
            'notification_endpoint': 'inproc://step2',
            }
 
@@ -17,14 +25,23 @@ def test_player():
         def __init__(self):
             pass
 
-        def get_next(self) -> tuple:
-            pass
+        def get_next(self, timeout: float=0.) -> tuple:
+            # nothing to play
+            time.sleep(timeout)
 
     _context = zmq.Context()
+    _socket = _context.socket(zmq.PAIR)
+    _socket.bind(CONFIG['notification_endpoint'])
 
     p = server.player(_context, CONFIG)
     p.set_scheduler(scheduler_stub())
     p.play()
+    assert _socket.recv_json() == {'type': 'hello from player'}
+    # a player waiting for something to play stops nevertheless
+    _t = time.time()
+    p.stop()
+    assert time.time() - _t < server.player.FETCH_TIMEOUT + 1.
+    _context.destroy(linger=0)
 
 
 def test_acquirer():
@@ -38,6 +55,217 @@ def test_acquirer():
     a = server.acquirer()
     a.set_scheduler(scheduler_stub())
 
+
+def test_control_channel():
+    c = control_channel()
+    assert not c.wait(0.)
+    threading.Timer(.05, c.put, ('pause',)).start()
+    _t = time.time()
+    assert c.wait(5.)
+    assert time.time() - _t < 1.
+    c.put('skip')
+    assert c.take() == ['pause', 'skip']
+    assert not c.wait(0.) and c.take() == []
+    assert c.latency()['count'] == 2
+    assert 0. <= c.latency()['mean'] <= c.latency()['max']
+    c.put('volume')
+    c.clear()
+    assert c.take() == [] and c.latency()['count'] == 2
+    c.close()
+
+
+def test_mplayer_output():
+    o = mplayer_output(interval=0.)
+    assert o.feed(b'Playing a.mp3.\nStarting pla') == ['Playing a.mp3.']
+    assert o.progress() is None
+    # lines span reads, only the latest status line counts
+    assert o.feed(b'yback...\nA:   1.0 (01.0) of 245.0 (04:05.0)  0.5% \rA:   1') == [
+        'Starting playback...']
+    assert o.progress() == (1., 245.)
+    assert o.feed(b'.1 (01.1) of 245.0 (04:05.0)  0.5% \rA:   1.2 (01.2) of 245.0 '
+                  b'(04:05.0)  0.5% \r\nEOF code: 1  \n') == ['EOF code: 1  ']
+    assert o.progress() == (1.2, 245.)
+    assert o.progress() is None
+    assert o.feed(b'A: garbage\r') == [] and o.progress() is None
+
+    o = mplayer_output(interval=60.)
+    o.feed(b'A:   1.0 (01.0) of 245.0 (04:05.0)  0.5% \r')
+    o.feed(b'A:   2.0 (02.0) of 245.0 (04:05.0)  0.5% \r')
+    assert o.progress() == (1., 245.) and o.progress() is None
+    o.reset()
+    o.feed(b'A:   0.0 (00.0) of 100.0 (01:40.0)  0.5% \r')
+    assert o.progress() == (0., 100.)
+
+
+def test_mixer():
+    if mixer.numpy is None:
+        return
+    numpy = mixer.numpy
+
+    class sink:
+        def __init__(self):
+            self.data = bytearray()
+        def write(self, data):
+            self.data += data
+        def samples(self):
+            return numpy.frombuffer(self.data, dtype=numpy.int16).reshape(-1, 2)
+
+    class handler:
+        volume = 1.
+        def __init__(self):
+            self.updates = []
+        def handler_get_volume(self):
+            return self.volume
+        def handler_get_pause(self):
+            return False
+        def handler_set_pause(self, value):
+            pass
+        def handler_update_pos(self, now, total):
+            self.updates.append((now, total))
+
+    def track(frames, value):
+        _data = numpy.full((frames, 2), value, dtype=numpy.int16).tobytes()
+        return lambda start: io.BytesIO(_data)
+
+    c = control_channel()
+    h = handler()
+
+    # gapless: the second track continues the last block of the first one
+    s = sink()
+    m = mixer.pcm_mixer(s, block_frames=1024, progress_interval=.02)
+    m.play(track(5000, 1000), c, h, 5000 / mixer.RATE)
+    # the length known up front gets reported along with the position
+    assert h.updates and all(l == 5000 / mixer.RATE for _, l in h.updates)
+    m.play(track(5000, 2000), c, h)
+    m.finish()
+    _samples = s.samples()
+    assert len(_samples) == 10240
+    assert (_samples[:5000] == 1000).all() and (_samples[5000:10000] == 2000).all()
+    assert (_samples[10000:] == 0).all()
+
+    # crossfade: three blocks overlap and sum up to the original level
+    s = sink()
+    m = mixer.pcm_mixer(s, block_frames=1024, crossfade=.05, curve='linear')
+    m.play(track(10240, 1000), c, h)
+    m.play(track(10240, 1000), c, h)
+    h.volume = .5
+    c.put('volume')
+    m.play(track(10240, 1000), c, h)
+    m.finish()
+    _samples = s.samples()
+    assert len(_samples) == 1024 * (30 - 2 * 3)
+    # the volume applies from the start of the third track on
+    assert (abs(_samples[:1024 * 14].astype(int) - 1000) <= 1).all()
+    assert (abs(_samples[-1024 * 4:-1024 * 3].astype(int) - 500) <= 1).all()
+    # the end fades out
+    assert _samples[-1, 0] < 10
+
+    # the backend opens its sink for playing and closes it when done
+    with tempfile.TemporaryDirectory() as _tmp:
+        _track = os.path.join(_tmp, 'a.pcm')
+        with open(_track, 'wb') as _f:
+            _f.write(numpy.full((5000, 2), 1000, dtype=numpy.int16).tobytes())
+        _wav = os.path.join(_tmp, 'out.wav')
+        h.handler_get_filename = lambda: _track
+        b = server.player.backend_mixer(c, h, {'mixer_sink': 'wav:' + _wav,
+                                               'mixer_block_frames': 1024,
+                                               'decoder_command': ('cat', '{path}')})
+        assert not os.path.exists(_wav)
+        b.blocking_play()
+        b.close()
+        with wave.open(_wav) as _f:
+            assert _f.getnframes() == 5120
+    c.close()
+
+
+def test_null_backend():
+    class handler:
+        pause = False
+        def __init__(self):
+            self.updates = []
+        def handler_get_filename(self):
+            return '/music/a.mp3'
+        def handler_get_pause(self):
+            return self.pause
+        def handler_set_pause(self, value):
+            self.pause = value
+        def handler_get_seek_position(self):
+            return 15
+        def handler_update_pos(self, now, total):
+            self.updates.append((now, total))
+
+    c = control_channel()
+    h = handler()
+    b = server.player.backend_null(c, h, speedup=1000., track_length=(20., 20.),
+                                   progress_interval=5.)
+    assert b.length('/music/a.mp3') == 20.
+    _t = time.time()
+    b.blocking_play()
+    assert time.time() - _t < 1.
+    assert [p for p, _ in h.updates] == [0., 5., 10., 15.]
+    assert all(l == 20. for _, l in h.updates)
+
+    # lengths differ between tracks but not between plays
+    b = server.player.backend_null(c, h, speedup=1000.)
+    assert 120. <= b.length('/music/a.mp3') <= 420.
+    assert b.length('/music/a.mp3') == b.length('/music/a.mp3')
+    assert b.length('/music/a.mp3') != b.length('/music/b.mp3')
+
+    # a paused track waits, seeking reports the new position right away
+    h.updates = []
+    b = server.player.backend_null(c, h, speedup=1., track_length=(60., 60.),
+                                   progress_interval=60.)
+    c.put('pause')
+    threading.Timer(.05, c.put, ('seek',)).start()
+    threading.Timer(.1, c.put, ('skip',)).start()
+    b.blocking_play()
+    assert h.pause
+    assert [int(p) for p, _ in h.updates] == [0, 15]
+    c.close()
+
+
+def test_restart():
+    with tempfile.TemporaryDirectory() as _tmp:
+        _music = os.path.join(_tmp, 'music')
+        os.makedirs(os.path.join(_music, 'a'))
+        for i in range(10):
+            open(os.path.join(_music, 'a', '%d.mp3' % i), 'w').close()
+        _config = dict(CONFIG, input_dirs=(_music,),
+                       playlist_folder=os.path.join(_tmp, 'lists'),
+                       player_backend='null', library_watcher='off',
+                       read_metadata=False, analyze_loudness=False, lookahead=0)
+        _context = zmq.Context()
+
+        def request(**request):
+            _socket.send_json(request)
+            return _socket.recv_json()
+
+        _played = None
+        for _ in range(2):
+            s = server.server(_config)
+            _thread = threading.Thread(target=s.run)
+            _thread.start()
+            _socket = _context.socket(zmq.REQ)
+            _socket.connect('tcp://localhost:9876')
+            assert request(type='hello', user_id='frans', user_name='Frans')['type'] == 'ok'
+            if _played is None:
+                # the library gets crawled while requests get answered
+                _played = s._scheduler.get_next(timeout=10.)
+            else:
+                # the no-repeat window has been stored and loaded again
+                assert s._scheduler._recent.excludes(os.path.join(*_played),
+                                                     os.path.join(*_played[:2]))
+            assert request(type='quit')['type'] == 'ok'
+            _thread.join()
+            _socket.close()
+        _context.destroy(linger=0)
+
+
 if __name__ == '__main__':
     test_player()
     test_acquirer()
+    test_control_channel()
+    test_mplayer_output()
+    test_mixer()
+    test_null_backend()
+    test_restart()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Keeps the scheduler's library in sync with the file system while the
+    server is running. Changed directories are handed over to
+    scheduler.refresh_dirs() which applies only the differences.
+'''
+
+import os
+import time
+import errno
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+import logging
+log = logging.getLogger('watcher')
+
+
+class polling_watcher:
+    ''' Finds changed directories by comparing their mtime with the one the
+        scheduler saw when it listed them. Works everywhere but has to stat
+        every known directory once per @interval.
+    '''
+
+    def __init__(self, scheduler_inst, interval: float=60.) -> None:
+        self._scheduler = scheduler_inst
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll(self) -> int:
+        ''' refreshes all changed directories, returns the track delta '''
+        _changed = []
+        for _root, _relpath, _mtime in self._scheduler.known_dirs():
+            _path = os.path.join(_root, _relpath) if _relpath else _root
+            try:
+                if os.stat(_path).st_mtime_ns == _mtime:
+                    continue
+            except OSError:
+                pass
+            _changed.append((_root, _relpath))
+        if not _changed:
+            return 0
+        log.info('%d directories changed', len(_changed))
+        return self._scheduler.refresh_dirs(_changed)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            try:
+                self.poll()
+            except Exception as ex:
+                log.error("polling for changes failed: %s", repr(ex))
+
+
+class inotify_watcher:
+    ''' Gets notified about changed directories by the Linux kernel (via
+        libc, no extra modules needed). Changes are collected until
+        nothing happened for @delay seconds.
+    '''
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+
+    WATCH_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    class unavailable(Exception):
+        pass
+
+    def __init__(self, scheduler_inst, delay: float=1.) -> None:
+        self._scheduler = scheduler_inst
+        self._delay = delay
+        self._stop_event = threading.Event()
+        self._thread = None
+        _libc_name = ctypes.util.find_library('c')
+        if _libc_name is None:
+            raise inotify_watcher.unavailable('libc not found')
+        self._libc = ctypes.CDLL(_libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise inotify_watcher.unavailable('libc has no inotify support')
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise inotify_watcher.unavailable(os.strerror(ctypes.get_errno()))
+        # watch descriptor -> (root, relpath) and back
+        self._dirs = {}
+        self._watches = {}
+        try:
+            self.sync_watches()
+        except inotify_watcher.unavailable:
+            os.close(self._fd)
+            raise
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._fd)
+
+    def sync_watches(self) -> None:
+        ''' adds watches for all directories the scheduler knows '''
+        for _root, _relpath, _ in self._scheduler.known_dirs():
+            if (_root, _relpath) in self._watches:
+                continue
+            _path = os.path.join(_root, _relpath) if _relpath else _root
+            _wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(_path), inotify_watcher.WATCH_MASK)
+            if _wd < 0:
+                _errno = ctypes.get_errno()
+                if _errno == errno.ENOSPC:
+                    raise inotify_watcher.unavailable(
+                        'too many directories, see fs.inotify.max_user_watches')
+                log.warning("cannot watch '%s': %s", _path, os.strerror(_errno))
+                continue
+            self._dirs[_wd] = (_root, _relpath)
+            self._watches[(_root, _relpath)] = _wd
+
+    def _read_events(self) -> set:
+        ''' returns the watched directories affected by pending events '''
+        _result = set()
+        try:
+            _buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return _result
+        _offset = 0
+        while _offset < len(_buffer):
+            _wd, _mask, _, _length = inotify_watcher.EVENT_HEADER.unpack_from(
+                _buffer, _offset)
+            _offset += inotify_watcher.EVENT_HEADER.size + _length
+            if _mask & inotify_watcher.IN_Q_OVERFLOW:
+                log.warning('missed file system events - check all directories')
+                _result.update(self._watches)
+                continue
+            _dir = self._dirs.get(_wd)
+            if _dir is None:
+                continue
+            if _mask & inotify_watcher.IN_IGNORED:
+                # the kernel removed the watch along with the directory
+                del self._dirs[_wd]
+                self._watches.pop(_dir, None)
+            _result.add(_dir)
+        return _result
+
+    def _run(self) -> None:
+        _changed = set()
+        _last_event = 0.
+        while not self._stop_event.is_set():
+            _readable, _, _ = select.select([self._fd], [], [], .5)
+            if _readable:
+                _changed |= self._read_events()
+                _last_event = time.time()
+                continue
+            if not _changed or time.time() - _last_event < self._delay:
+                continue
+            try:
+                self._scheduler.refresh_dirs(sorted(_changed))
+                _changed = set()
+                self.sync_watches()
+            except inotify_watcher.unavailable as ex:
+                log.error("stop watching for changes: %s", ex)
+                return
+            except Exception as ex:
+                log.error("applying changes failed: %s", repr(ex))
+                _changed = set()
+
+
+def create_watcher(scheduler_inst, config: dict):
+    ''' returns a watcher according to @config['library_watcher'] which is
+        one of 'auto' (inotify if available), 'inotify', 'poll' or 'off' '''
+    _kind = config.get('library_watcher', 'auto')
+    if _kind == 'off':
+        return None
+    if _kind in ('auto', 'inotify'):
+        try:
+            return inotify_watcher(scheduler_inst,
+                                   config.get('library_watch_delay', 1.))
+        except inotify_watcher.unavailable as ex:
+            if _kind == 'inotify':
+                raise
+            log.info('inotify is not available (%s) - poll for changes', ex)
+    return polling_watcher(scheduler_inst,
+                           config.get('library_poll_interval', 60.))
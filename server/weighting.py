@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class upvote_weights:
+    ''' Computes a selection weight for each track from the upvotes it got.
+        An upvote adds @upvote_boost to the track's base weight of 1, halves
+        its effect every @upvote_half_life seconds and counts with
+        @upvote_absent_factor only if its listener is not present.
+        Votes are kept in flat arrays so the whole distribution is
+        recomputed in one vectorized pass.
+    '''
+
+    def __init__(self, config: dict) -> None:
+        assert numpy is not None
+        self._boost = float(config.get('upvote_boost', 1.))
+        self._half_life = float(config.get('upvote_half_life', 30 * 24 * 3600.))
+        self._absent_factor = float(config.get('upvote_absent_factor', .25))
+        self._listener_ids = {}
+        self.clear()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def has_voted(self, listener: str) -> bool:
+        return listener in self._listener_ids
+
+    def clear(self) -> None:
+        self._tracks = array('q')
+        self._times = array('d')
+        self._listeners = array('q')
+
+    def add_vote(self, track: int, time_stamp: float, listener: str) -> None:
+        self._tracks.append(track)
+        self._times.append(time_stamp)
+        self._listeners.append(
+            self._listener_ids.setdefault(listener, len(self._listener_ids)))
+
+    def compute(self, banned: bytearray, present_listeners: set,
+                now: float):
+        ''' returns a numpy array with one weight per track, 0 for tracks
+            marked in @banned '''
+        _weights = numpy.ones(len(banned))
+        if len(self._tracks) > 0:
+            _tracks = numpy.frombuffer(self._tracks, dtype=numpy.int64)
+            _ages = numpy.maximum(
+                now - numpy.frombuffer(self._times, dtype=numpy.float64), 0.)
+            _present = numpy.isin(
+                numpy.frombuffer(self._listeners, dtype=numpy.int64),
+                [self._listener_ids[l] for l in present_listeners
+                 if l in self._listener_ids])
+            _votes = (self._boost * numpy.exp2(-_ages / self._half_life) *
+                      numpy.where(_present, 1., self._absent_factor))
+            _weights += numpy.bincount(_tracks, weights=_votes,
+                                       minlength=len(banned))[:len(banned)]
+        _weights[numpy.frombuffer(banned, dtype=numpy.bool_)] = 0.
+        return _weights
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import itertools
+
+
+class wishlist:
+    ''' Tracks listeners wish to hear next, ordered by their number of
+        votes (most first) and the time they have been wished (oldest
+        first). Every track is on the list only once - wishing it again
+        counts as a vote.
+        Voting pushes a new heap entry and invalidates the old one so all
+        operations take O(log n).
+    '''
+
+    class unknown_wish(Exception):
+        pass
+
+    # heap entry layout - entries are lists so they can be invalidated
+    _VOTES, _TIME, _SEQ, _TRACK, _VALID = range(5)
+
+    def __init__(self) -> None:
+        self._heap = []
+        # track -> (current heap entry, set of voters)
+        self._wishes = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._wishes)
+
+    def __contains__(self, track):
+        return track in self._wishes
+
+    def add(self, track: int, listener: str, time_stamp: float=None) -> int:
+        ''' wishes @track or votes for it if it has been wished already,
+            returns its number of votes '''
+        if track in self._wishes:
+            return self.vote(track, listener)
+        self._push(track, 1, time.time() if time_stamp is None else time_stamp,
+                   {listener})
+        return 1
+
+    def vote(self, track: int, listener: str) -> int:
+        ''' adds a vote of @listener (once per listener), returns the
+            number of votes for @track '''
+        if track not in self._wishes:
+            raise wishlist.unknown_wish(track)
+        _entry, _voters = self._wishes[track]
+        if listener in _voters:
+            return len(_voters)
+        _voters.add(listener)
+        _entry[wishlist._VALID] = False
+        self._push(track, len(_voters), _entry[wishlist._TIME], _voters)
+        return len(_voters)
+
+    def pop(self):
+        ''' removes and returns the most wanted track or None '''
+        while self._heap:
+            _entry = heapq.heappop(self._heap)
+            if _entry[wishlist._VALID]:
+                del self._wishes[_entry[wishlist._TRACK]]
+                return _entry[wishlist._TRACK]
+        return None
+
+    def items(self, count: int=None) -> list:
+        ''' returns (track, votes, time) of the @count most wanted tracks '''
+        _valid = (e for e in self._heap if e[wishlist._VALID])
+        _entries = (sorted(_valid) if count is None else
+                    heapq.nsmallest(count, _valid))
+        return [(e[wishlist._TRACK], -e[wishlist._VOTES], e[wishlist._TIME])
+                for e in _entries]
+
+    def _push(self, track: int, votes: int, time_stamp: float, voters: set) -> None:
+        _entry = [-votes, time_stamp, next(self._sequence), track, True]
+        self._wishes[track] = (_entry, voters)
+        heapq.heappush(self._heap, _entry)
+        # don't let invalidated entries pile up
+        if len(self._heap) > 2 * len(self._wishes) + 32:
+            self._heap = [e for e in self._heap if e[wishlist._VALID]]
+            heapq.heapify(self._heap)